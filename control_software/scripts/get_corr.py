@@ -8,6 +8,7 @@ import numpy as np
 import argparse 
 import time
 import os
+from hera_corr_f.poco import PocoScheduler, PocoWriter
 
 def get_corr_output(feng, ant1, ant2, int_time=10):
 
@@ -70,30 +71,21 @@ if __name__ == "__main__":
     logger.warning('Disabling the monitoring. Use poco option in monitoring if you want both.')
     time.sleep(2)
     
-    NCHAN    = 1024
-    NPOL     = 4
-
-    frequencies = np.arange(NCHAN) * 250e6/NCHAN
-    pols = range(NPOL)
-    ant1_array=np.array([[0,0,0,1,1,2] for t in range(args.num_spectra)]).astype(int).flatten()
-    ant2_array=np.array([[0,1,2,1,2,2] for t in range(args.num_spectra)]).astype(int).flatten()
-    antenna_pairs = ([[0,0],[0,1],[0,2],[1,1],[1,2],[2,2]])
-
     fengine = SnapFengine(args.host)
-    
-    times = []
-    data = []
-    # Start integrating and collecting data
-    for n in range(args.num_spectra):
-        for a1, a2 in antenna_pairs:
-            r.set('disable_monitoring', 1, ex=60)
-            logger.info('Getting baseline pair: (%d, %d)..'%(a1,a2))
-            c = get_corr_output(fengine,a1,a2,args.integration_time) 
-            times.append(c['times'])
-            data.append(np.transpose(c['data']))
-    times = np.concatenate(times)
+    acc_len = int((args.integration_time*250e6)/(8*fengine.corr.nchans*fengine.corr.spec_per_acc))
 
-    outfilename = os.path.join(args.output, 'snap_correlation_%d.npz'%(times[0]))
-    logger.info('Writing output to file: %s'%outfilename)
-    np.savez(outfilename,data=data,polarizations=pols,frequencies=frequencies,
-             times=times,ant1_array=ant1_array,ant2_array=ant2_array)
+    # Stream every pair of inputs, num_spectra times, straight to disk.
+    # The output is a directory readable with hera_corr_f.poco.read_poco
+    outfilename = os.path.join(args.output, 'snap_correlation_%d' % time.time())
+    logger.info('Writing output to: %s'%outfilename)
+    writer = PocoWriter(outfilename, args.host, args.num_spectra, nchans=fengine.corr.nchans)
+    # Keep the monitoring off while we're running
+    def write(host, pair, acc_cnt, timestamp, spec):
+        r.set('disable_monitoring', 1, ex=60)
+        writer.add(pair, timestamp, spec)
+    scheduler = PocoScheduler([fengine], write, acc_len=acc_len)
+    try:
+        scheduler.run(ncycles=args.num_spectra)
+    finally:
+        writer.close()
+    scheduler.report()
@@ -5,6 +5,7 @@ import json
 import argparse
 from subprocess import Popen, PIPE
 from hera_corr_f import HeraCorrelator
+from hera_corr_f.control_daemon import DaemonClient
 
 def send_response(r, command, time, **kwargs):
     message_dict = {"command":command, "time":time, "args":kwargs}
@@ -40,6 +41,9 @@ if __name__ == "__main__":
                         help ='Hostname of redis server')
     parser.add_argument('-t', dest='testmode', action='store_true', default=False,
                         help ='Use this flag to run in test mode, where no commands are executed')
+    parser.add_argument('-d', dest='daemon', action='store_true', default=False,
+                        help ='Run commands through the control daemon (hera_snap_control_daemon.py), '\
+                              'rather than connecting to the boards')
     args = parser.parse_args()
     
     r = redis.Redis(args.redishost)
@@ -48,7 +52,10 @@ if __name__ == "__main__":
     cmd_chan.subscribe("corr:message")
     cmd_chan.get_message(timeout=0.1)
 
-    corr = HeraCorrelator()
+    if args.daemon:
+        corr = DaemonClient(args.redishost)
+    else:
+        corr = HeraCorrelator()
     
     while(True):
         message = cmd_chan.get_message(timeout=5)
@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+import sys
+import json
+import logging
+import argparse
+from hera_corr_f import helpers
+from hera_corr_f import benchmark
+from hera_corr_f.snap_sim import TapcpModel
+
+logger = helpers.add_default_log_handlers(logging.getLogger(__file__))
+
+parser = argparse.ArgumentParser(description='Measure the register transactions, bytes and TAPCP time the '\
+                                 'board-wide control operations cost, on an array of simulated SNAPs. '\
+                                 'Exits with status 1 if any limit or baseline is exceeded.',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('operations', type=str, nargs='*', default=None,
+                    help='Operations to run (default all): %s' % ', '.join([name for name, func in benchmark.OPERATIONS]))
+parser.add_argument('-n', dest='nboards', type=int, default=10,
+                    help='Number of simulated boards')
+parser.add_argument('-o', dest='output', type=str, default=None,
+                    help='Write the report, as JSON, to this file')
+parser.add_argument('-b', dest='baseline', type=str, default=None,
+                    help='Compare to this earlier report')
+parser.add_argument('-t', dest='thresholds', type=str, default=None,
+                    help='JSON file of {operation: {metric: maximum value}} limits to check')
+parser.add_argument('--tolerance', type=float, default=0.05,
+                    help='Fraction by which a metric may exceed its baseline value')
+parser.add_argument('--latency', type=float, default=2e-3,
+                    help='Modeled TAPCP round trip time, in seconds')
+parser.add_argument('--bandwidth', type=float, default=2e6,
+                    help='Modeled TAPCP bandwidth, in bytes per second')
+parser.add_argument('--sleep', action='store_true', default=False,
+                    help='Make the simulated boards wait the modeled time of every transaction')
+args = parser.parse_args()
+
+bench = benchmark.ControlBenchmark(nboards=args.nboards, sleep=args.sleep,
+                                   model=TapcpModel(latency=args.latency, bandwidth=args.bandwidth))
+report = bench.run(args.operations or None)
+
+print '%-22s %12s %12s %12s %12s %12s' % ('Operation (per board)', 'Transactions', 'Bytes read',
+                                          'Bytes written', 'TAPCP time', 'Wall time')
+for name, func in benchmark.OPERATIONS:
+    if name in report['operations']:
+        m = report['operations'][name]
+        print '%-22s %12.1f %12d %12d %11.3fs %11.3fs' % (name, m['transactions'], m['bytes_read'],
+                                                           m['bytes_written'], m['modeled_time'], m['wall_time'])
+
+if args.output is not None:
+    benchmark.save_report(report, args.output)
+    logger.info('Wrote report to %s' % args.output)
+
+failures = []
+if args.thresholds is not None:
+    failures += benchmark.check_thresholds(report, benchmark.load_report(args.thresholds))
+if args.baseline is not None:
+    failures += benchmark.compare_to_baseline(report, benchmark.load_report(args.baseline), tolerance=args.tolerance)
+for failure in failures:
+    logger.error(failure)
+if len(failures) > 0:
+    sys.exit(1)
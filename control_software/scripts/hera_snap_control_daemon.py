@@ -0,0 +1,42 @@
+#! /usr/bin/env python
+import time
+import logging
+import argparse
+import threading
+from hera_corr_f import HeraCorrelator
+from hera_corr_f import helpers
+from hera_corr_f.control_daemon import ControlDaemon
+
+logger = helpers.add_default_log_handlers(logging.getLogger(__file__))
+
+parser = argparse.ArgumentParser(description='Keep connections to all the SNAPs open, and run requests from '\
+                                 'scripts (see hera_snap_ctl.py) on them, one at a time per board. '\
+                                 'Also polls the boards for monitoring data, in place of hera_snap_redis_monitor.py',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--config_file', type=str, default=None,
+                    help = 'YAML configuration file with hosts and channels list. Default: the one in redis, '\
+                           'which is reloaded whenever a new one is uploaded')
+parser.add_argument('-r', dest='redishost', type=str, default='redishost',
+                    help ='Host servicing redis requests')
+parser.add_argument('-d', dest='delay', type=float, default=10.0,
+                    help ='Seconds between monitor polling loops. 0 to not poll')
+parser.add_argument('-D', dest='retrytime', type=float, default=300.0,
+                    help ='Seconds between reconnection attempts to dead boards')
+args = parser.parse_args()
+
+def make_corr():
+    return HeraCorrelator(redishost=args.redishost, config=args.config_file)
+
+daemon = ControlDaemon(make_corr(), make_corr=make_corr if args.config_file is None else None)
+logger.info('Control daemon serving %d boards' % len(daemon.corr.fengs))
+
+if args.delay > 0:
+    monitor_thread = threading.Thread(target=daemon.run_monitor, args=(args.delay, args.retrytime))
+    monitor_thread.daemon = True
+    monitor_thread.start()
+
+try:
+    daemon.serve()
+except KeyboardInterrupt:
+    logger.info('Stopping')
+    daemon.stop()
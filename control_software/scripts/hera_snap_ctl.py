@@ -0,0 +1,43 @@
+#! /usr/bin/env python
+import sys
+import json
+import yaml
+import argparse
+from hera_corr_f import control_daemon
+
+parser = argparse.ArgumentParser(description='Run a command on the SNAPs through the control daemon '\
+                                 '(hera_snap_control_daemon.py), eg. "resync manual=True", or '\
+                                 '"feng_call eth disable_tx --hosts heraNode1Snap0"',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('method', type=str,
+                    help='Method to run, one of: %s'
+                         % ', '.join(control_daemon.DAEMON_METHODS + control_daemon.CORR_METHODS))
+parser.add_argument('params', type=str, nargs='*',
+                    help='Arguments of the method, and key=value keyword arguments. Values are read as YAML')
+parser.add_argument('--hosts', type=str, nargs='+', default=None,
+                    help='Boards to run feng_call on. Default: all. Only feng_call takes hosts, '\
+                         'the other methods use every board')
+parser.add_argument('-r', dest='redishost', type=str, default='redishost',
+                    help ='Host servicing redis requests')
+parser.add_argument('-p', dest='priority', type=int, default=control_daemon.CONTROL,
+                    help='Priority of the request. Lower goes first')
+parser.add_argument('-t', dest='timeout', type=float, default=600.0,
+                    help='Seconds to wait for the request to be run')
+args = parser.parse_args()
+
+call_args = []
+call_kwargs = {}
+for param in args.params:
+    key, sep, val = param.partition('=')
+    if sep:
+        call_kwargs[key] = yaml.safe_load(val)
+    else:
+        call_args += [yaml.safe_load(param)]
+
+client = control_daemon.DaemonClient(args.redishost, timeout=args.timeout)
+try:
+    result = client.call(args.method, call_args, call_kwargs, priority=args.priority, hosts=args.hosts)
+except control_daemon.RemoteError as e:
+    print >> sys.stderr, e
+    sys.exit(1)
+print json.dumps(result, indent=2, sort_keys=True)
@@ -24,6 +24,8 @@ parser.add_argument('-s', dest='sync', action='store_true', default=False,
                     help ='Use this flag to sync the F-engine(s) and Noise generators from PPS')
 parser.add_argument('-m', dest='mansync', action='store_true', default=False,
                     help ='Use this flag to manually sync the F-engines with an asynchronous software trigger')
+parser.add_argument('-S', dest='staged', action='store_true', default=False,
+                    help ='Use this flag to arm all F-engines concurrently when syncing, and check they caught the same PPS')
 parser.add_argument('-i', dest='initialize', action='store_true', default=False,
                     help ='Use this flag to initialize the F-engine(s)')
 parser.add_argument('-t', dest='tvg', action='store_true', default=False,
@@ -36,7 +38,7 @@ parser.add_argument('-p','--program', action='store_true', default=False,
                     help='Program FPGAs with the fpgfile specified in the config file if not programmed already')
 args = parser.parse_args()
 
-corr = HeraCorrelator(redishost=args.redishost, config=args.config_file)
+corr = HeraCorrelator(redishost=args.redishost, config=args.config_file, shadow=True)
 
 if not corr.config_is_valid:
     logger.error('Currently loaded config is invalid')
@@ -89,8 +91,9 @@ if args.noise:
 # per the config file. A total of 32 Xengs are assumed for 
 # assigning slots- 16 for the even bank, 16 for the odd.  
 # Channels not assigned to Xengs in the config file are 
-# ignored. Following are the assumed globals:
-if not corr.configure_freq_slots():
+# ignored. Only the parts of each board's tables which differ
+# from the config are written, so re-running this is cheap.
+if corr.apply_config() is None:
     logger.error('Configuring frequency slots failed!')
     exit()
 
@@ -100,8 +103,10 @@ if args.sync:
     for feng in corr.fengs:
         #feng.sync.change_period(9*8*7*6*5*4*3*2 * 4096)
         feng.sync.change_period(0)
-    corr.resync(manual=args.mansync)
-    corr.sync_noise(manual=args.mansync)
+    missed = corr.resync(manual=args.mansync, staged=args.staged)
+    if len(missed) > 0:
+        logger.error('Boards which missed the sync: %s' % ', '.join(missed))
+    corr.sync_noise(manual=args.mansync, staged=args.staged)
 
 if args.eth:
     corr.enable_output()
@@ -1,30 +1,16 @@
 #! /usr/bin/env python
 import sys
 import time
-import datetime
 import argparse
 import logging
-import json
 from hera_corr_f import HeraCorrelator
 from hera_corr_f import helpers
+from hera_corr_f import instrument
+from hera_corr_f.monitor import get_board_inputs, poll_boards, upload_status, poll_poco
 
 logger = helpers.add_default_log_handlers(logging.getLogger(__file__))
 FAIL_COUNT_LIMIT = 20
 
-def get_fpga_stats(feng):
-    """
-    Get FPGA stats.
-    returns: Dictionary of stats
-    """
-    stat = {}
-    stat['temp'] = feng.fpga.transport.get_temp()
-    stat['timestamp'] = datetime.datetime.now().isoformat()
-    stat['uptime'] = feng.sync.uptime()
-    stat['pps_count'] = feng.sync.count()
-    stat['serial'] = feng.serial
-    stat['pmb_alert'] = feng.fpga.read_uint('pmbus_alert')
-    return stat
-
 def get_pam_stats():
     """
     Get PAM stats.
@@ -43,41 +29,6 @@ def get_fem_stats():
     """
     pass
 
-def get_poco_output(feng,redishost):
-    """
-    Get pocket correlator output. Antennas and integration time 
-    polled from redis database.
-    Params:  feng: SnapFengine object that maps to a SNAP board
-             redishost: Redis database to upload the data to.
-    Returns: Dict: {'data':shape(fqs, pols), 
-                    'times':list of unix times}
-    """
-    int_time = int(redishost.hget('poco', 'integration_time'))
-    acc_len = int_time * 250e6/ (8192 * feng.corr.spec_per_acc)
-    
-    if (acc_len != feng.corr.get_acc_len()):
-        feng.corr.set_acc_len(acc_len)
-  
-    antenna_pairs = ([[0,0],[0,1],[0,2],[1,1],[1,2],[2,2]])
-    pair = (int(redishost.hget('poco','ant1')), int(redishost.hget('poco','ant2')))
-    idx = antenna_pairs.index(pair)
-    ant1, ant2 = antenna_pairs[(idx+1)%len(antenna_pairs)]
-    redishost.hset('poco','ant1',ant1)
-    redishost.hset('poco','ant2',ant2)    
-
-    ant1 *= 2; ant2 *= 2
-    xcorr = []; times = []
-    for i in range(4):
-        xcorr.append(feng.corr.get_new_corr(ant1+i%2, (ant2+(i//2+i%2)%2)))
-        times.append(time.time())
-    xcorr = np.asarray(xcorr); times = np.asarray(times)
-    redishost.hset('poco', 'corr',  xcorr.tostring())
-    redishost.hset('poco', 'times', times.tostring())
-
-    # to unpack from string: c = struct.unpack('<8192d'); xcorr = (c[::2] + 1j*c[1::2]).reshape(4,1024)
-   
-    return {'data':xcorr, 'times':times}
-    
 def print_ant_log_messages(corr):
     for ant, antval in corr.ant_to_snap.iteritems():
         for pol, polval in antval.iteritems():
@@ -102,8 +53,14 @@ if __name__ == "__main__":
                         help='Upload pocket correlator output to redis')
     parser.add_argument('-D', dest='retrytime', type=float, default=300.0,
                         help ='Seconds between reconnection attempts to dead boards')
+    parser.add_argument('-i', dest='instrument', action='store_true', default=False,
+                        help='Record the register accesses made by the monitor, and publish them to '\
+                             'redis (see hera_corr_f.instrument)')
     args = parser.parse_args()
 
+    if args.instrument:
+        instrument.enable()
+
     corr = HeraCorrelator(redishost=args.redishost)
     upload_time = corr.r.hget('snap_configuration', 'upload_time')
     print_ant_log_messages(corr)
@@ -129,50 +86,34 @@ if __name__ == "__main__":
         # Recompute the hookup every time. It's fast
         corr.compute_hookup()
 
-        for ant, antval in corr.ant_to_snap.iteritems():
-            for pol, polval in antval.iteritems():
-                # Skip if the antenna is associated with a board we can't reach
-                if polval['host'] in corr.dead_fengs.keys():
-                    continue
-                try:
-                    status_key = 'status:ant:%s:%s' % (ant, pol)
-                    feng = polval['host']
-                    chan = polval['channel']
-                    corr.r.hmset(status_key, {'f_host':feng.host, 'host_ant_id':chan})
-                    means, powers, rmss = feng.input.get_stats(sum_cores=True)
-                    mean = means[chan]
-                    power = powers[chan]
-                    rms   = rmss[chan]
-                    corr.r.hmset(status_key, {'adc_mean':mean, 'adc_power':power, 'adc_rms':rms})
-                    hist_bins, hist_vals = feng.input.get_histogram(chan, sum_cores=True)
-                    corr.r.hset(status_key, 'histogram', json.dumps([hist_bins.tolist(), hist_vals.tolist()]))
-                    corr.r.hset(status_key, 'timestamp', datetime.datetime.now().isoformat())
-
-                    if args.poco: get_poco_output(feng,corr.r)
-                        
-                    # If this was all successful, reset the fail counter
-                    fail_count[feng.host] = 0
-                except:
-                    logger.error('Failed to get stats for ant %s pol %s (feng %s, chan %s)' % (ant, pol, feng.host, chan))
-                    count = fail_count.get(feng.host, 0)
-                    fail_count[feng.host] = count + 1
-                    if fail_count[feng.host] > FAIL_COUNT_LIMIT:
-                        logger.error('Declaring board %s bad' % feng.host)
-                        corr.declare_feng_dead(feng)
-                        fail_count[feng.host] = 0
+        inputs = get_board_inputs(corr)
 
-        for feng in corr.fengs:
+        # Poll all the boards at once, and upload everything with a single round trip
+        status, errors = poll_boards(corr, inputs)
+        upload_status(corr.r, status)
+        # The pocket correlators are read separately, so that their failures don't lose the boards' status
+        if args.poco:
             try:
-                corr.r.hmset("status:snap:%s" % feng.host, get_fpga_stats(feng))
-                fail_count[feng.host] = 0
-            except:
-                logger.error('Failed to get stats from SNAP %s' % feng.host)
-                count = fail_count.get(feng.host, 0)
-                fail_count[feng.host] = count + 1
-                if fail_count[feng.host] > FAIL_COUNT_LIMIT:
-                    logger.error('Declaring board %s bad' % feng.host)
-                    corr.declare_feng_dead(feng)
-                    fail_count[feng.host] = 0
+                poco_errors = poll_poco(corr, corr.r, hosts=status.keys())
+            except Exception as e:
+                poco_errors = {'all boards' : e}
+            for host, err in poco_errors.iteritems():
+                logger.error('Failed to get pocket correlator output from SNAP %s: %r' % (host, err))
+        if args.instrument:
+            instrument.export_redis(corr.r, __file__)
+        # If this was all successful, reset the fail counter
+        for host in status.keys():
+            fail_count[host] = 0
+
+        for host, err in errors.iteritems():
+            logger.error('Failed to get stats from SNAP %s (antennas %s): %s' % (host,
+                         ', '.join(['%s%s' % (ant, pol) for ant, pol, chan in inputs.get(host, [])]), err))
+            count = fail_count.get(host, 0)
+            fail_count[host] = count + 1
+            if fail_count[host] > FAIL_COUNT_LIMIT:
+                logger.error('Declaring board %s bad' % host)
+                corr.declare_feng_dead(host)
+                fail_count[host] = 0
 
         # If the retry period has been exceeded, try to reconnect to dead boards:
         if time.time() > (retry_tick + args.retrytime):
@@ -42,7 +42,7 @@ time.sleep(1)
 # Initialize, set input according to command line flags.
 fengines_list = []
 for host,params in fengs.items():
-    fengines_list += [SnapFengine(host)]
+    fengines_list += [SnapFengine(host, shadow=True)]
 
 print 'Sync-ing Fengines'
 print 'Waiting for PPS at time %.2f' % time.time()
@@ -1,31 +1,17 @@
-import socket
-import struct
 import argparse
 import logging
 import numpy as np
-
-def decode_packet(packet):
-    p = struct.unpack('>Q4608B', packet)
-    time = p[0] >> 29
-    chan = (p[0] >> 16) & (2**13 - 1)
-    ant  = p[0] & 0xffff
-    return time, chan, ant, np.array(p[1:])
-
-def decode_header(packet):
-    p = struct.unpack('>Q', packet[0:8])
-    time = p[0] >> 29
-    chan = (p[0] >> 16) & (2**13 - 1)
-    ant  = p[0] & 0xffff
-    return time, chan, ant
-
+from hera_corr_f import packet_capture
+from hera_corr_f.packet_capture import PacketCapture, CaptureService, TvgChecker, decode_headers, payload_view
 
 parser = argparse.ArgumentParser(description='Grab packets from an F-engine in '\
                                  'EQ TVG mode and check they look ok',
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('-i', dest='ip', type=str, default='10.10.10.136',
                     help = 'Socket to which to bind')
-parser.add_argument('-p', dest='port', type=int, default=8511,
-                    help = 'Port to collect packets from')
+parser.add_argument('-p', dest='port', type=int, nargs='+', default=[8511],
+                    help = 'Port(s) to collect packets from. More than one port '\
+                           'requires --workers')
 parser.add_argument('-s', dest='single_packet', action='store_true', default=False,
                     help = 'Use this flag to print a single packet')
 parser.add_argument('-e', dest='errors', action='store_true', default=False,
@@ -48,34 +34,61 @@ parser.add_argument('--dt',dest='timeorder',action='store_true',default=False,
                     help = 'Check that time increments by 1 after all channels '\
                            'and antennas are received. WORKS ONLY IF ALL PACKETS '\
                            'ARE CAPTURED.')
+parser.add_argument('--batch', dest='batch', type=int, default=256,
+                    help = 'Maximum number of packets to receive at once')
+parser.add_argument('--workers', dest='workers', type=int, default=0,
+                    help = 'Capture with this many processes per port, and just '\
+                           'report counts and errors (checking the payload if '\
+                           '-e or --o is given) every --report seconds')
+parser.add_argument('--report', dest='report', type=float, default=10.0,
+                    help = 'Seconds between reports when using --workers')
 
 args = parser.parse_args()
 
-BUFSIZE = 4616
-chans_per_pkt = 384
-nsamp_per_pkt = 2
-pol = 2
+chans_per_pkt = packet_capture.CHANS_PER_PKT
+nsamp_per_pkt = packet_capture.NSAMP_PER_PKT
+pol = packet_capture.NPOL
 tot_chans = 8192
 
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind((args.ip, args.port))
-sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024*4616*128)
+if args.workers > 0:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    tvg_mode = args.mode if (args.errors or args.ordererrors) else None
+    service = CaptureService(args.ip, args.port, nworkers=args.workers,
+                             tvg_mode=tvg_mode, batch=args.batch)
+    service.run(report_interval=args.report)
+    exit()
+
+if len(args.port) > 1:
+    print 'Capturing from more than one port requires --workers'
+    exit()
+
+cap = PacketCapture(args.ip, args.port[0], batch=args.batch)
+
+def next_batch():
+    pkts = []
+    while len(pkts) == 0:
+        pkts = cap.recv_batch()
+    return pkts
 
 if args.timeorder:
-    payload, addr = sock.recvfrom(BUFSIZE)
-    ti, chani, anti = decode_header(payload)
+    pkts = next_batch()
+    time, chan, ant = decode_headers(pkts)
+    anti, chani = ant[0], chan[0]
+    ti = time[0]
     errorctr = 0; n=0
     while(True):
         try:
-            payload, addr = sock.recvfrom(BUFSIZE)
-            time, chan, ant  = decode_header(payload)
-            if (ant == anti) and (chan == chani):
-                if (time-ti != 2*nsamp_per_pkt): #2x for even odd split
-                    print "ERROR: TIME not incrementing by %d" %(2*nsamp_per_pkt)
-                    print "ANT: %d CHAN: %d TIME: %d"%(ant,chan,time)
-                    errorctr += 1
-                ti = time;
-                n += 1
+            # Follow the timestamps of the first packet's antenna and channel
+            sel = (ant == anti) & (chan == chani)
+            times = np.concatenate([[ti], time[sel]])
+            dt = np.diff(times)
+            for i in np.where(dt != 2*nsamp_per_pkt)[0]: #2x for even odd split
+                print "ERROR: TIME not incrementing by %d" %(2*nsamp_per_pkt)
+                print "ANT: %d CHAN: %d TIME: %d"%(anti,chani,times[i+1])
+                errorctr += 1
+            ti = times[-1]
+            n += len(dt)
+            time, chan, ant = decode_headers(next_batch())
         except KeyboardInterrupt:
             print '#######################'
             print 'Grabbed %d packets' % n
@@ -85,8 +98,9 @@ if args.timeorder:
     exit()          
 
 if args.single_packet:
-    payload, addr = sock.recvfrom(BUFSIZE)
-    time, chan, ant, data = decode_packet(payload)
+    pkt = next_batch()[0:1]
+    time, chan, ant = [x[0] for x in decode_headers(pkt)]
+    data = pkt['payload'][0]
     print 'TIME: %d (TIME%%4: %d), CHAN: %d , ANT: %d' % (time, time%4, chan, ant)
     for ant in range(3):
         print '\nAnt: %d'%ant
@@ -102,73 +116,51 @@ if args.single_packet:
 n = 0
 ant_counter = np.zeros(23)
 chan_counter = np.zeros(8192)
-#data_chan_counter = np.zeros(2048*3)
 err_count = 0
-
-# Determine the bank you are receiving
-if args.timeerrors or args.errors:
-    payload, addr = sock.recvfrom(BUFSIZE)
-    time, c, a, d = decode_packet(payload)
-    bank = time%4
+bank = None
 
 # Generate the test vector you expect to receive
 # ['const_ants','const_pols','ramp_ants','ramp_pols']
 if args.ordererrors or args.errors:
-    tvg = np.zeros(8192*6,dtype='>B')
-    if args.mode == 'const_pols':
-        for a in range(6):
-            tvg[a*8192:(a+1)*8192] = a
-    if args.mode == 'const_ants':
-        for a in range(6):
-            tvg[a*8192:(a+1)*8192] = a//2
-    else:
-        ramp = np.arange(8192,dtype='>B')
-        if args.mode == 'ramp_pols':
-            for a in range(6):
-                tvg[a*8192:(a+1)*8192] = ramp + a
-        if args.mode == 'ramp_ants':
-            for a in range(6):
-                tvg[a*8192:(a+1)*8192] = ramp + a//2
+    tvg = TvgChecker(args.mode, nchans=tot_chans)
 
 while(True):
     try:
-        payload, addr = sock.recvfrom(BUFSIZE)
-        time, chan, ant, data = decode_packet(payload)
+        pkts = next_batch()
+        time, chan, ant = decode_headers(pkts)
 
         if args.verbose:
-            print '%d: TIME: %d (TIME%%4: %d), CHAN: %4d, ANT: %3d, DATA0: %d'\
-                   % (n, time, time%4, chan, ant, data[0])
-        ant_counter[ant//3] += 1
-        chan_counter[chan] += 1
+            for i in range(len(pkts)):
+                print '%d: TIME: %d (TIME%%4: %d), CHAN: %4d, ANT: %3d, DATA0: %d'\
+                       % (n+i, time[i], time[i]%4, chan[i], ant[i], pkts['payload'][i,0])
+        ant_counter += np.bincount(ant//3, minlength=len(ant_counter))[:len(ant_counter)]
+        chan_counter += np.bincount(chan, minlength=len(chan_counter))[:len(chan_counter)]
 
         if args.errors or args.timeerrors:
-            # Check you are getting only one (odd/even) bank
-            if (time % 4!=bank):
-                print 'ERROR: Receiving both odd and even banks!'
-                err_count += 1
+            # Determine the bank you are receiving, then check
+            # you are getting only one (odd/even) bank
+            if bank is None:
+                bank = time[0] % 4
+            nwrong = np.count_nonzero(time % 4 != bank)
+            if nwrong > 0:
+                print 'ERROR: Receiving both odd and even banks! (%d packets)' % nwrong
+                err_count += nwrong
 
         if args.errors or args.ordererrors:
             # Check payload matches
-            nbytes = chans_per_pkt
-            for a in range(3):
-                for p in range(pol):
-                    tvg_offset = (a*pol + p)*tot_chans + chan
-                    for t in range(nsamp_per_pkt):
-                        offset = a * pol * chans_per_pkt * nsamp_per_pkt + t*pol + p
-                        if not np.all(data[offset:offset+(pol*nsamp_per_pkt*nbytes):pol*nsamp_per_pkt] == tvg[tvg_offset:tvg_offset+nbytes]):
-                            print 'ERROR: Header and packet contents do not match! (Ant %d (pkt ant %d), Pol: %d, Sample %d, Chan %d)' % (ant, a, p, t, chan)
-                            print 'Expected:', tvg[tvg_offset:tvg_offset+nbytes]
-                            print 'Received:', data[offset:offset+(pol*nsamp_per_pkt*nbytes):pol*nsamp_per_pkt]
-                            err_count += 1
+            for i in np.where(~tvg.check(pkts))[0]:
+                match = (payload_view(pkts[i:i+1]) == tvg.expected(chan[i:i+1]))[0]
+                for a, c, t, p in zip(*np.where(~match)):
+                    print 'ERROR: Header and packet contents do not match! (Ant %d (pkt ant %d), Pol: %d, Sample %d, Chan %d)' % (ant[i], a, p, t, chan[i]+c)
+                    err_count += 1
+                    break
 
         if args.errors or args.chanerrors:
-            # Check that you have atmost 16 unique chans
-            nchans = len(np.where(chan_counter != 0)[0])
+            # Check that you have atmost 384 unique chans
+            nchans = np.count_nonzero(chan_counter)
             if nchans > 384:
-                err_count += 1
-        #for d in data:
-        #    data_chan_counter[d] += 1
-        n += 1
+                err_count += len(pkts)
+        n += len(pkts)
 
     except KeyboardInterrupt:
         break
@@ -179,16 +171,10 @@ if args.stats:
         print 'ANT %3d: %d' % (3*xn, x)
     print 'Packet count by channel: from headers (from data)'
     for xn, x in enumerate(chan_counter[0::chans_per_pkt]):
-        #a0 = data_chan_counter[xn]
-        #a1 = data_chan_counter[xn+2048]
-        #a2 = data_chan_counter[xn+4096]
-        #tot = a0+a1+a2
         print 'CHAN %4d-%4d: %d '%(xn*chans_per_pkt, (xn+1)*chans_per_pkt-1, x)
-        #(ANT0:%d, ANT1:%d, ANT2:%d TOTAL:%d)' % (xn, x, a0, a1, a2, tot)
 
 print '#######################'
 print 'Grabbed %d packets' % n
+print 'Size errors: %d' % cap.nbad
 print 'Errors: %d' % err_count
 print '#######################'
-
-    
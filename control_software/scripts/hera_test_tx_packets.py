@@ -0,0 +1,38 @@
+import argparse
+import logging
+from hera_corr_f.packet_capture import PACKET_BYTES, TVG_MODES
+from hera_corr_f.packet_generator import PacketGenerator
+
+parser = argparse.ArgumentParser(description='Send the packets F-engines in EQ TVG mode '\
+                                 'would send, according to the config file, without any '\
+                                 'hardware. Use with hera_test_rx_packets.py.',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('config_file', type=str,
+                    help = 'YAML configuration file with fengines and xengines')
+parser.add_argument('-i', dest='ip', type=str, default=None,
+                    help = 'Send all packets to this IP, rather than the X-engines '\
+                           'in the config (eg. 127.0.0.1 for loopback tests)')
+parser.add_argument('-p', dest='ports', type=int, nargs=2, default=[8511, 8511],
+                    help = 'Ports to send even and odd bank packets to, with -i')
+parser.add_argument('-m',dest='mode', type=str, default='ramp_pols', choices=TVG_MODES,
+                    help='The test vector mode to emulate.')
+parser.add_argument('-r', dest='rate', type=float, default=None,
+                    help = 'Packets per second to send. Default: as fast as possible')
+parser.add_argument('-n', dest='npkts', type=int, default=None,
+                    help = 'Number of packets to send. Default: until interrupted')
+parser.add_argument('-t', dest='duration', type=float, default=None,
+                    help = 'Seconds to send for. Default: until interrupted')
+parser.add_argument('--hosts', dest='hosts', type=str, nargs='+', default=None,
+                    help = 'F-engines to emulate. Default: all in the config')
+args = parser.parse_args()
+
+dest = None if args.ip is None else (args.ip, args.ports[0], args.ports[1])
+gen = PacketGenerator(args.config_file, tvg_mode=args.mode, dest=dest, rate=args.rate, hosts=args.hosts)
+print 'Emulating %d F-engines, sending %d packets per time step' % (len(gen.hosts), len(gen.template))
+npkts, elapsed = gen.send(npkts=args.npkts, duration=args.duration)
+gen.close()
+
+print '#######################'
+print 'Sent %d packets in %.2f seconds' % (npkts, elapsed)
+print 'Rate: %.1f packets/s (%.3f Gb/s)' % (npkts / elapsed, npkts * PACKET_BYTES * 8 / elapsed / 1e9)
+print '#######################'
@@ -0,0 +1,372 @@
+"""
+Benchmarks of the control software's board-wide operations, run against
+simulated SNAP boards (see snap_sim), which count every register
+transaction, and the bytes it moves, and model the time it would take
+over TAPCP.
+
+`ControlBenchmark` runs the operations in OPERATIONS, in order, on an
+array of simulated boards, and returns a report, a dictionary which can
+be saved as JSON, of their per-board costs. A report can be checked
+against fixed limits (`check_thresholds`) or against an earlier report
+(`compare_to_baseline`), so that changes to the cost of talking to the
+boards are caught. See hera_snap_benchmark.py.
+"""
+import os
+import json
+import time
+import tempfile
+import threading
+import logging
+import yaml
+import helpers
+import monitor
+from hera_corr import HeraCorrelator
+from snap_sim import SimulatedSnap, TapcpModel
+
+logger = helpers.add_default_log_handlers(logging.getLogger(__name__))
+
+REPORT_VERSION = 1
+# Metrics of an operation which don't depend on the speed of the machine
+# the benchmark runs on, and are compared to a baseline by default.
+DETERMINISTIC_METRICS = ['transactions', 'reads', 'writes', 'bytes_read', 'bytes_written',
+                         'modeled_time', 'redis_round_trips']
+
+def _counted(func):
+    def command(self, *args, **kwargs):
+        self._count(1)
+        return func(self, *args, **kwargs)
+    command.__name__ = func.__name__
+    command.uncounted = func
+    return command
+
+class CountingRedis(object):
+    """
+    An in-memory stand-in for the parts of a redis.Redis connection the
+    control software uses, which counts the commands it is sent, and the
+    round trips they would take (one per command, or one per pipeline).
+    """
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.commands = 0
+        self.round_trips = 0
+
+    def _count(self, ncommands, round_trips=1):
+        with self.lock:
+            self.commands += ncommands
+            self.round_trips += round_trips
+
+    @_counted
+    def get(self, key):
+        return self.data.get(key)
+
+    @_counted
+    def set(self, key, value, ex=None, **kwargs):
+        self.data[key] = str(value)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    @_counted
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    @_counted
+    def exists(self, key):
+        return key in self.data
+
+    @_counted
+    def expire(self, key, seconds):
+        return key in self.data
+
+    @_counted
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    @_counted
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = str(value)
+
+    @_counted
+    def hmset(self, key, mapping):
+        self.data.setdefault(key, {}).update([(field, str(value)) for field, value in mapping.items()])
+
+    @_counted
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    @_counted
+    def publish(self, channel, message):
+        return 0
+
+    def pipeline(self, transaction=True):
+        return CountingPipeline(self)
+
+class CountingPipeline(object):
+    """
+    A pipeline of a CountingRedis, which costs one round trip to execute.
+    """
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(type(self.redis), name)
+        command = getattr(command, 'uncounted', command)
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        self.redis._count(len(commands))
+        return [command(self.redis, *args, **kwargs) for command, args, kwargs in commands]
+
+def make_config(nboards, nxengs=16, chans_per_xeng=384):
+    """
+    Make an array configuration, as HeraCorrelator reads, of `nboards`
+    boards, with 3 antennas each, sending to `nxengs` X-engines.
+    Boards are named by IP address, so that they resolve without DNS.
+    returns: configuration dictionary
+    """
+    config = {
+        'fpgfile' : 'simulated.fpg',
+        'dest_port' : 8511,
+        'n_xengs' : nxengs,
+        'fengines' : {},
+        'xengines' : {},
+    }
+    for i in range(nboards):
+        host = '10.1.%d.%d' % (i // 250, i % 250 + 1)
+        config['fengines'][host] = {'ants' : [3*i, 3*i + 1, 3*i + 2]}
+    for xn in range(nxengs):
+        config['xengines'][xn] = {
+            'even' : {'ip' : '10.80.40.%d' % (2*xn + 1), 'mac' : 0x02020a502801 + 2*xn},
+            'odd' : {'ip' : '10.80.40.%d' % (2*xn + 2), 'mac' : 0x02020a502802 + 2*xn},
+            'chan_range' : [xn * chans_per_xeng, (xn + 1) * chans_per_xeng],
+        }
+    return config
+
+def make_hookup(config):
+    """
+    Make the antenna hookup of configuration `config`, as stored in redis
+    under 'corr:map', with antenna n's e and n polarizations on inputs
+    2n and 2n+1 of its board.
+    returns: dictionary of redis hash fields
+    """
+    ant_to_snap = {}
+    snap_to_ant = {}
+    for host, params in config['fengines'].items():
+        snap_to_ant[host] = []
+        for i, ant in enumerate(params['ants']):
+            ant_to_snap[str(ant)] = {'e' : {'host' : host, 'channel' : 2*i},
+                                     'n' : {'host' : host, 'channel' : 2*i + 1}}
+            snap_to_ant[host] += ['%de' % ant, '%dn' % ant]
+    return {
+        'update_time' : time.time(),
+        'ant_to_snap' : json.dumps(ant_to_snap),
+        'snap_to_ant' : json.dumps(snap_to_ant),
+    }
+
+def _initialize(corr):
+    return corr.do_for_all_fengs(lambda feng: feng.initialize())[1]
+
+def _configure_freq_slots(corr):
+    if not corr.configure_freq_slots():
+        return {'config' : 'Invalid configuration'}
+
+def _apply_config(corr):
+    if corr.apply_config() is None:
+        return {'config' : 'Invalid configuration'}
+
+def _resync(corr):
+    corr.resync(manual=True)
+
+def _phase_switch_enable(corr):
+    corr.phase_switch_enable()
+
+def _monitor_loop(corr):
+    # As one loop of hera_snap_redis_monitor.py
+    corr.compute_hookup()
+    status, errors = monitor.poll_boards(corr, monitor.get_board_inputs(corr))
+    monitor.upload_status(corr.r, status)
+    return errors
+
+# (name, function of a HeraCorrelator, returning a dictionary of
+# {hostname: exception} for boards which failed, or None), in the
+# order they are run, which is the order a correlator is brought up in.
+OPERATIONS = [
+    ('initialize', _initialize),
+    ('configure_freq_slots', _configure_freq_slots),
+    ('apply_config', _apply_config),
+    ('resync', _resync),
+    ('phase_switch_enable', _phase_switch_enable),
+    ('monitor_loop', _monitor_loop),
+]
+
+class ControlBenchmark(object):
+    """
+    An array of `nboards` simulated boards, and a HeraCorrelator
+    controlling them, to run benchmarks on.
+
+    model: TapcpModel charged for every transaction. Default: TapcpModel()
+    sleep: If True, boards wait the modeled time of every transaction,
+           so wall times are as they would be on hardware.
+    nthreads: Maximum number of boards to talk to concurrently.
+    shadow: Keep software copies of control registers, as the short-lived
+            scripts which run the operations benchmarked do.
+    """
+    def __init__(self, nboards=10, model=None, sleep=False, nthreads=16, shadow=True):
+        self.nboards = nboards
+        self.model = model or TapcpModel()
+        self.sleep = sleep
+        self.config = make_config(nboards)
+        self.redis = CountingRedis()
+        self.redis.hmset('corr:map', make_hookup(self.config))
+        self.snaps = {}
+        fd, path = tempfile.mkstemp(suffix='.yaml')
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                yaml.safe_dump(self.config, fh)
+            self.corr = HeraCorrelator(config=path, passive=True, nthreads=nthreads,
+                                       fpga_factory=self._make_snap, shadow=shadow)
+        finally:
+            os.remove(path)
+        self.corr.r = self.redis
+        self.corr.establish_connections()
+        self.corr.compute_hookup()
+
+    def _make_snap(self, host):
+        self.snaps[host] = SimulatedSnap(host, model=self.model, sleep=self.sleep)
+        return self.snaps[host]
+
+    def measure(self, func):
+        """
+        Call `func(corr)`, counting what it costs.
+        returns: dictionary of metrics
+                 The register transaction counts, bytes and modeled TAPCP
+                 time are per board, the mean over boards, except for
+                 modeled_time, which is that of the slowest board (how long
+                 the operation would take if the boards were all talked to at
+                 once), and modeled_time_total, the sum over boards.
+        """
+        for snap in self.snaps.values():
+            snap.reset_stats()
+        self.redis.reset_stats()
+        t0 = time.time()
+        errors = func(self.corr) or {}
+        wall_time = time.time() - t0
+        stats = [snap.stats for snap in self.snaps.values()]
+        nboards = float(max(len(stats), 1))
+        metrics = {
+            'wall_time' : wall_time,
+            'modeled_time' : max([s['modeled_time'] for s in stats] or [0.]),
+            'modeled_time_total' : sum([s['modeled_time'] for s in stats]),
+            'redis_commands' : self.redis.commands,
+            'redis_round_trips' : self.redis.round_trips,
+            'errors' : len(errors),
+        }
+        for key in ['reads', 'writes', 'bytes_read', 'bytes_written']:
+            metrics[key] = sum([s[key] for s in stats]) / nboards
+        metrics['transactions'] = metrics['reads'] + metrics['writes']
+        for host, err in errors.items():
+            logger.error('%s: %s' % (host, err))
+        return metrics
+
+    def run(self, operations=None):
+        """
+        Run the operations named `operations` (default: all of them),
+        in the order of OPERATIONS.
+        returns: report dictionary
+        """
+        names = [name for name, func in OPERATIONS]
+        if operations is not None:
+            for name in operations:
+                if name not in names:
+                    raise ValueError('Unknown operation %s. Choose from: %s' % (name, ', '.join(names)))
+        report = {
+            'version' : REPORT_VERSION,
+            'timestamp' : time.time(),
+            'nboards' : self.nboards,
+            'model' : dict(self.model.__dict__),
+            'sleep' : self.sleep,
+            'sequence' : [],
+            'operations' : {},
+        }
+        for name, func in OPERATIONS:
+            if operations is not None and name not in operations:
+                continue
+            logger.info('Running %s on %d boards' % (name, self.nboards))
+            report['operations'][name] = self.measure(func)
+            report['sequence'] += [name]
+        unknown = sorted(set([reg for snap in self.snaps.values() for reg in snap.unknown]))
+        if len(unknown) > 0:
+            logger.warning('Registers not in the simulated memory map were used: %s' % ', '.join(unknown))
+        return report
+
+def check_thresholds(report, thresholds):
+    """
+    Check the metrics in benchmark report `report` against limits.
+    thresholds: dictionary of {operation name: {metric: maximum value}}
+    returns: list of descriptions of the limits exceeded
+    """
+    failures = []
+    for name, limits in sorted(thresholds.items()):
+        metrics = report['operations'].get(name)
+        if metrics is None:
+            continue
+        for metric, limit in sorted(limits.items()):
+            if metrics[metric] > limit:
+                failures += ['%s %s is %g, above the limit of %g' % (name, metric, metrics[metric], limit)]
+    return failures
+
+def compare_to_baseline(report, baseline, tolerance=0.05, metrics=DETERMINISTIC_METRICS):
+    """
+    Compare the metrics in benchmark report `report` to those of an
+    earlier report, `baseline`, of the same number of boards. Operations
+    build on the state the ones before them leave the boards in, so only
+    those run after the same operations as in the baseline are compared.
+    tolerance: Fraction by which a metric can exceed its baseline value.
+    metrics: Names of the metrics to compare.
+    returns: list of descriptions of the metrics which regressed
+    """
+    if report['nboards'] != baseline['nboards']:
+        raise ValueError('Cannot compare a benchmark of %d boards to a baseline of %d'
+                         % (report['nboards'], baseline['nboards']))
+    regressions = []
+    for i, name in enumerate(baseline['sequence']):
+        if report['sequence'][:i + 1] != baseline['sequence'][:i + 1]:
+            if name in report['operations']:
+                logger.warning('Not comparing %s, which was run after different operations than in the baseline' % name)
+            continue
+        base, current = baseline['operations'][name], report['operations'][name]
+        for metric in metrics:
+            if metric not in base:
+                continue
+            if current[metric] > base[metric] * (1 + tolerance) + 1e-9:
+                regressions += ['%s %s is %g, up from %g' % (name, metric, current[metric], base[metric])]
+            elif current[metric] < base[metric] * (1 - tolerance) - 1e-9:
+                logger.info('%s %s is %g, down from %g' % (name, metric, current[metric], base[metric]))
+    return regressions
+
+def save_report(report, path):
+    with open(path, 'w') as fh:
+        json.dump(report, fh, indent=2, sort_keys=True)
+
+def load_report(path):
+    """
+    Read a benchmark report, or thresholds, saved as JSON.
+    """
+    with open(path, 'r') as fh:
+        return json.load(fh)
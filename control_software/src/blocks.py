@@ -6,14 +6,13 @@ import time
 import casperfpga
 import casperfpga.snapadc
 import helpers
-from casperfpga import i2c
-from casperfpga import i2c_gpio
-from casperfpga import i2c_volt
-from casperfpga import i2c_eeprom
-from casperfpga import i2c_sn
-from casperfpga import i2c_bar
-from casperfpga import i2c_motion
-from scipy.linalg import hadamard #for walsh (hadamard) matrices
+from instrument import instrumented
+
+# ADC histogram bin values, as returned by Input.get_histogram
+ADC_HIST_BINS = np.arange(-128, 128)
+# Stats of one ADC input, as captured by Input.get_snapshot
+ADC_SNAPSHOT_DTYPE = np.dtype([('time', '<f8'), ('mean', '<f4'), ('power', '<f4'),
+                               ('rms', '<f4'), ('histogram', '<u4', (len(ADC_HIST_BINS),))])
 
 # Block Classes
 class Block(object):
@@ -25,6 +24,15 @@ class Block(object):
             self.prefix = ''
         else:
             self.prefix = name + '_'
+        # Control registers which only software writes. Software
+        # copies of them are only kept once `enable_shadow` is called
+        self.shadow_regs = []
+        # Software copies of control registers which only software writes.
+        # {register name: last written value, or None if unknown}
+        self._shadow = {}
+        # Copies of memory contents last written with `write_image`.
+        # {register name: (byte offset, data string)}
+        self._images = {}
     
     def print_status(self):
         """
@@ -47,33 +55,240 @@ class Block(object):
         devs = self.host.listdev()
         return [x[len(self.prefix):] for x in devs if x.startswith(self.prefix)]
 
+    @instrumented('read')
     def read_int(self, reg, word_offset=0, **kwargs):
         return self.host.read_int(self.prefix + reg, word_offset=word_offset, **kwargs)
 
+    @instrumented('write')
     def write_int(self, reg, val, word_offset=0, **kwargs):
+        self._forget(reg, 4, 4*word_offset)
         self.host.write_int(self.prefix + reg, val, word_offset=word_offset, **kwargs)
+        self._update_shadow(reg, val, word_offset)
 
+    @instrumented('read')
     def read_uint(self, reg, word_offset=0, **kwargs):
         return self.host.read_uint(self.prefix + reg, word_offset=word_offset, **kwargs)
 
+    @instrumented('write')
     def write_uint(self, reg, val, word_offset=0, **kwargs):
+        self._forget(reg, 4, 4*word_offset)
         self.host.write_int(self.prefix + reg, val, word_offset=word_offset, **kwargs)
+        self._update_shadow(reg, val, word_offset)
 
+    @instrumented('read', size=lambda args, rv: len(rv))
     def read(self, reg, nbytes, **kwargs):
         return self.host.read(self.prefix + reg, nbytes, **kwargs)
 
+    @instrumented('write', size=lambda args, rv: len(args[0]))
     def write(self, reg, val, offset=0, **kwargs):
+        # Forget first, as a failed write may have changed some of the memory
+        self._forget(reg, len(val), offset)
         self.host.write(self.prefix + reg, val, offset=offset, **kwargs)
 
-    def blindwrite(self, reg, val, **kwargs):
-        self.host.blindwrite(self.prefix + reg, val, **kwargs)
+    @instrumented('write', size=lambda args, rv: len(args[0]))
+    def blindwrite(self, reg, val, offset=0, **kwargs):
+        self._forget(reg, len(val), offset)
+        self.host.blindwrite(self.prefix + reg, val, offset=offset, **kwargs)
+
+    def _forget(self, reg, nbytes, offset):
+        # Drop the copies of `reg` which a write of `nbytes` at byte `offset` may have changed
+        if reg in self._shadow:
+            self._shadow[reg] = None
+        cached_offset, data = self._images.get(reg, (None, None))
+        if data is not None and offset < cached_offset + len(data) and offset + nbytes > cached_offset:
+            del self._images[reg]
+
+    def read_image(self, reg, nbytes, offset=0):
+        """
+        Read `nbytes` of memory `reg`, starting at byte `offset`, from the
+        copy kept by `write_image` if there is one, and otherwise from the
+        hardware, keeping what was read for the next call to `write_image`.
+        returns: string
+        """
+        cached_offset, data = self._images.get(reg, (None, None))
+        if cached_offset != offset or data is None or len(data) != nbytes:
+            data = self.read(reg, nbytes, offset=offset)
+            self._images[reg] = (offset, data)
+        return data
+
+    def cached_image(self, reg, offset=0):
+        """
+        returns: the copy of memory `reg`, starting at byte `offset`, kept
+                 by `read_image` or `write_image`, or None if there isn't one
+        """
+        cached_offset, data = self._images.get(reg, (None, None))
+        return data if cached_offset == offset else None
+
+    def write_image(self, reg, data, offset=0, max_gap=64, dry_run=False):
+        """
+        Make the contents of memory `reg`, starting at byte `offset`,
+        equal to the string `data`, writing only the regions which differ.
+        The current contents are taken from the copy kept by the last call
+        to this method, if there is one, and otherwise read from the hardware.
+        max_gap: Maximum number of unchanged bytes between two changed
+                 regions before they are written separately.
+        dry_run: If True, work out what would be written, but don't write it.
+        returns: list of (byte offset, nbytes) regions written
+        """
+        cached_offset, current = self._images.get(reg, (None, None))
+        if cached_offset != offset or current is None or len(current) != len(data):
+            current = self.read(reg, len(data), offset=offset)
+        new = np.fromstring(data, dtype=np.uint8)
+        changed = np.nonzero(new != np.fromstring(current, dtype=np.uint8))[0]
+        regions = []
+        # Transactions are in 32-bit words, so align regions to them
+        for start in np.unique(changed - (changed % 4)):
+            if len(regions) > 0 and start - (regions[-1][0] + regions[-1][1]) <= max_gap:
+                regions[-1][1] = start + 4 - regions[-1][0]
+            else:
+                regions += [[start, 4]]
+        regions = [(start, min(nbytes, len(data) - start)) for start, nbytes in regions]
+        if dry_run:
+            return regions
+        for start, nbytes in regions:
+            self._write_region(reg, data[start:start+nbytes], offset + start)
+        self._images[reg] = (offset, data)
+        return regions
+
+    @instrumented('write', size=lambda args, rv: len(args[0]))
+    def _write_region(self, reg, data, offset):
+        # Unlike `write`, leaves the copy kept by `write_image` alone
+        self.host.write(self.prefix + reg, data, offset=offset)
+
+    def enable_shadow(self, *regs):
+        """
+        Keep a software copy of the registers `regs` (default:
+        `self.shadow_regs`), so that bit-field updates with
+        `change_reg_bits` don't need to read the register first.
+        Only use this for control registers which are never changed by
+        the firmware, and in processes which are short-lived enough
+        that no other software will change them meanwhile.
+        Copies start off unknown, and are filled by the first
+        write, or by `resync_shadow`.
+        """
+        for reg in regs or self.shadow_regs:
+            self._shadow.setdefault(reg, None)
+
+    def invalidate_shadow(self):
+        """
+        Forget the software copies of all shadowed registers, and
+        of memories written with `write_image`, eg. because the FPGA
+        has been reprogrammed.
+        """
+        for reg in self._shadow.keys():
+            self._shadow[reg] = None
+        self._images = {}
+
+    def resync_shadow(self):
+        """
+        Refresh the software copies of all shadowed registers
+        from the hardware.
+        """
+        if len(self._shadow) > 0:
+            self._shadow.update(self.read_uints(self._shadow.keys()))
+
+    def _update_shadow(self, reg, val, word_offset):
+        if word_offset == 0 and reg in self._shadow:
+            self._shadow[reg] = val & 0xffffffff
+
+    @instrumented('read', size=lambda args, rv: 4 * len(rv))
+    def read_uints(self, regs, **kwargs):
+        """
+        Read many registers using as few transactions as possible.
+        regs: list of register names, or (register name, word offset) tuples
+        returns: dictionary of {entry in regs: unsigned value}
+        See `read_uints` (the module function) for kwargs.
+        """
+        full_regs = []
+        for reg in regs:
+            if isinstance(reg, tuple):
+                full_regs += [(self.prefix + reg[0], reg[1])]
+            else:
+                full_regs += [(self.prefix + reg, 0)]
+        return dict(zip(regs, read_uints(self.host, full_regs, **kwargs)))
 
     def change_reg_bits(self, reg, val, start, width=1):
-        orig_val = self.read_uint(reg)
+        orig_val = self._shadow.get(reg)
+        if orig_val is None:
+            orig_val = self.read_uint(reg)
         masked   = orig_val & (0xffffffff - ((2**width - 1) << start))
         new_val  = masked + (val << start)
         self.write_int(reg, new_val)
 
+def plan_reads(devices, regs, max_gap=256):
+    """
+    Group 32-bit register reads into as few contiguous reads
+    of the FPGA memory map as possible.
+    devices: dictionary of {device name: (address, length in bytes)}
+             describing the memory map.
+    regs: list of (device name, word offset) tuples to be read.
+    max_gap: Maximum number of unwanted bytes to read between two
+             wanted registers, rather than splitting the read in two.
+    Reads only span addresses which belong to some device in the
+    memory map, so they never touch unmapped bus space.
+    returns: list of (device name, byte offset, nbytes, [(reg index, byte offset in read)])
+             where the first three entries are the arguments to pass to
+             the FPGA's `read` method, and reg index is the position
+             of the register in `regs`.
+    """
+    # Merge the memory map into contiguous mapped address ranges
+    mapped = []
+    for addr, length in sorted(devices.values()):
+        if len(mapped) > 0 and addr <= mapped[-1][1]:
+            mapped[-1][1] = max(mapped[-1][1], addr + length)
+        else:
+            mapped += [[addr, addr + length]]
+
+    def same_range(start, end):
+        for lo, hi in mapped:
+            if lo <= start and end <= hi:
+                return True
+        return False
+
+    plan = []
+    unmapped = []
+    wanted = []
+    for rn, (name, word_offset) in enumerate(regs):
+        if name in devices:
+            wanted += [(devices[name][0] + 4*word_offset, rn, name, word_offset)]
+        else:
+            unmapped += [(name, 4*word_offset, 4, [(rn, 0)])]
+    wanted.sort()
+    run_start = None
+    for addr, rn, name, word_offset in wanted:
+        if run_start is not None and addr - run_end <= max_gap and same_range(run_start, addr + 4):
+            plan[-1][2] = max(plan[-1][2], addr + 4 - run_start)
+            plan[-1][3] += [(rn, addr - run_start)]
+            run_end = max(run_end, addr + 4)
+        else:
+            run_start = addr
+            run_end = addr + 4
+            plan += [[name, 4*word_offset, 4, [(rn, 0)]]]
+    return [tuple(p) for p in plan] + unmapped
+
+def read_uints(fpga, regs, max_gap=256):
+    """
+    Read many 32-bit registers from a CasperFpga using as few
+    transactions as possible. Registers which are close together
+    in the FPGA's memory map are fetched with a single read.
+    regs: list of (device name, word offset) tuples
+    max_gap: see `plan_reads`
+    returns: list of unsigned register values, in the order of `regs`
+    """
+    devices = {}
+    for name, dev in fpga.memory_devices.items():
+        try:
+            devices[name] = (dev.address, dev.length_bytes)
+        except AttributeError:
+            # Not everything in the memory map has an address (eg. the ADC)
+            continue
+    vals = [None] * len(regs)
+    for name, offset, nbytes, contents in plan_reads(devices, regs, max_gap=max_gap):
+        raw = fpga.read(name, nbytes, offset=offset)
+        for rn, pos in contents:
+            vals[rn] = struct.unpack('>L', raw[pos:pos+4])[0]
+    return vals
+
 class Synth(casperfpga.synth.LMX2581):
     def __init__(self, host, name):
          super(Synth, self).__init__(host, name)
@@ -139,6 +354,7 @@ class Sync(Block):
         self.OFFSET_ARM_SYNC  = 0
         self.OFFSET_ARM_NOISE = 1
         self.OFFSET_SW_SYNC   = 4
+        self.shadow_regs = ['arm']
     
     def uptime(self):
         """
@@ -173,6 +389,19 @@ class Sync(Block):
         while(self.count() == c):
             time.sleep(0.05)
 
+    def get_arm_words(self, offset):
+        """
+        Compute the values of the arm register needed to pulse bit `offset`,
+        so that the pulse can later be issued without reading the register.
+        returns: low, high
+                 The register value with the bit cleared, and set.
+        """
+        orig_val = self._shadow.get('arm')
+        if orig_val is None:
+            orig_val = self.read_uint('arm')
+        low = orig_val & (0xffffffff - (1 << offset))
+        return low, low + (1 << offset)
+
     def arm_sync(self):
         """
         Arm sync pulse generator.
@@ -198,9 +427,10 @@ class Sync(Block):
         self.change_reg_bits('arm', 0, self.OFFSET_SW_SYNC)
 
     def print_status(self):
-        print 'Sync block: %s: Uptime: %d seconds' % (self.name, self.uptime())
-        print 'Sync block: %s: Period: %d FPGA clocks' % (self.name, self.period())
-        print 'Sync block: %s: Count : %d' % (self.name, self.count())
+        stat = self.read_uints(['uptime', 'period', 'count'])
+        print 'Sync block: %s: Uptime: %d seconds' % (self.name, stat['uptime'])
+        print 'Sync block: %s: Period: %d FPGA clocks' % (self.name, stat['period'])
+        print 'Sync block: %s: Count : %d' % (self.name, stat['count'])
 
     def initialize(self):
         self.write_int('arm', 0)
@@ -211,6 +441,7 @@ class NoiseGen(Block):
     def __init__(self, host, name, nstreams=6):
         super(NoiseGen, self).__init__(host, name)
         self.nstreams = nstreams
+        self.shadow_regs = ['seed_%d' % i for i in range((nstreams + 3) // 4)]
 
     def set_seed(self, stream, seed):
         """
@@ -281,15 +512,11 @@ class Input(Block):
         else:
             raise NotImplementedError('Different input selects not supported yet!')
 
-    def get_stats(self, sum_cores=False):
+    def _read_stats(self, sum_cores=False):
         """
-        Get the mean, RMS, and powers of
-        all 12 ADC cores.
-        returns: means, powers, rmss
+        Read the stats latched by the last 1 -> 0 transition
+        of rms_enable, and start accumulating again.
         """
-        self.write_int('rms_enable', 1)
-        time.sleep(0.01)
-        self.write_int('rms_enable', 0)
         x = np.array(struct.unpack('>%dl' % (2*self.nstreams), self.read('rms_levels', self.nstreams * 8)))
         self.write_int('rms_enable', 1)
         means    = x[0::2] / 2.**16
@@ -301,6 +528,17 @@ class Input(Block):
             rmss = np.sqrt(powers)
         return means, powers, rmss
 
+    def get_stats(self, sum_cores=False):
+        """
+        Get the mean, RMS, and powers of
+        all 12 ADC cores.
+        returns: means, powers, rmss
+        """
+        self.write_int('rms_enable', 1)
+        time.sleep(0.01)
+        self.write_int('rms_enable', 0)
+        return self._read_stats(sum_cores=sum_cores)
+
     def initialize(self):
         self.use_adc()
         self.write_int('rms_enable', 1)
@@ -320,15 +558,19 @@ class Input(Block):
     def set_input(self, i):
         self.write_int('bit_stats_input_sel', i)
 
-    def get_histogram(self, input, sum_cores=True):
-        self.set_input(input)
-        time.sleep(0.1)
+    def _read_histogram(self):
         v = np.array(struct.unpack('>512H', self.read('bit_stats_histogram_output', 512*2)))
         a = v[0:256]
         b = v[256:512]
         a = np.roll(a, 128) # roll so that array counts -128, -127, ..., 0, ..., 126, 127
         b = np.roll(b, 128) # roll so that array counts -128, -127, ..., 0, ..., 126, 127
-        vals = np.arange(-128,128)
+        return a, b
+
+    def get_histogram(self, input, sum_cores=True):
+        self.set_input(input)
+        time.sleep(0.1)
+        a, b = self._read_histogram()
+        vals = ADC_HIST_BINS.copy()
         if sum_cores:
             return vals, a+b
         else:
@@ -340,25 +582,72 @@ class Input(Block):
         return vals, a+b
 
     def get_all_histograms(self):
-        out = np.zeros([self.nstreams, 256])
-        for stream in range(self.nstreams/4):
-            x, out[stream,:] = self.get_input_histogram(stream)
-        return x, out
-
-    def print_histograms(self):
-        x, hist = self.get_all_histograms()
-        hist /= 1024.*1024
-        for vn, v in enumerate(x):
+        """
+        returns: bins, (ninputs, 256) array of histograms of all inputs
+        """
+        snapshot = self.get_snapshot()
+        return ADC_HIST_BINS.copy(), snapshot['histogram'].astype(np.float)
+
+    def snapshot_steps(self, snapshot):
+        """
+        The steps of `get_snapshot`, as a generator which fills in the
+        record array `snapshot` (see ADC_SNAPSHOT_DTYPE), and yields the
+        number of seconds to wait before each following step. This lets
+        many boards be stepped through their inputs together, sharing
+        the waits for the histograms to fill.
+        """
+        # Start the stats accumulating along with the first histogram,
+        # which takes longer
+        self.write_int('rms_enable', 1)
+        for i in range(self.nstreams // 2):
+            self.set_input(i)
+            yield 0.1
+            if i == 0:
+                self.write_int('rms_enable', 0)
+                means, powers, rmss = self._read_stats(sum_cores=True)
+                snapshot['mean'] = means
+                snapshot['power'] = powers
+                snapshot['rms'] = rmss
+            a, b = self._read_histogram()
+            snapshot['histogram'][i] = a + b
+            snapshot['time'][i] = time.time()
+
+    def get_snapshot(self):
+        """
+        Capture the mean, power and RMS (summed over cores) and
+        histogram of every input in one pass.
+        returns: record array, with one ADC_SNAPSHOT_DTYPE record per input
+        """
+        snapshot = np.zeros(self.nstreams // 2, dtype=ADC_SNAPSHOT_DTYPE)
+        for wait in self.snapshot_steps(snapshot):
+            time.sleep(wait)
+        return snapshot
+
+    def print_histograms(self, snapshot=None):
+        """
+        Print the histograms of all inputs, as fractions of the samples.
+        snapshot: Output of get_snapshot to print. Default: take a new one.
+        """
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        hist = snapshot['histogram'] / (1024.*1024)
+        for vn, v in enumerate(ADC_HIST_BINS):
             print '%5d:'%v,
             for an, ant in enumerate(hist):
                 print '%.3f'%ant[vn],
             print ''
 
-    def plot_histogram(self, input, show=False):
+    def plot_histogram(self, input, show=False, snapshot=None):
+        """
+        Plot the histogram of input `input`.
+        snapshot: Output of get_snapshot to plot from. Default: take a new one.
+        """
         from matplotlib import pyplot as plt
-        bins, d = self.get_input_histogram(input)
+        if snapshot is None:
+            snapshot = self.get_snapshot()
+        d = snapshot['histogram'][input]
         #plt.hist(d, bins=bins)
-        plt.bar(bins-0.5, d, width=1)
+        plt.bar(ADC_HIST_BINS-0.5, d, width=1)
         if show:
             plt.show()
 
@@ -398,6 +687,7 @@ class Pfb(Block):
         self.PRESHIFT_OFFSET = 12
         self.PRESHIFT_WIDTH  = 2
         self.STAT_RST_BIT = 14
+        self.shadow_regs = ['ctrl']
 
     def set_fft_shift(self, shift):
         self.change_reg_bits('ctrl', shift, self.SHIFT_OFFSET, self.SHIFT_WIDTH)
@@ -424,6 +714,78 @@ class PhaseSwitch(Block):
         self.depth = depth           # number of brams steps in a period
         self.periodbase = periodbase # number of clock cycles in one bram step
 
+    def walsh_patterns(self, params):
+        """
+        Compute the BRAM contents (one bit per BRAM address) of several
+        walsh functions at once. See `set_walsh` for arguments.
+        params: list of (N, n, stepperiod) tuples
+        returns: numpy uint8 array of 0s and 1s, shape (len(params), self.depth)
+        """
+        N, n, stepperiod = np.array(params, dtype=np.int64).reshape(-1, 3).T
+        N_round = (2**np.ceil(np.log2(N))).astype(np.int64)
+        # The counter in the FPGA cycles through <depth> ram addresses, so the
+        # sequence repeats. Since N_round and 2**stepperiod are always powers
+        # of 2, this is always an integer number of cycles, if any fit
+        if np.any(N_round << stepperiod > self.depth):
+            raise ValueError('Walsh functions %s are longer than the %d entry BRAM' % (params, self.depth))
+        step = (np.arange(self.depth)[None, :] >> stepperiod[:, None]) % N_round[:, None]
+        # Row n of the (Sylvester) hadamard matrix is -1 where n & step has odd
+        # parity, which is where we want a 1 (multiply by -1)
+        bits = n[:, None] & step
+        walsh = np.zeros(bits.shape, dtype=np.uint8)
+        while np.any(bits):
+            walsh ^= (bits & 1).astype(np.uint8)
+            bits >>= 1
+        return walsh
+
+    def walsh_vec(self, N, n, stepperiod):
+        """
+        Compute the BRAM contents (one bit per BRAM address) for walsh
+        function `n` of order `N`. See `set_walsh` for arguments.
+        returns: numpy array of length self.depth
+        """
+        return self.walsh_patterns([(N, n, stepperiod)])[0].astype(np.int)
+
+    def walsh_images(self, params, mod_image, demod_image, demodulate=True):
+        """
+        Compute the contents of the modulation and demodulation BRAMs
+        with several streams' walsh functions set.
+        params: list of (N, n, stepperiod) tuples, one per stream, or a
+                dictionary of {stream: (N, n, stepperiod)} to set only some
+                streams. See `set_walsh` for their meaning.
+        mod_image, demod_image: current BRAM contents, as strings. Bits
+                not used by the streams being set are kept.
+        returns: mod_image, demod_image as strings
+        """
+        if not isinstance(params, dict):
+            params = dict(enumerate(params))
+        streams = np.array(sorted(params.keys()), dtype=np.uint8)
+        walsh = self.walsh_patterns([params[stream] for stream in streams])
+        # note reverse direction of gpio vs software bit assignments
+        mod_bits = np.uint8(1) << streams
+        demod_bits = np.uint8(1) << (np.uint8(self.nstreams-1) - streams)
+        mod = np.fromstring(mod_image, dtype=np.uint8) & ~np.bitwise_or.reduce(mod_bits)
+        mod |= np.bitwise_or.reduce(walsh << streams[:, None], axis=0)
+        demod = np.fromstring(demod_image, dtype=np.uint8) & ~np.bitwise_or.reduce(demod_bits)
+        if demodulate:
+            demod |= np.bitwise_or.reduce(walsh * demod_bits[:, None], axis=0)
+        return mod.tostring(), demod.tostring()
+
+    def set_walsh_streams(self, params, demodulate=True):
+        """
+        Set the walsh functions of several streams, with one write to each of
+        the modulation and demodulation BRAMs. Their contents are read the
+        first time, and cached after that.
+        params: list of (N, n, stepperiod) tuples, one per stream, or a
+                dictionary of {stream: (N, n, stepperiod)}.
+                See `set_walsh` for their meaning.
+        """
+        mod, demod = self.walsh_images(params, self.read_image('gpio_switch_states', self.depth),
+                                       self.read_image('sw_switch_states', self.depth),
+                                       demodulate=demodulate)
+        self.write_image('gpio_switch_states', mod, max_gap=self.depth)
+        self.write_image('sw_switch_states', demod, max_gap=self.depth)
+
     def set_walsh(self, stream, N, n, stepperiod, demodulate=True):
         """
         N: order of walsh matrix
@@ -433,57 +795,27 @@ class PhaseSwitch(Block):
                 of shortest walsh step. I.e., 2**13 * 2**self.baseperiod * N
                 = period of complete cycle in FPGA clocks.
         """
-        N_round = int(2**(np.ceil(np.log2(N))))
-        walsh_matrix = hadamard(N_round)
-        # reformat so 1 means multiply by -1, and 0 means multiply by 1
-        walsh_matrix[walsh_matrix == 1]  = 0
-        walsh_matrix[walsh_matrix == -1] = 1
-        walsh_func = walsh_matrix[n] # a vector of length N_round
-        
-        walsh_func_stretch = walsh_func.repeat(2**stepperiod) # a vector of length N_round * 2*step_period
+        self.set_walsh_streams({stream : (N, n, stepperiod)}, demodulate=demodulate)
 
-        # The counter in the FPGA cycles through <depth> ram addresses, so repeat
-        # the sequence. Since N_round and 2**stepperiod are always powers of 2,
-        # this is always an integer number of cycles
-        vec = np.array(walsh_func_stretch.tolist() * (self.depth/ 2**stepperiod / N_round), dtype=np.int)
-        
-        #Modify the appropriate bits of the bram
+    def _set_gpio(self, stream, value):
         # note reverse direction of gpio vs software bit assignments
-        curr_bram_vec = np.array(struct.unpack('>%dB' % self.depth, self.read('gpio_switch_states', self.depth)))
-        new_bram_vec  = curr_bram_vec & (0xff - (1 << stream)) # zero the stream we are writing
-        new_bram_vec  = new_bram_vec + (vec << stream)
-        self.write('gpio_switch_states', struct.pack('>%dB' % self.depth, *new_bram_vec))
-        
-        #Modify the appropriate bits of the demodulation bram
-        curr_bram_vec = np.array(struct.unpack('>%dB' % self.depth, self.read('sw_switch_states', self.depth)))
-        new_bram_vec  = curr_bram_vec & (0xff - (1<<((self.nstreams-1)-stream))) # zero the stream we are writing
-        if demodulate:
-            new_bram_vec = new_bram_vec + (vec << ((self.nstreams-1) - stream))
-        self.write('sw_switch_states', struct.pack('>%dB' % self.depth, *new_bram_vec))
+        vec = np.fromstring(self.read_image('gpio_switch_states', self.depth), dtype=np.uint8)
+        vec = vec & np.uint8(0xff - (1 << stream)) # zero the stream we are writing
+        vec |= np.uint8(value << stream)
+        self.write_image('gpio_switch_states', vec.tostring(), max_gap=self.depth)
 
     def set_gpio_high(self, stream):
-        #Modify the appropriate bits of the bram
-        # note reverse direction of gpio vs software bit assignments
-        curr_bram_vec = np.array(struct.unpack('>%dB' % self.depth, self.read('gpio_switch_states', self.depth)))
-        new_bram_vec  = curr_bram_vec & (0xff - (1 << stream)) # zero the stream we are writing
-        new_bram_vec += (np.ones(self.depth, dtype=np.int) << stream)
-        self.write('gpio_switch_states', struct.pack('>%dB' % self.depth, *new_bram_vec))
+        self._set_gpio(stream, 1)
 
     def set_gpio_low(self, stream):
-        #Modify the appropriate bits of the bram
-        # note reverse direction of gpio vs software bit assignments
-        curr_bram_vec = np.array(struct.unpack('>%dB' % self.depth, self.read('gpio_switch_states', self.depth)))
-        new_bram_vec  = curr_bram_vec & (0xff - (1 << stream)) # zero the stream we are writing
-        self.write('gpio_switch_states', struct.pack('>%dB' % self.depth, *new_bram_vec))
+        self._set_gpio(stream, 0)
 
     def get_mod_pattern(self, stream):
-        #Modify the appropriate bits of the bram
-        curr_bram_vec = np.array(struct.unpack('>%dB' % self.depth, self.read('gpio_switch_states', self.depth)))
-        return (curr_bram_vec >> ((self.nstreams-1) - stream)) & 0b1
+        curr_bram_vec = np.frombuffer(self.read('gpio_switch_states', self.depth), dtype=np.uint8)
+        return (curr_bram_vec >> stream) & 0b1
 
     def get_demod_pattern(self, stream):
-        #Modify the appropriate bits of the bram
-        curr_bram_vec = np.array(struct.unpack('>%dB' % self.depth, self.read('sw_switch_states', self.depth)))
+        curr_bram_vec = np.frombuffer(self.read('sw_switch_states', self.depth), dtype=np.uint8)
         return (curr_bram_vec >> ((self.nstreams-1) - stream)) & 0b1
 
     def set_delay(self, delay):
@@ -498,8 +830,7 @@ class PhaseSwitch(Block):
         """
         Initialize, turning off walshing
         """
-        for stream in range(self.nstreams):
-            self.set_walsh(stream, 1, 0, 1)
+        self.set_walsh_streams([(1, 0, 1)] * self.nstreams)
         self.set_delay(0)
         
 class Eq(Block):
@@ -512,21 +843,59 @@ class Eq(Block):
         self.format = 'H'#'L'
         self.streamsize = struct.calcsize(self.format)*self.ncoeffs
 
-    def set_coeffs(self, stream, coeffs):
-        coeffs *= 2**self.bp
-        if np.any(coeffs > (2**self.width - 1)):
+    def quantize(self, coeffs):
+        """
+        Convert the coefficients `coeffs`, an array of any shape,
+        to the fixed point values held by the coeffs BRAM, saturating
+        those which are out of range.
+        returns: uint16 array of the same shape, boolean array which
+                 is True where coefficients were saturated
+        """
+        coeffs = np.asarray(coeffs, dtype=np.float) * 2**self.bp
+        saturated = (coeffs > (2**self.width - 1)) | (coeffs < 0)
+        return np.clip(coeffs, 0, 2**self.width - 1).astype(np.uint16), saturated
+
+    def pack_coeffs(self, coeffs):
+        """
+        Convert the coefficients `coeffs` to their
+        fixed point representation in the coeffs BRAM.
+        returns: string of packed, saturated coefficients
+        """
+        coeffs, saturated = self.quantize(coeffs)
+        if np.any(saturated):
             self.logger.warning("Some coefficients out of range")
-        # saturate coefficients
-        coeffs[coeffs>(2**self.width - 1)] = 2**self.width - 1
-        coeffs = list(coeffs)
-        coeffs_str = struct.pack('>%d%s' % (len(coeffs), self.format), *coeffs)
-        self.write('coeffs', coeffs_str, offset= self.streamsize * stream)
+        return coeffs.astype('>%s' % self.format).tostring()
+
+    def set_coeffs(self, stream, coeffs):
+        self.write('coeffs', self.pack_coeffs(coeffs), offset= self.streamsize * stream)
+
+    def set_all_coeffs(self, coeffs):
+        """
+        Set the coefficients of every stream with a single write.
+        coeffs: array of shape (nstreams, ncoeffs), or anything
+                which broadcasts to it, eg. a single value.
+        """
+        coeffs = np.broadcast_to(coeffs, (self.nstreams, self.ncoeffs))
+        data = self.pack_coeffs(coeffs)
+        self.write('coeffs', data)
+        # Keep a copy for any later write_image
+        self._images['coeffs'] = (0, data)
 
     def get_coeffs(self, stream):
         coeffs_str = self.read('coeffs', self.streamsize, offset= self.streamsize * stream)
         coeffs = np.array(struct.unpack('>%d%s' % (self.ncoeffs, self.format), coeffs_str))
         return coeffs / (2.**self.bp)
 
+    def get_all_coeffs(self):
+        """
+        Read the coefficients of every stream with a single read.
+        returns: array of shape (nstreams, ncoeffs)
+        """
+        coeffs_str = self.read('coeffs', self.streamsize * self.nstreams)
+        self._images['coeffs'] = (0, coeffs_str)
+        coeffs = np.frombuffer(coeffs_str, dtype='>%s' % self.format).reshape(self.nstreams, self.ncoeffs)
+        return coeffs / (2.**self.bp)
+
     def clip_count(self):
         return self.read_int('clip_cnt')
 
@@ -534,8 +903,7 @@ class Eq(Block):
         print 'Number of times input got clipped: %d'%self.clip_count()
 
     def initialize(self):
-        for stream in range(self.nstreams):
-            self.set_coeffs(stream, 100*np.ones(self.ncoeffs,dtype='>%s'%self.format))
+        self.set_all_coeffs(100)
 
 class EqTvg(Block):
     def __init__(self, host, name, nstreams=8, nchans=2**13):
@@ -607,12 +975,11 @@ class ChanReorder(Block):
         Re-order the channels to that they are
         sent with the order in the specified map
         """
-        order = list(order)
+        order = np.asarray(order, dtype='>u4')
         if len(order) != self.nchans:
-            self.logger.Error("Tried to reorder channels, but map was the wrong length")
+            self.logger.error("Tried to reorder channels, but map was the wrong length")
             return
-        order_str = struct.pack('>%d%s' %(self.nchans,self.format), *order)
-        self.write('reorder3_map1', order_str)
+        self.write('reorder3_map1', order.tostring())
 
     def read_reorder(self, slot_num=None):
         reorder = self.read('reorder3_map1',1024*4)
@@ -671,36 +1038,73 @@ class Packetizer(Block):
         ants     -- The antenna index of the first antenna on this board. One packet contains 3 antennas
 
         """
-        NCHANS_PER_SLOT = 384
-        chans = np.array(chans, dtype='>L')
-        if slot_num > self.n_slots:
-            raise ValueError("Only %d output slots can be specified" % self.n_slots)
-        if chans.shape[0] != NCHANS_PER_SLOT:
-            raise ValueError("Each slot must contain %d frequency channels" % NCHANS_PER_SLOT)
-
-        if (type(dests) != list) or (len(dests) != self.n_time_demux):
-            raise ValueError("Packetizer requires a list of desitination IPs with %d entries" % self.n_time_demux)
+        self.assign_slots({slot_num: (chans, dests)}, reorder_block, ant)
 
-        # Set the frequency header of this slot to be the first specified channel
-        self.set_chan_header(chans[0], slot_offset=slot_num)
+    def assign_slots(self, slots, reorder_block, ant):
+        """
+        Assign many output slots at once. See `assign_slot` for
+        an explanation of the arguments.
+        slots -- a dictionary of {slot_num: (chans, dests)}. Slots not in
+                 this dictionary keep their current configuration.
+        The destination IP, antenna header, channel header and channel
+        reorder tables are each read once, updated, and written back
+        with a single write if they have changed.
+        returns: the number of tables which were written
+        """
+        ntable = self.n_time_demux * self.n_slots
+        ips   = np.fromstring(self.read('ips', ntable*4), dtype='>u4').copy()
+        ants  = np.fromstring(self.read('ants', ntable*4), dtype='>u4').copy()
+        chans_hdr = np.fromstring(self.read('chans', ntable*4), dtype='>u4').copy()
+        reorder = np.array(reorder_block.read_reorder(), dtype='>u4')
+        orig = [ips.copy(), ants.copy(), chans_hdr.copy(), reorder.copy()]
 
-        # Set the antenna header of this slot (every slot represents 3 antennas
-        self.set_ant_header(ant=ant, slot_offset=slot_num)
+        self.fill_slot_tables(slots, ant, ips, ants, chans_hdr, reorder)
 
-        # Set the destination address of this slot to be the specified IP address
-        self.set_dest_ip(dests, slot_offset=slot_num)
+        nwrites = 0
+        for reg, new, old in zip(['ips', 'ants', 'chans'], [ips, ants, chans_hdr], orig[0:3]):
+            if np.any(new != old):
+                self.write(reg, new.tostring())
+                nwrites += 1
+        if np.any(reorder != orig[3]):
+            reorder_block.set_channel_order(reorder)
+            nwrites += 1
+        return nwrites
 
-        # set the channel orders
-        # The channels supplied need to emerge in the first 384 channels of a block
-        # of 512 (first 192 clks of 256clks for 2 pols)
-        for cn, chan in enumerate(chans[::8]):
-            reorder_block.reindex_channel(chan//8, slot_num*64 + cn)
+    def fill_slot_tables(self, slots, ant, ips, ants, chans_hdr, reorder):
+        """
+        Update, in place, numpy arrays holding the destination IP, antenna
+        header, channel header and channel reorder tables, so that they
+        implement the slot assignments `slots`. See `assign_slots`.
+        """
+        NCHANS_PER_SLOT = 384
+        NCHANS_PER_WORD = 8  # The reorder map moves blocks of 8 channels
+        for slot_num, (chans, dests) in slots.items():
+            chans = np.array(chans, dtype='>L')
+            if slot_num > self.n_slots:
+                raise ValueError("Only %d output slots can be specified" % self.n_slots)
+            if chans.shape[0] != NCHANS_PER_SLOT:
+                raise ValueError("Each slot must contain %d frequency channels" % NCHANS_PER_SLOT)
+            if (type(dests) != list) or (len(dests) != self.n_time_demux):
+                raise ValueError("Packetizer requires a list of desitination IPs with %d entries" % self.n_time_demux)
+            # Each table has an entry per time slot per output slot
+            entries = np.arange(self.n_time_demux) * self.n_slots + slot_num
+            # Set the frequency header of this slot to be the first specified channel
+            chans_hdr[entries] = chans[0]
+            # Set the antenna header of this slot (every slot represents 3 antennas
+            ants[entries] = ant
+            # Set the destination address of this slot to be the specified IP address
+            ips[entries] = dests
+            # set the channel orders
+            # The channels supplied need to emerge in the first 384 channels of a block
+            # of 512 (first 192 clks of 256clks for 2 pols)
+            first = slot_num * 64
+            reorder[first:first + NCHANS_PER_SLOT // NCHANS_PER_WORD] = chans[::NCHANS_PER_WORD] // NCHANS_PER_WORD
 
-        
 class Eth(Block):
     def __init__(self, host, name, port=10000):
         super(Eth, self).__init__(host, name)
         self.port = port
+        self.shadow_regs = ['ctrl']
 
     def set_arp_table(self, macs):
         """
@@ -722,8 +1126,24 @@ class Eth(Block):
         ip_offset = ip % 256
         self.write('sw', mac_pack, offset=0x3000 + ip_offset*8)
 
+    def add_arp_entries(self, entries):
+        """
+        Set many arp entries at once.
+        entries: dictionary of {ip: mac}
+        The ARP table is read once, and only written
+        (with a single write) if it needs to change.
+        returns: True if the table was written
+        """
+        table = np.fromstring(self.read('sw', 256*8, offset=0x3000), dtype='>u8').copy()
+        orig = table.copy()
+        for ip, mac in entries.items():
+            table[ip % 256] = mac
+        if np.all(table == orig):
+            return False
+        self.write('sw', table.tostring(), offset=0x3000)
+        return True
+
     def get_status(self):
-        stat = self.read_uint('sw_txs_ss_status')
         rv = {}
         #rv['rx_overrun'  ] =  (stat >> 0) & 1   
         #rv['rx_bad_frame'] =  (stat >> 1) & 1
@@ -733,11 +1153,12 @@ class Eth(Block):
         #rv['rx_led'      ] =  (stat >> 5) & 1   # Receive LED
         #rv['up'          ] =  (stat >> 6) & 1   # LED up
         #rv['eof_cnt'     ] =  (stat >> 7) & (2**25-1)
-        rv['tx_of'        ] =  self.read_uint('sw_txofctr')
-        rv['tx_full'      ] =  self.read_uint('sw_txfullctr')
-        rv['tx_err'       ] =  self.read_uint('sw_txerrctr')
-        rv['tx_vld'       ] =  self.read_uint('sw_txvldctr')
-        rv['tx_ctr'       ] =  self.read_uint('sw_txctr')
+        ctrs = self.read_uints(['sw_txofctr', 'sw_txfullctr', 'sw_txerrctr', 'sw_txvldctr', 'sw_txctr'])
+        rv['tx_of'        ] =  ctrs['sw_txofctr']
+        rv['tx_full'      ] =  ctrs['sw_txfullctr']
+        rv['tx_err'       ] =  ctrs['sw_txerrctr']
+        rv['tx_vld'       ] =  ctrs['sw_txvldctr']
+        rv['tx_ctr'       ] =  ctrs['sw_txctr']
         return rv
         
     def status_reset(self):
@@ -765,7 +1186,7 @@ class Eth(Block):
 
     def initialize(self):
         #Set ip address of the SNAP
-        ipaddr = socket.inet_aton(socket.gethostbyname(self.host.host))
+        ipaddr = socket.inet_aton(helpers.gethostbyname(self.host.host))
         self.blindwrite('sw', ipaddr, offset=0x10)
         self.set_port(self.port)
 
@@ -796,31 +1217,89 @@ class Corr(Block):
             continue
         return 1
 
-    def read_bram(self):
+    def wait_for_new_acc(self, last, poll=0.005, timeout=None):
+        """
+        Wait for the accumulation counter to move on from `last`.
+        poll: Seconds between reads of the counter.
+        timeout: Seconds to wait before giving up. Default: forever.
+        returns: the new value of the counter
+        """
+        t0 = time.time()
+        while True:
+            cnt = self.read_uint('acc_cnt')
+            if cnt != last:
+                return cnt
+            if timeout is not None and time.time() - t0 > timeout:
+                raise RuntimeError('%s: Timed out waiting for an accumulation' % self.host.host)
+            time.sleep(poll)
+
+    def get_acc_time(self):
+        """
+        returns: Seconds per accumulation, for the current acc_len
+        """
+        return self.acc_len * 8 * self.nchans * self.spec_per_acc / 250e6
+
+    def read_dout(self, out=None):
+        """
+        Read the last accumulation from the BRAM, without waiting for a new one.
+        out: complex array of length nchans to decode into. Default: a new one.
+        returns: the (unnormalized) accumulation
+        """
+        # dout holds big-endian (real, imag) int32 pairs
+        raw = np.frombuffer(self.read('dout', 8*self.nchans), dtype='>i4')
+        if out is None:
+            out = np.empty(self.nchans, dtype=np.complex128)
+        out.real[:] = raw[0::2]
+        out.imag[:] = raw[1::2]
+        return out
+
+    def normalize(self, spec, auto=False):
+        """
+        Normalize the accumulation `spec` to the mean of one spectrum, in place.
+        auto: Zero the imaginary part, which for an autocorrelation is the max hold.
+        returns: spec
+        """
+        spec /= float(self.acc_len*self.spec_per_acc)
+        if auto:
+            spec.imag[:] = 0
+        return spec
+
+    def read_bram(self, out=None):
         """ 
         Outputs the contents of the BRAM. If you want a 
         fresh accumulation use get_new_corr(pol1, pol2) instead.
 
         """
         self.wait_for_acc()
-        spec = np.array(struct.unpack('>2048l',self.read('dout',8*1024)))
-        spec = (spec[0::2]+1j*spec[1::2])
-        return spec
+        return self.read_dout(out=out)
     
-    def get_new_corr(self, pol1, pol2):
+    def get_new_corr(self, pol1, pol2, out=None):
         """
         Get a new correlation with the given inputs.
         Input Pol Mapping: [1a, 1b, 2a, 2b, 3a, 3b] : [0, 1, 2, 3, 4, 5, 6, 7]
+        out: complex array of length nchans to write the visibility to.
         Returns: visibility of shape(1024,)
 
         """
         self.set_input(pol1,pol2)
         self.wait_for_acc()      # Wait two acc_len for new spectra to load
-        spec = self.read_bram()/float(self.acc_len*self.spec_per_acc)
-        if pol1==pol2:
-            return spec.real + 1j*np.zeros(len(spec))
-        else:
-            return spec
+        return self.normalize(self.read_bram(out=out), auto=(pol1 == pol2))
+
+    def get_new_corrs(self, pol1, pol2, n_dumps, out=None):
+        """
+        Get `n_dumps` consecutive new correlations with the given inputs.
+        out: complex array of shape (n_dumps, nchans) to write them to.
+        Returns: visibilities of shape (n_dumps, 1024)
+        """
+        if out is None:
+            out = np.empty((n_dumps, self.nchans), dtype=np.complex128)
+        self.set_input(pol1,pol2)
+        # The accumulation in progress has some of the last inputs in it
+        cnt = self.wait_for_new_acc(self.read_uint('acc_cnt'))
+        for i in range(n_dumps):
+            cnt = self.wait_for_new_acc(cnt)
+            self.read_dout(out=out[i])
+        return self.normalize(out, auto=(pol1 == pol2))
 
     def get_max_hold(self, pol):
         """
@@ -829,8 +1308,9 @@ class Corr(Block):
         """
         self.set_input(pol,pol)
         self.wait_for_acc()
-        spec = self.read_bram()/float(self.spec_per_acc)
-   	return spec.imag 
+        spec = self.read_bram().imag
+        spec /= float(self.spec_per_acc)
+        return spec
         
     
     def plot_corr(self, pol1, pol2, show=False):
@@ -1052,9 +1532,12 @@ class Pam(Block):
         """
         super(Pam, self).__init__(host, name)
 
+        # The I2C drivers are only imported by boards which use them
+        from casperfpga import i2c
         self.i2c = i2c.I2C(host, name, retry_wait=self.I2C_RETRY_WAIT)
 
     def initialize(self):
+        from casperfpga import i2c_gpio, i2c_volt, i2c_sn, i2c_eeprom
 
         self.i2c.enable_core()
         # set i2c bus to 10 kHz
@@ -1217,9 +1700,12 @@ class Fem(Block):
         """
         super(Fem, self).__init__(host, name)
 
+        # The I2C drivers are only imported by boards which use them
+        from casperfpga import i2c
         self.i2c = i2c.I2C(host, name, retry_wait=self.I2C_RETRY_WAIT)
 
     def initialize(self):
+        from casperfpga import i2c_bar, i2c_volt, i2c_motion, i2c_eeprom, i2c_gpio, i2c_temp
 
         self.i2c.enable_core()
         # set i2c bus to 10 kHz
@@ -0,0 +1,411 @@
+"""
+A long-running process which owns the connections to every board, so
+that scripts don't each have to connect to all the boards, read the
+configuration and compute the hookup before they can do anything, and
+don't have to lock the monitor out to keep their TAPCP traffic apart.
+
+`ControlDaemon` runs requests to call HeraCorrelator's board-wide
+methods, or methods of the blocks of some boards (see `feng_call`).
+Every request holds the boards it uses until it's done, so no two
+requests talk to a board at once, and boards are handed to the waiting
+request with the highest priority first. Its monitor polls the boards
+at MONITOR priority, in between other requests.
+
+Requests arrive over redis, as JSON pushed onto the list REQUEST_KEY,
+and responses are pushed onto a list of their own, which `DaemonClient`
+waits on:
+
+    client = DaemonClient('redishost')
+    client.resync(manual=True)
+    client.feng_call('eth', 'disable_tx', hosts=['heraNode1Snap0'])
+
+See hera_snap_control_daemon.py and hera_snap_ctl.py.
+"""
+import time
+import json
+import uuid
+import heapq
+import itertools
+import threading
+import logging
+import redis
+import helpers
+import monitor
+
+logger = helpers.add_default_log_handlers(logging.getLogger(__name__))
+
+LAST_PROGRAMMED_KEY = 'corr:snap:last_programmed'
+REQUEST_KEY = 'corr:daemon:requests'
+RESPONSE_KEY = 'corr:daemon:response:%s'
+STATUS_KEY = 'status:script:control_daemon'
+# Priorities of requests. Lower values go first.
+CONTROL = 0
+MONITOR = 10
+
+# HeraCorrelator methods which can be requested. They use every board.
+CORR_METHODS = [
+    'program', 'initialize', 'apply_config', 'configure_freq_slots',
+    'resync', 'sync_noise', 'check_sync', 'enable_output', 'disable_output',
+    'phase_switch_enable', 'phase_switch_disable',
+    'noise_diode_enable', 'noise_diode_disable',
+    'reestablish_dead_connections',
+]
+# ControlDaemon methods which can be requested
+DAEMON_METHODS = ['feng_call', 'monitor_poll', 'invalidate', 'reload', 'status']
+
+class RemoteError(RuntimeError):
+    """
+    An exception raised by a request to the control daemon.
+    """
+    pass
+
+class PriorityLock(object):
+    """
+    A lock which, when released, is given to the waiter with the lowest
+    `priority` value, and of those, the one which has waited longest.
+    It isn't owned by a thread, so any thread can release it.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._locked = False
+        self._waiting = []
+        self._count = itertools.count()
+
+    def acquire(self, priority=CONTROL):
+        with self._cond:
+            entry = (priority, next(self._count))
+            heapq.heappush(self._waiting, entry)
+            while self._locked or self._waiting[0] != entry:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._locked = True
+
+    def release(self):
+        with self._cond:
+            self._locked = False
+            self._cond.notify_all()
+
+    def waiting(self):
+        """
+        returns: number of threads waiting for the lock
+        """
+        with self._cond:
+            return len(self._waiting)
+
+def _to_json(obj):
+    # numpy arrays and scalars, and anything else which
+    # JSON can't represent, such as exceptions
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return repr(obj)
+
+class ControlDaemon(object):
+    """
+    Run requests on the boards of HeraCorrelator `corr`, one request per
+    board at a time, in order of priority.
+
+    make_corr: Function returning a new HeraCorrelator, called by `reload`
+               when the configuration changes. Default: don't reload.
+    """
+    def __init__(self, corr, make_corr=None):
+        self.corr = corr
+        self.make_corr = make_corr
+        self.locks = {}
+        self._locks_lock = threading.Lock()
+        self.t0 = time.time()
+        self.nrequests = 0
+        self._stop = threading.Event()
+
+    def _hosts(self):
+        # Every configured board, connected or not, as reconnecting
+        # to a dead board also needs it to be left alone
+        return sorted(self.corr.config['fengines'].keys())
+
+    def hold(self, hosts, priority=CONTROL):
+        """
+        Wait for the boards `hosts` to be free, and hold them,
+        as a context manager:
+
+            with daemon.hold(hosts):
+                ...
+        """
+        return _Hold(self, sorted(set(hosts)), priority)
+
+    def _lock(self, host):
+        with self._locks_lock:
+            if host not in self.locks:
+                self.locks[host] = PriorityLock()
+            return self.locks[host]
+
+    def call(self, method, args=(), kwargs=None, priority=CONTROL, hosts=None):
+        """
+        Run method `method`, holding the boards it uses while it runs.
+        `method` can be one of CORR_METHODS, or DAEMON_METHODS. Only
+        feng_call uses boards `hosts` (default all). The rest use every board.
+        returns: what the method returns
+        """
+        kwargs = kwargs or {}
+        if method not in CORR_METHODS + DAEMON_METHODS:
+            raise ValueError('Unknown method %s' % method)
+        if hosts is not None and method != 'feng_call':
+            raise ValueError('%s uses every board, so it cannot be given hosts' % method)
+        if method in ['reload', 'status']:
+            # These look after their own locking
+            return getattr(self, method)(*args, **kwargs)
+        if method == 'feng_call':
+            kwargs = dict(kwargs, hosts=hosts)
+        with self.hold(self._hosts() if hosts is None else hosts, priority):
+            # Only look the method up once the boards are held, in case of a `reload`
+            if method in CORR_METHODS:
+                return getattr(self.corr, method)(*args, **kwargs)
+            return getattr(self, method)(*args, **kwargs)
+
+    def feng_call(self, block, method, *args, **kwargs):
+        """
+        Call `method(*args, **kwargs)` of block `block` (eg. 'eth', or
+        None for the SnapFengine itself) of boards `hosts` (default all
+        connected boards), concurrently.
+        returns: dictionary with 'results', a dictionary of {hostname: return value},
+                 and 'errors', a dictionary of {hostname: error message} for
+                 boards which failed
+        """
+        hosts = kwargs.pop('hosts', None)
+        if method.startswith('_') or (block is not None and block.startswith('_')):
+            raise ValueError('Private attributes cannot be called')
+        fengs = [feng for feng in self.corr.fengs if hosts is None or feng.host in hosts]
+        def _call(feng):
+            obj = feng if block is None else getattr(feng, block)
+            return getattr(obj, method)(*args, **kwargs)
+        results, errors = self.corr.do_for_all_fengs(_call, fengs=fengs)
+        return {'results' : results, 'errors' : dict([(host, repr(err)) for host, err in errors.items()])}
+
+    def monitor_poll(self):
+        """
+        Poll the monitoring data of all the boards, as one loop of
+        hera_snap_redis_monitor.py, and upload it to redis.
+        returns: dictionary of {hostname: error message} for boards which failed
+        """
+        self.corr.compute_hookup()
+        inputs = monitor.get_board_inputs(self.corr)
+        status, errors = monitor.poll_boards(self.corr, inputs)
+        monitor.upload_status(self.corr.r, status)
+        for host, err in errors.items():
+            logger.error('Failed to get stats from SNAP %s: %s' % (host, err))
+        return dict([(host, repr(err)) for host, err in errors.items()])
+
+    def invalidate(self):
+        """
+        Forget the copies kept of the boards' control registers and
+        memories, because another process may have changed them,
+        eg. by reprogramming or initializing the boards.
+        """
+        for feng in self.corr.fengs:
+            feng.invalidate_shadows()
+
+    def reload(self):
+        """
+        Replace the HeraCorrelator with a new one from `make_corr`, eg.
+        because the configuration has changed, once every board is free.
+        """
+        if self.make_corr is None:
+            raise RuntimeError('This daemon cannot reload its configuration')
+        # Boards new to the configuration aren't in use, so only the old ones need holding
+        with self.hold(self._hosts(), CONTROL):
+            self.corr = self.make_corr()
+        logger.info('Reloaded configuration %s' % self.corr.config_name)
+
+    def status(self):
+        """
+        returns: dictionary describing the daemon and its boards
+        """
+        with self._locks_lock:
+            locks = self.locks.items()
+        return {
+            'uptime' : time.time() - self.t0,
+            'requests' : self.nrequests,
+            'config_name' : self.corr.config_name,
+            'config_time' : self.corr.config_time,
+            'hosts' : [feng.host for feng in self.corr.fengs],
+            'dead_hosts' : sorted(self.corr.dead_fengs.keys()),
+            'waiting' : dict([(host, lock.waiting()) for host, lock in locks]),
+        }
+
+    def handle(self, request):
+        """
+        Run a request, a dictionary with the method name, and optionally,
+        args, kwargs, priority, hosts, and a unix time it `expires` at,
+        after which it isn't run.
+        returns: response dictionary, holding the request's id, and
+                 either the 'result' or an 'error' message
+        """
+        t0 = time.time()
+        response = {'id' : request.get('id')}
+        self.nrequests += 1
+        try:
+            if request.get('expires') is not None and time.time() > request['expires']:
+                raise RuntimeError('Request expired before it could be run')
+            response['result'] = self.call(request['method'], request.get('args', []), request.get('kwargs'),
+                                           priority=request.get('priority', CONTROL), hosts=request.get('hosts'))
+        except Exception as e:
+            logger.error('Request %s failed: %r' % (request.get('method'), e))
+            response['error'] = repr(e)
+        response['elapsed'] = time.time() - t0
+        return response
+
+    def _respond(self, r, request):
+        response = self.handle(request)
+        key = RESPONSE_KEY % request.get('id')
+        pipe = r.pipeline(transaction=False)
+        pipe.rpush(key, json.dumps(response, default=_to_json))
+        pipe.expire(key, 60)
+        pipe.execute()
+
+    def serve(self, r=None, poll=1.0):
+        """
+        Run requests pushed onto redis list REQUEST_KEY, until `stop` is
+        called. Each request is run in a thread of its own, so that it can
+        wait for its boards while others run.
+        r: redis connection. Default: the HeraCorrelator's
+        poll: Seconds between checks of whether to stop.
+        """
+        r = r or self.corr.r
+        while not self._stop.is_set():
+            item = r.blpop([REQUEST_KEY], timeout=int(max(1, poll)))
+            if item is None:
+                continue
+            try:
+                request = json.loads(item[1])
+            except ValueError:
+                logger.error('Ignoring malformed request: %s' % item[1])
+                continue
+            t = threading.Thread(target=self._respond, args=(r, request))
+            t.daemon = True
+            t.start()
+
+    def run_monitor(self, interval=10.0, retrytime=300.0):
+        """
+        Poll the boards' monitoring data every `interval` seconds, at
+        MONITOR priority, and reload the configuration when a new one is
+        uploaded, until `stop` is called. Try to reconnect to dead boards
+        every `retrytime` seconds. Polling is skipped while the
+        'disable_monitoring' key is set, by scripts which talk to the
+        boards themselves, rather than through the daemon.
+        Everything cached of the boards is forgotten (see `invalidate`)
+        while such a script runs, once it's done, and whenever the
+        boards are reprogrammed.
+        """
+        retry_tick = time.time()
+        upload_time = self.corr.r.hget('snap_configuration', 'upload_time')
+        last_programmed = self.corr.r.get(LAST_PROGRAMMED_KEY)
+        locked_out = False
+        while not self._stop.is_set():
+            tick = time.time()
+            r = self.corr.r
+            try:
+                r.set(STATUS_KEY, 'alive', ex=int(max(60, interval * 2)))
+                if r.hget('snap_configuration', 'upload_time') != upload_time:
+                    upload_time = r.hget('snap_configuration', 'upload_time')
+                    if self.make_corr is not None:
+                        logger.info('New configuration detected. Reloading')
+                        self.reload()
+                if r.get(LAST_PROGRAMMED_KEY) != last_programmed:
+                    last_programmed = r.get(LAST_PROGRAMMED_KEY)
+                    logger.info('Boards were reprogrammed at %s' % last_programmed)
+                    self.call('invalidate')
+                if r.exists('disable_monitoring'):
+                    logger.warning('Monitoring locked out by another script. Skipping')
+                    locked_out = True
+                    self.call('invalidate')
+                else:
+                    if locked_out:
+                        # The script may have changed the boards after the last check
+                        locked_out = False
+                        self.call('invalidate')
+                    self.call('monitor_poll', priority=MONITOR)
+                if time.time() > retry_tick + retrytime:
+                    self.call('reestablish_dead_connections', priority=MONITOR)
+                    retry_tick = time.time()
+            except Exception as e:
+                logger.error('Monitor loop failed: %r' % e)
+            self._stop.wait(max(0, interval - (time.time() - tick)))
+
+    def stop(self):
+        self._stop.set()
+
+class _Hold(object):
+    def __init__(self, daemon, hosts, priority):
+        self.daemon = daemon
+        self.hosts = hosts
+        self.priority = priority
+        self.held = []
+
+    def __enter__(self):
+        # Always in hostname order, so two requests can't each
+        # hold a board the other is waiting for
+        try:
+            for host in self.hosts:
+                lock = self.daemon._lock(host)
+                lock.acquire(self.priority)
+                self.held += [lock]
+        except:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        for lock in reversed(self.held):
+            lock.release()
+        self.held = []
+
+class DaemonClient(object):
+    """
+    Send requests to a ControlDaemon, through redis server `redishost`
+    (or connection `r`). Methods of the daemon, and the HeraCorrelator
+    methods it runs (see CORR_METHODS), can be called as methods of the
+    client, with the extra keyword arguments `priority`, and for
+    feng_call, `hosts`:
+
+        client.apply_config(dry_run=True)
+        client.feng_call('sync', 'change_period', 0, hosts=hosts)
+
+    timeout: Default seconds to wait for a request to be run.
+    """
+    def __init__(self, redishost='redishost', r=None, timeout=600.0):
+        # Not the shared connection, whose socket timeout is shorter than the waits for responses
+        self.r = r or redis.Redis(redishost)
+        self.timeout = timeout
+
+    def call(self, method, args=(), kwargs=None, priority=CONTROL, hosts=None, timeout=None):
+        """
+        Run `method` in the daemon, and wait for it to finish.
+        returns: what the method returns
+        raises: RemoteError if the method failed, or didn't
+                finish within `timeout` seconds
+        """
+        timeout = timeout or self.timeout
+        request = {
+            'id' : uuid.uuid4().hex,
+            'method' : method,
+            'args' : list(args),
+            'kwargs' : kwargs or {},
+            'priority' : priority,
+            'hosts' : hosts,
+            'expires' : time.time() + timeout,
+        }
+        self.r.rpush(REQUEST_KEY, json.dumps(request, default=_to_json))
+        item = self.r.blpop([RESPONSE_KEY % request['id']], timeout=int(max(1, timeout)))
+        if item is None:
+            raise RemoteError('No response to %s from the control daemon in %d seconds' % (method, timeout))
+        response = json.loads(item[1])
+        if 'error' in response:
+            raise RemoteError('%s failed: %s' % (method, response['error']))
+        return response.get('result')
+
+    def __getattr__(self, method):
+        if method not in CORR_METHODS + DAEMON_METHODS:
+            raise AttributeError(method)
+        def _call(*args, **kwargs):
+            hosts = kwargs.pop('hosts', None)
+            priority = kwargs.pop('priority', CONTROL)
+            return self.call(method, args, kwargs, priority=priority, hosts=hosts)
+        return _call
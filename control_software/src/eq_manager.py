@@ -0,0 +1,143 @@
+"""
+Management of the EQ coefficients of every stream of every board
+in the array as one array, so that array-wide bandpass equalization
+updates only cost one write per board which has changed.
+"""
+import logging
+import numpy as np
+import helpers
+
+logger = logging.getLogger(__name__)
+
+class EqManager(object):
+    """
+    Hold the EQ coefficients of boards `fengs` in `coeffs`, an array of shape
+    (boards, streams, ncoeffs), in the order of `hosts`. Change `coeffs`
+    (directly, or with `set`), and `upload` the boards which have changed.
+
+    What a board holds is taken from its Eq block's copy of the coeffs
+    memory (see Block.write_image), which HeraCorrelator.apply_config also
+    keeps up to date, and which is dropped when the board is reprogrammed.
+
+    default: Coefficient every stream starts off with, as set by Eq.initialize.
+             Boards aren't assumed to hold it until they're uploaded, or
+             their coefficients are read with `fetch`.
+    nthreads: Maximum number of boards to talk to concurrently.
+    timeout: Seconds a board is allowed to take to upload or fetch.
+    """
+    def __init__(self, fengs, default=100, nthreads=16, timeout=60.0):
+        self.fengs = list(fengs)
+        self.hosts = [feng.host for feng in self.fengs]
+        self.nthreads = nthreads
+        self.timeout = timeout
+        if len(self.fengs) > 0:
+            eq = self.fengs[0].eq
+            self.nstreams, self.ncoeffs = eq.nstreams, eq.ncoeffs
+        else:
+            self.nstreams, self.ncoeffs = 6, 2**10
+        self.coeffs = np.ones((len(self.fengs), self.nstreams, self.ncoeffs)) * default
+
+    def _board_index(self, hosts):
+        if hosts is None:
+            return slice(None)
+        if isinstance(hosts, basestring):
+            return self.hosts.index(hosts)
+        return [self.hosts.index(host) for host in hosts]
+
+    def set(self, coeffs, hosts=None, streams=None):
+        """
+        Set the coefficients of boards `hosts` (a hostname or list of them,
+        default all) and streams `streams` (default all) to `coeffs`, which
+        is broadcast to fit, eg. a single value, one bandpass for all, or
+        one per stream.
+        """
+        boards = self._board_index(hosts)
+        if streams is None:
+            self.coeffs[boards] = coeffs
+        elif isinstance(boards, list):
+            self.coeffs[np.ix_(boards, np.atleast_1d(streams))] = coeffs
+        else:
+            self.coeffs[boards, streams] = coeffs
+
+    def get(self, host, stream=None):
+        """
+        returns: coefficients of board `host`, shape (streams, ncoeffs),
+                 or (ncoeffs,) for one stream.
+        """
+        board = self.coeffs[self._board_index(host)]
+        return board if stream is None else board[stream]
+
+    def quantize(self):
+        """
+        Convert all the coefficients to the fixed point values the boards
+        hold, saturating those which are out of range.
+        returns: uint16 array of shape (boards, streams, ncoeffs),
+                 number of coefficients saturated on each board
+        """
+        if len(self.fengs) == 0:
+            return np.zeros(self.coeffs.shape, dtype=np.uint16), np.zeros(0, dtype=np.int)
+        quantized, saturated = self.fengs[0].eq.quantize(self.coeffs)
+        return quantized, saturated.reshape(len(self.fengs), -1).sum(axis=1)
+
+    def _image(self, i):
+        # The contents of board i's coeffs memory, as Eq.pack_coeffs, without its warnings
+        eq = self.fengs[i].eq
+        return eq.quantize(self.coeffs[i])[0].astype('>%s' % eq.format).tostring()
+
+    def pending(self):
+        """
+        returns: hostnames of the boards whose coefficients differ
+                 from the ones they are known to hold
+        """
+        return [host for i, host in enumerate(self.hosts)
+                if self.fengs[i].eq.cached_image('coeffs') != self._image(i)]
+
+    def upload(self, force=False):
+        """
+        Write the coefficients of every board whose coefficients differ
+        from the ones it is known to hold, each with a single write of its
+        whole coeffs BRAM, concurrently.
+        force: Upload every board, changed or not.
+        returns: hostnames of the boards written, dictionary of {hostname: exception}
+                 for boards which failed
+        """
+        pending = self.pending()
+        todo = [i for i, host in enumerate(self.hosts) if force or host in pending]
+
+        def _upload(i):
+            self.fengs[i].eq.set_all_coeffs(self.coeffs[i])
+
+        results, errors = helpers.run_threaded(_upload, todo, key=lambda i: self.hosts[i],
+                                               nthreads=self.nthreads, timeout=self.timeout)
+        for host, err in errors.items():
+            logger.error('%s: EQ coefficient upload failed: %s' % (host, err))
+        return sorted(results.keys()), errors
+
+    def fetch(self):
+        """
+        Read the coefficients of every board, concurrently, into `coeffs`.
+        Boards which already hold the coefficients read back won't be
+        uploaded until they change.
+        returns: dictionary of {hostname: exception} for boards which failed
+        """
+        results, errors = helpers.run_threaded(lambda feng: feng.eq.get_all_coeffs(), self.fengs,
+                                               key=lambda feng: feng.host,
+                                               nthreads=self.nthreads, timeout=self.timeout)
+        for i, host in enumerate(self.hosts):
+            if host in results:
+                self.coeffs[i] = results[host]
+        for host, err in errors.items():
+            logger.error('%s: EQ coefficient read failed: %s' % (host, err))
+        return errors
+
+    def invalidate(self, hosts=None):
+        """
+        Forget what boards `hosts` (a hostname or list of them, default
+        all) hold, eg. because they have been reprogrammed, so that the
+        next `upload` writes them.
+        """
+        if isinstance(hosts, basestring):
+            hosts = [hosts]
+        for i, host in enumerate(self.hosts):
+            if hosts is None or host in hosts:
+                self.fengs[i].eq.invalidate_shadow()
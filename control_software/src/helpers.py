@@ -7,6 +7,8 @@ import redis
 import json
 import socket
 import struct
+import threading
+import Queue
 
 '''
 A Redis-based log handler from:
@@ -15,11 +17,56 @@ http://charlesleifer.com/blog/using-redis-pub-sub-and-irc-for-error-logging-with
 
 logger = logging.getLogger(__name__)
 
+# Process-wide cache of name lookups, shared by everything which needs
+# to resolve SNAP hostnames. {(lookup function name, host): result}
+_dns_cache = {}
+_dns_lock = threading.Lock()
+
+# Process-wide redis connections, and log handlers publishing through
+# them, shared by every logger. {hostname: redis.Redis}, {(hostname, channel): RedisHandler}
+_redis_conns = {}
+_redis_handlers = {}
+_redis_lock = threading.Lock()
+
+# The handlers add_default_log_handlers gives every logger, shared by all
+# of them. {(redis hostname, fglevel, bglevel): [handler, ...]}
+_default_handlers = {}
+
+def get_redis_connection(redishostname='redishost'):
+    """
+    returns: this process's connection to the redis server `redishostname`.
+             It is thread-safe, and shared by all its callers.
+    """
+    with _redis_lock:
+        if redishostname not in _redis_conns:
+            _redis_conns[redishostname] = redis.Redis(redishostname, socket_timeout=1)
+        return _redis_conns[redishostname]
+
 class RedisHandler(logging.Handler):
-    def __init__(self, channel, conn, *args, **kwargs):
+    """
+    Publish log records, as JSON, to redis channel `channel`.
+    Records are queued, and published in pipelined batches of up to
+    `batch` records by a background thread, so logging never waits on
+    redis. If more than `maxsize` records are waiting, new ones are
+    dropped, and counted in `dropped`. Records which couldn't be
+    published because redis was unavailable are counted in `failed`.
+    ping: Check the server is there, from the background thread, before
+          publishing anything. If it isn't, give up on publishing.
+    """
+    def __init__(self, channel, conn, maxsize=10000, batch=256, ping=False, *args, **kwargs):
         logging.Handler.__init__(self, *args, **kwargs)
         self.channel = channel
         self.redis_conn = conn
+        self.batch = batch
+        self.ping = ping
+        self.available = None # Unknown until pinged
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        self.failed = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='RedisHandler-%s' % channel)
+        self._thread.daemon = True
+        self._thread.start()
 
     def emit(self, record):
         attributes = [
@@ -28,43 +75,261 @@ class RedisHandler(logging.Handler):
             'thread', 'threadName', 'process', 'processName',
         ]
         record_dict = dict((attr, getattr(record, attr)) for attr in attributes)
-        record_dict['formatted'] = self.format(record)
         try:
-            self.redis_conn.publish(self.channel, json.dumps(record_dict))
+            record_dict['formatted'] = self.format(record)
+            message = json.dumps(record_dict)
         except UnicodeDecodeError:
-            self.redis_conn.publish(self.channel, 'UnicodeDecodeError on emit!')
+            message = 'UnicodeDecodeError on emit!'
+        if self.available is False:
+            self.failed += 1
+            return
+        try:
+            self.queue.put_nowait(message)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _publish(self, messages):
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for message in messages:
+            pipe.publish(self.channel, message)
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            self.failed += len(messages)
+
+    def _check_server(self):
+        try:
+            self.redis_conn.ping()
+            self.available = True
         except redis.RedisError:
-            pass
+            self.available = False
+            host = self.redis_conn.connection_pool.connection_kwargs.get('host')
+            logger.warning("Couldn't connect to redis server at %s" % host)
+
+    def _run(self):
+        if self.ping:
+            self._check_server()
+        while not self._stop.is_set():
+            try:
+                messages = [self.queue.get(timeout=0.1)]
+            except Queue.Empty:
+                continue
+            try:
+                while len(messages) < self.batch:
+                    messages += [self.queue.get_nowait()]
+            except Queue.Empty:
+                pass
+            try:
+                if self.available is False:
+                    self.failed += len(messages)
+                else:
+                    self._publish(messages)
+            finally:
+                for message in messages:
+                    self.queue.task_done()
+
+    def flush(self, timeout=2.0):
+        """
+        Wait up to `timeout` seconds for the queued records to be published.
+        """
+        t0 = time.time()
+        while self.queue.unfinished_tasks > 0 and self._thread.is_alive():
+            if time.time() - t0 > timeout:
+                break
+            time.sleep(0.01)
+
+    def close(self):
+        self.flush()
+        self._stop.set()
+        # Don't leave the thread running into interpreter shutdown
+        if self._thread is not threading.current_thread():
+            self._thread.join(1.0)
+        with _redis_lock:
+            for key, handler in _redis_handlers.items():
+                if handler is self:
+                    del _redis_handlers[key]
+            # Loggers set up from now on get a new set of default handlers
+            for key, handlers in _default_handlers.items():
+                if self in handlers:
+                    del _default_handlers[key]
+        logging.Handler.close(self)
+
+def get_redis_handler(redishostname='redishost', channel='log-channel'):
+    """
+    returns: the RedisHandler publishing to channel `channel` of the
+             redis server `redishostname`, shared by every logger in
+             this process. The server is pinged once, in the background,
+             when the handler is made.
+    """
+    conn = get_redis_connection(redishostname)
+    with _redis_lock:
+        if (redishostname, channel) not in _redis_handlers:
+            _redis_handlers[(redishostname, channel)] = RedisHandler(channel, conn, ping=True)
+        return _redis_handlers[(redishostname, channel)]
     
-def add_default_log_handlers(logger, redishostname='redishost', fglevel=logging.INFO, bglevel=logging.INFO):
-    logger.setLevel(logging.DEBUG)
-    logger.propagate = False
+def get_default_log_handlers(redishostname='redishost', fglevel=logging.INFO, bglevel=logging.INFO):
+    """
+    returns: the stdout, syslog and redis log handlers which
+             `add_default_log_handlers` gives loggers. They are made
+             the first time they're asked for, and shared after that.
+    """
+    key = (redishostname, fglevel, bglevel)
+    with _redis_lock:
+        handlers = _default_handlers.get(key)
+    if handlers is not None:
+        return handlers
 
     formatter = logging.Formatter('%(asctime)s - %(name)20s - %(levelname)s - %(message)s')
 
     stream_handler = logging.StreamHandler(stream=sys.stdout)
     stream_handler.setLevel(fglevel)
     stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
 
     syslog_handler = logging.handlers.SysLogHandler(address='/dev/log')
     syslog_handler.setLevel(bglevel)
     syslog_handler.setFormatter(formatter)
-    logger.addHandler(syslog_handler)
 
-    redis_host = redis.Redis(redishostname, socket_timeout=1)
-    try:
-        redis_host.ping()
-    except redis.ConnectionError:
-        logger.warn("Couldn't connect to redis server at %s"%redishostname)
-        return logger
-
-    redis_handler = RedisHandler('log-channel', redis_host)
-    redis_handler.setLevel(bglevel)
-    redis_handler.setFormatter(formatter)
-    logger.addHandler(redis_handler)
+    # Anything the redis handler itself has to say goes to the others
+    if len(logger.handlers) == 0:
+        logger.propagate = False
+        logger.addHandler(stream_handler)
+        logger.addHandler(syslog_handler)
+
+    # The handler is shared, so its level and format are those of the first logger to use it
+    redis_handler = get_redis_handler(redishostname)
+    if redis_handler.formatter is None:
+        redis_handler.setLevel(bglevel)
+        redis_handler.setFormatter(formatter)
+
+    with _redis_lock:
+        return _default_handlers.setdefault(key, [stream_handler, syslog_handler, redis_handler])
+
+def add_default_log_handlers(logger, redishostname='redishost', fglevel=logging.INFO, bglevel=logging.INFO):
+    """
+    Make `logger` log to stdout, syslog and the redis server `redishostname`,
+    using handlers shared by every logger in the process, so this is cheap
+    enough to do for every block of every board. Adding them again to a
+    logger which already has them does nothing.
+    returns: logger
+    """
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    for handler in get_default_log_handlers(redishostname, fglevel, bglevel):
+        if handler not in logger.handlers:
+            logger.addHandler(handler)
     return logger
 
+def run_threaded(func, items, key=None, nthreads=16, timeout=None):
+    """
+    Call `func(item)` for every entry in `items` using a pool
+    of at most `nthreads` worker threads.
+    key: function mapping an item to the key used in the
+         returned dictionaries. Default: the item itself.
+    timeout: Seconds any single call is allowed to run for
+             before it is abandoned and reported as failed.
+             None means wait forever.
+    returns: results, errors
+             Two dictionaries, keyed by `key(item)`. `results` holds the
+             return values of successful calls, and `errors` holds the
+             exceptions raised by (or timeouts of) failed calls.
+    Abandoned calls are left to run to completion in a daemon thread,
+    so a hung board cannot block the remaining items.
+    """
+    key = key or (lambda x: x)
+    items = list(items)
+    keys = [key(item) for item in items]
+    results = {}
+    errors = {}
+    if len(items) == 0:
+        return results, errors
+
+    lock = threading.Lock()
+    todo = Queue.Queue()
+    for k, item in zip(keys, items):
+        todo.put((k, item))
+    running = {} # {key: start time} of calls currently in progress
+    done = threading.Event()
+
+    def worker():
+        while True:
+            try:
+                k, item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            with lock:
+                running[k] = time.time()
+            try:
+                rv, err = func(item), None
+            except Exception as e:
+                rv, err = None, e
+            with lock:
+                # Skip calls which have already been declared timed out
+                if running.pop(k, None) is None:
+                    return
+                if err is None:
+                    results[k] = rv
+                else:
+                    errors[k] = err
+                if len(results) + len(errors) == len(keys):
+                    done.set()
+
+    def start_worker():
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    for i in range(min(nthreads, len(items))):
+        start_worker()
+
+    while not done.wait(0.05):
+        if timeout is None:
+            continue
+        now = time.time()
+        with lock:
+            expired = [k for k, t0 in running.items() if now - t0 > timeout]
+            for k in expired:
+                running.pop(k)
+                errors[k] = RuntimeError('Timed out after %.1f seconds' % timeout)
+            if len(results) + len(errors) == len(keys):
+                done.set()
+        # The threads running expired calls are abandoned, so replace them
+        for k in expired:
+            start_worker()
+    return results, errors
+
+def _cached_lookup(func, host):
+    k = (func.__name__, host)
+    with _dns_lock:
+        if k in _dns_cache:
+            return _dns_cache[k]
+    # Don't hold the lock while resolving, so lookups of
+    # different hosts can proceed in parallel.
+    rv = func(host)
+    with _dns_lock:
+        _dns_cache[k] = rv
+    return rv
+
+def gethostbyname(host):
+    """
+    Cached version of socket.gethostbyname.
+    Failed lookups are not cached.
+    """
+    return _cached_lookup(socket.gethostbyname, host)
+
+def gethostbyaddr(host):
+    """
+    Cached version of socket.gethostbyaddr.
+    Failed lookups are not cached.
+    """
+    return _cached_lookup(socket.gethostbyaddr, host)
+
+def clear_dns_cache():
+    """
+    Forget all cached name lookups, eg. after the hosts file has changed.
+    """
+    with _dns_lock:
+        _dns_cache.clear()
+
 def snap_part_to_host_input(part):
     """
     Given a part string, eg. 'e2>SNP008', return the hostname of the snap board
@@ -78,7 +343,7 @@ def snap_part_to_host_input(part):
     # name has the form SNPA0000123. Hostnames have the form herasnapA123
     hostname = "herasnap%s" % (name[3] + name[4:].lstrip('0'))
     try:
-        true_name, aliases, addresses = socket.gethostbyaddr(hostname)
+        true_name, aliases, addresses = gethostbyaddr(hostname)
     except:
         logger.error('Failed to gethostbyname for host %s' % hostname)
     # assume that the one we want is the last thing in the hosts file line
@@ -1,5 +1,6 @@
 import logging
 import time
+import threading
 import socket
 import redis
 import yaml
@@ -7,16 +8,52 @@ import json
 import helpers
 import hashlib
 from hera_corr_f import SnapFengine
+from blocks import ADC_SNAPSHOT_DTYPE
 import numpy as np
-from casperfpga import utils
 
 LOGGER = helpers.add_default_log_handlers(logging.getLogger(__name__))
 
+def get_slot_plan(config):
+    """
+    Work out the X-engine slot assignments from the configuration `config`.
+    They are the same for every board.
+    returns: list of (xeng number, channels, even IP, odd IP, xeng config) tuples
+    """
+    n_xengs = config.get('n_xengs', 16)
+    slots = []
+    for xn, xparams in config['xengines'].items():
+        chan_range = xparams.get('chan_range', [xn*384, (xn+1)*384])
+        chans = range(chan_range[0], chan_range[1])
+        if (xn > n_xengs): 
+           raise ValueError("Cannot have more than %d X-engs!!" % n_xengs)
+        ip = [int(i) for i in xparams['even']['ip'].split('.')]
+        ip_even = (ip[0]<<24) + (ip[1]<<16) + (ip[2]<<8) + ip[3]
+        ip = [int(i) for i in xparams['odd']['ip'].split('.')]
+        ip_odd = (ip[0]<<24) + (ip[1]<<16) + (ip[2]<<8) + ip[3]
+        slots += [(xn, chans, ip_even, ip_odd, xparams)]
+    return slots
+
 class HeraCorrelator(object):
-    def __init__(self, redishost='redishost', config=None, logger=LOGGER, passive=False):
+    def __init__(self, redishost='redishost', config=None, logger=LOGGER, passive=False,
+                 nthreads=16, timeout=60.0, fpga_factory=None, shadow=False):
+        """
+        nthreads: Maximum number of boards to talk to concurrently
+                  in board-wide operations.
+        timeout: Seconds a single board is allowed to take to complete
+                 a board-wide operation before it is declared dead.
+        fpga_factory: Function of a hostname, returning the object to talk
+                      to that board through, eg. snap_sim.SimulatedSnap to
+                      run without hardware. Default: connect with TAPCP.
+        shadow: Keep software copies of the boards' control registers.
+                See SnapFengine. Only for short-lived scripts.
+        """
         self.logger = logger
         self.redishost = redishost
         self.r = redis.Redis(redishost)
+        self.nthreads = nthreads
+        self.timeout = timeout
+        self.fpga_factory = fpga_factory
+        self.shadow = shadow
 
         self.get_config(config)
 
@@ -50,29 +87,40 @@ class HeraCorrelator(object):
             self.config_time_str = time.ctime(self.config_time)
         self.config = yaml.load(self.config_str)
 
+    def _connect(self, host, ant_indices=None):
+        """
+        Connect to a single board, raising an exception on failure.
+        returns: SnapFengine instance
+        """
+        fpga = None if self.fpga_factory is None else self.fpga_factory(host)
+        feng = SnapFengine(host, ant_indices=ant_indices, fpga=fpga, shadow=self.shadow)
+        if not feng.fpga.is_connected():
+            raise RuntimeError("Board %s is not connected" % host)
+        feng.ip = helpers.gethostbyname(feng.host)
+        return feng
+
     def establish_connections(self):
         # Instantiate CasperFpga connections to all the F-Engine.
         self.fengs = []
         self.dead_fengs = {}
         ant_index = 0
-        for host in self.config['fengines'].keys():
-            ant_indices = self.config['fengines'][host].get('ants', range(ant_index, ant_index + 3))
+        hosts = self.config['fengines'].keys()
+        ant_indices = {}
+        for host in hosts:
+            ant_indices[host] = self.config['fengines'][host].get('ants', range(ant_index, ant_index + 3))
             ant_index += 3
-            self.logger.info("Setting Feng %s antenna indices to %s" % (host, ant_indices))
-            try:
-                feng = SnapFengine(host, ant_indices=ant_indices)
-                if feng.fpga.is_connected():
-                    self.fengs += [feng]
-                else:
-                    self.logger.warning("Board %s is not connected" % host)
-                    self.dead_fengs[host] = time.time()
-            except:
-                self.logger.warning("Exception whilst connecting to board %s" % host)
-                self.dead_fengs[host] = time.time()
+            self.logger.info("Setting Feng %s antenna indices to %s" % (host, ant_indices[host]))
+        # Connect to all the boards in parallel
+        new_fengs, errors = helpers.run_threaded(lambda host: self._connect(host, ant_indices[host]),
+                                hosts, nthreads=self.nthreads, timeout=self.timeout)
+        for host, err in errors.items():
+            self.logger.warning("Exception whilst connecting to board %s: %s" % (host, err))
+            self.dead_fengs[host] = time.time()
+        # Keep the boards in the order they appear in the config
+        self.fengs = [new_fengs[host] for host in hosts if host in new_fengs]
         self.fengs_by_name = {}
         self.fengs_by_ip = {}
         for feng in self.fengs:
-            feng.ip = socket.gethostbyname(feng.host)
             self.fengs_by_name[feng.host] = feng
             self.fengs_by_ip[feng.ip] = feng
         self.logger.info('SNAPs are: %s' % ', '.join([feng.host for feng in self.fengs]))
@@ -85,23 +133,20 @@ class HeraCorrelator(object):
         """
         t_thresh = time.time() - age # Try to connect to boards which were declared dead before this time
         self.logger.info("Trying to re-establish connections to fengines dead before %s" % time.ctime(t_thresh))
-        new_fengs = []
+        hosts = []
         for host, deadtime in self.dead_fengs.iteritems():
             if deadtime > t_thresh:
-                self.logger.info("Ignoring host %s, which was only declared dead %d seconds ago" % (time.time() - deadtime))
+                self.logger.info("Ignoring host %s, which was only declared dead %d seconds ago" % (host, time.time() - deadtime))
                 continue
-            try:
-                feng = SnapFengine(host)
-                if feng.fpga.is_connected():
-                    new_fengs += [feng]
-                    self.dead_fengs.pop(host)
-                else:
-                    self.logger.warning("Tried to reconnect to host %s and failed" % host)
-            except:
-                self.logger.warning("Tried to reconnect to host %s and failed" % host)
+            hosts += [host]
+        new_fengs, errors = helpers.run_threaded(self._connect, hosts,
+                                nthreads=self.nthreads, timeout=self.timeout)
+        for host in errors.keys():
+            self.logger.warning("Tried to reconnect to host %s and failed" % host)
+        new_fengs = [new_fengs[host] for host in hosts if host in new_fengs]
 
         for feng in new_fengs:
-            feng.ip = socket.gethostbyname(feng.host)
+            self.dead_fengs.pop(feng.host)
             self.fengs_by_name[feng.host] = feng
             self.fengs_by_ip[feng.ip] = feng
         
@@ -144,6 +189,30 @@ class HeraCorrelator(object):
 
         self.dead_fengs[deadfeng.host] = time.time()
 
+    def do_for_all_fengs(self, func, fengs=None, timeout=None, nthreads=None):
+        """
+        Call `func(feng)` concurrently for every SnapFengine in `fengs`
+        (default: all connected boards), using up to `nthreads`
+        (default: `self.nthreads`) threads.
+        Boards which raise an exception, or which take longer than `timeout`
+        seconds (default: `self.timeout`), are declared dead.
+        returns: results, errors
+                 Dictionaries keyed by hostname, holding the return values
+                 of successful calls and the exceptions of failed calls.
+        """
+        fengs = list(self.fengs if fengs is None else fengs)
+        if nthreads is None:
+            nthreads = self.nthreads
+        if timeout is None:
+            timeout = self.timeout
+        fengs_by_host = {feng.host: feng for feng in fengs}
+        results, errors = helpers.run_threaded(func, fengs, key=lambda feng: feng.host,
+                              nthreads=nthreads, timeout=timeout)
+        for host, err in errors.items():
+            self.logger.error('%s: Board-wide operation failed: %s' % (host, err))
+            self.declare_feng_dead(fengs_by_host[host])
+        return results, errors
+
     def disable_monitoring(self, expiry=60):
         self.r.set('disable_monitoring', 1, ex=expiry)
 
@@ -153,42 +222,48 @@ class HeraCorrelator(object):
     def program(self, bitstream=None):
         progfile = bitstream or self.config['fpgfile']
         self.logger.info('Programming all SNAPs with %s' % progfile)
+        from casperfpga import utils
         utils.program_fpgas([feng.fpga for feng in self.fengs], progfile, timeout=300.0)
+        for feng in self.fengs:
+            feng.invalidate_shadows()
         self.r['corr:snap:last_programmed'] =  time.ctime()
         
     def phase_switch_disable(self):
         self.logger.info('Disabling all phase switches')
-        for feng in self.fengs:
-           for stream in range(feng.phaseswitch.nstreams):
-               feng.phaseswitch.set_walsh(stream, 1, 0, 1) 
+        def _disable(feng):
+            feng.phaseswitch.set_walsh_streams(self._walsh_params(feng, enable=False))
+        self.do_for_all_fengs(_disable)
         self.r['corr:status_phase_switch'] = 'off'
 
     def phase_switch_enable(self):
         self.logger.info('Enabling all phase switches')
-        for feng in self.fengs:
-           for stream in range(feng.phaseswitch.nstreams):
-               #TODO figure out what the patterns should be per antenna
-               feng.phaseswitch.set_walsh(stream, 1, 0, 1) 
+        params = self._walsh_assignments()
+        def _enable(feng):
+            feng.phaseswitch.set_walsh_streams(params[feng.host])
+        self.do_for_all_fengs(_enable)
         self.r['corr:status_phase_switch'] = 'on'
 
     def noise_diode_enable(self):
         self.logger.info('Enabling all noise inputs')
-        for feng in self.fengs:
-           for fem in feng.fems:
-               fem.switch(name='noise')
+        def _enable(feng):
+            for fem in feng.fems:
+                fem.switch(name='noise')
+        self.do_for_all_fengs(_enable)
         self.r['corr:status_noise_diode'] = 'on'
 
     def noise_diode_disable(self):
         self.logger.info('Disabling all noise inputs')
-        for feng in self.fengs:
-           for fem in feng.fems:
-               fem.switch(name='antenna')
+        def _disable(feng):
+            for fem in feng.fems:
+                fem.switch(name='antenna')
+        self.do_for_all_fengs(_disable)
         self.r['corr:status_noise_diode'] = 'off'
 
     def initialize(self):
-        for feng in self.fengs:
+        def _initialize(feng):
             self.logger.info('Initializing %s'%feng.host)
             feng.initialize()
+        self.do_for_all_fengs(_initialize)
         self.noise_diode_disable()
         self.phase_switch_disable()
 
@@ -207,10 +282,10 @@ class HeraCorrelator(object):
             for pol in self.ant_to_snap[ant].keys():
                 host = self.ant_to_snap[ant][pol]['host']
                 if host in self.fengs_by_name:
-                    self.ant_to_snap[ant][pol]['host'] = self.fengs_by_ip[socket.gethostbyname(host)]
+                    self.ant_to_snap[ant][pol]['host'] = self.fengs_by_ip[helpers.gethostbyname(host)]
         # Make the snap->ant dict, but make sure the hostnames match what is expected by this classes Fengines
         for hooked_up_snap in hookup['snap_to_ant'].keys():
-            ip = socket.gethostbyname(hooked_up_snap)
+            ip = helpers.gethostbyname(hooked_up_snap)
             for feng in self.fengs:
                 if feng.ip == ip:
                     self.snap_to_ant[feng.host] = hookup['snap_to_ant'][hooked_up_snap]
@@ -238,37 +313,338 @@ class HeraCorrelator(object):
                     test_passed = False
         return test_passed
 
+    def get_adc_snapshots(self, fengs=None):
+        """
+        Capture the ADC stats and histograms of every input of the boards
+        `fengs` (default: all connected boards), as Input.get_snapshot
+        does. The boards are stepped through their inputs together, so
+        each wait for a histogram to fill is shared by all of them, and
+        the whole array takes as long as a single board.
+        returns: snapshots, errors
+                 Two dictionaries, keyed by hostname. `snapshots` holds record
+                 arrays of ADC_SNAPSHOT_DTYPE, one record per input, and
+                 `errors` the exceptions raised by boards which failed.
+        """
+        if fengs is None:
+            fengs = self.fengs
+        snapshots = {}
+        steps = {}
+        for feng in fengs:
+            snapshots[feng.host] = np.zeros(feng.input.nstreams // 2, dtype=ADC_SNAPSHOT_DTYPE)
+            steps[feng.host] = feng.input.snapshot_steps(snapshots[feng.host])
+        errors = {}
+        def _step(feng):
+            try:
+                return next(steps[feng.host])
+            except StopIteration:
+                return None
+        active = list(fengs)
+        while len(active) > 0:
+            waits, errs = helpers.run_threaded(_step, active, key=lambda feng: feng.host,
+                                               nthreads=self.nthreads, timeout=self.timeout)
+            errors.update(errs)
+            active = [feng for feng in active if waits.get(feng.host) is not None]
+            if len(active) > 0:
+                time.sleep(max([waits[feng.host] for feng in active]))
+        for host in errors.keys():
+            snapshots.pop(host)
+        return snapshots, errors
+
+    def _get_slot_plan(self):
+        """
+        Work out the X-engine slot assignments from the configuration.
+        See `get_slot_plan`.
+        returns: slot plan, or None if the configuration is invalid.
+        """
+        try:
+            return get_slot_plan(self.config)
+        except ValueError as e:
+            self.logger.error(str(e))
+            return None
+
+    def _get_source_ports(self):
+        dest_port = self.config['dest_port'] 
+        # if the user hasn't specified a source port, auto increment mod 4
+        source_ports = {}
+        for fn, feng in enumerate(self.fengs):
+            source_ports[feng.host] = self.config['fengines'][feng.host].get('source_port', dest_port + (fn%4))
+        return source_ports
+
     def configure_freq_slots(self):
         n_xengs = self.config.get('n_xengs', 16)
         chans_per_packet = self.config.get('chans_per_packet', 384) # Hardcoded in firmware
         self.logger.info('Configuring frequency slots for %d X-engines, %d channels per packet' % (n_xengs, chans_per_packet))
         dest_port = self.config['dest_port'] 
-        for fn, feng in enumerate(self.fengs):
+        slots = self._get_slot_plan()
+        if slots is None:
+            return False
+        for xn, chans, ip_even, ip_odd, xparams in slots:
+            self.r.hset("corr:xeng_chans", xn, json.dumps(chans))
+        source_ports = self._get_source_ports()
+
+        def _configure(feng):
             # Update redis to reflect current assignments
             self.r.hset("corr:snap_ants", feng.host, json.dumps(feng.ant_indices))
-            # if the user hasn't specified a source port, auto increment mod 4
-            source_port = self.config['fengines'][feng.host].get('source_port', dest_port + (fn%4))
-            for xn, xparams in self.config['xengines'].items():
-                chan_range = xparams.get('chan_range', [xn*384, (xn+1)*384])
-                chans = range(chan_range[0], chan_range[1])
-                self.r.hset("corr:xeng_chans", xn, json.dumps(chans))
-                if (xn > n_xengs): 
-                   self.logger.error("Cannot have more than %d X-engs!!" % n_xengs)
-                   return False
+            slot_map = {}
+            arp = {}
+            for xn, chans, ip_even, ip_odd, xparams in slots:
                 self.logger.info('%s: Setting Xengine %d: chans %d-%d: %s (even) / %s (odd)' % (feng.fpga.host, xn, chans[0], chans[-1], xparams['even']['ip'], xparams['odd']['ip']))
-                ip = [int(i) for i in xparams['even']['ip'].split('.')]
-                ip_even = (ip[0]<<24) + (ip[1]<<16) + (ip[2]<<8) + ip[3]
-                ip = [int(i) for i in xparams['odd']['ip'].split('.')]
-                ip_odd = (ip[0]<<24) + (ip[1]<<16) + (ip[2]<<8) + ip[3]
-                feng.packetizer.assign_slot(xn, chans, [ip_even,ip_odd], feng.reorder, feng.ant_indices[0])
-                feng.eth.add_arp_entry(ip_even,xparams['even']['mac'])
-                feng.eth.add_arp_entry(ip_odd,xparams['odd']['mac'])
-            feng.eth.set_source_port(source_port)
+                slot_map[xn] = (chans, [ip_even,ip_odd])
+                arp[ip_even] = xparams['even']['mac']
+                arp[ip_odd] = xparams['odd']['mac']
+            # Program all the slots, and the ARP table, with a few bulk transfers
+            feng.packetizer.assign_slots(slot_map, feng.reorder, feng.ant_indices[0])
+            feng.eth.add_arp_entries(arp)
+            feng.eth.set_source_port(source_ports[feng.host])
             feng.eth.set_port(dest_port)
+        self.do_for_all_fengs(_configure)
         return True
 
-    def resync(self, manual=False):
+    def _walsh_assignments(self):
+        """
+        Give every antenna in the array its own walsh function, shared by both
+        its polarizations. Antennas are taken from the hookup, or if there
+        isn't one, from the antenna indices of the configuration. Walsh
+        function 0, which never switches, is left for inputs with no antenna.
+        The shortest walsh step is 2**`walsh_stepperiod` (from the
+        configuration, default 1) BRAM steps.
+        returns: dictionary of {hostname: [(N, n, stepperiod) for each stream]}
+        """
+        stepperiod = self.config.get('walsh_stepperiod', 1)
+        ant_to_snap = getattr(self, 'ant_to_snap', None)
+        stream_ants = {}
+        for feng in self.fengs:
+            nstreams = feng.phaseswitch.nstreams
+            if ant_to_snap is None:
+                stream_ants[feng.host] = [feng.ant_indices[stream // 2] for stream in range(nstreams)]
+            else:
+                stream_ants[feng.host] = [None] * nstreams
+        if ant_to_snap is not None:
+            for ant, antval in ant_to_snap.iteritems():
+                for pol, polval in antval.iteritems():
+                    # Boards we aren't connected to are left as hostnames by compute_hookup
+                    if isinstance(polval['host'], basestring):
+                        continue
+                    ants = stream_ants.get(polval['host'].host)
+                    if ants is not None and 0 <= polval['channel'] < len(ants):
+                        ants[polval['channel']] = ant
+        all_ants = sorted(set([ant for ants in stream_ants.values() for ant in ants if ant is not None]))
+        walsh_index = dict([(ant, i + 1) for i, ant in enumerate(all_ants)])
+        N = int(2**np.ceil(np.log2(len(all_ants) + 1)))
+        params = {}
+        for host, ants in stream_ants.items():
+            params[host] = [(1, 0, stepperiod) if ant is None else (N, walsh_index[ant], stepperiod)
+                            for ant in ants]
+        return params
+
+    def _walsh_params(self, feng, enable=True):
+        """
+        The walsh function parameters, (N, n, stepperiod), for each
+        stream of board `feng`, with phase switching enabled or disabled.
+        """
+        if enable:
+            return self._walsh_assignments()[feng.host]
+        return [(1, 0, 1)] * feng.phaseswitch.nstreams
+
+    def get_target_images(self, feng, slots):
+        """
+        Compute the memory contents the configuration requires of board `feng`.
+        slots: X-engine slot assignments, as returned by `_get_slot_plan`.
+        The channel reorder map, packetizer tables and ARP table are always
+        included. EQ coefficients are only included if the configuration has
+        an `eq_coeffs` entry (globally, or for this board), and phase switch
+        patterns if it has a `phase_switch` entry.
+        returns: dictionary of {(block, register name): (byte offset, data string)}
+        """
+        images = {}
+        fconfig = self.config['fengines'].get(feng.host) or {}
+
+        # Packetizer tables and reorder map, starting from their initialized state
+        ntable = feng.packetizer.n_time_demux * feng.packetizer.n_slots
+        ips = np.zeros(ntable, dtype='>u4')
+        ants = np.zeros(ntable, dtype='>u4')
+        chans_hdr = np.zeros(ntable, dtype='>u4')
+        reorder = np.arange(feng.reorder.nchans, dtype='>u4')
+        # Only the X-engines' entries of the ARP table are set. The rest are left as they are
+        arp = np.fromstring(feng.eth.read_image('sw', 256*8, offset=0x3000), dtype='>u8').copy()
+        slot_map = {}
+        for xn, chans, ip_even, ip_odd, xparams in slots:
+            slot_map[xn] = (chans, [ip_even, ip_odd])
+            arp[ip_even % 256] = xparams['even']['mac']
+            arp[ip_odd % 256] = xparams['odd']['mac']
+        feng.packetizer.fill_slot_tables(slot_map, feng.ant_indices[0], ips, ants, chans_hdr, reorder)
+        images[(feng.packetizer, 'ips')] = (0, ips.tostring())
+        images[(feng.packetizer, 'ants')] = (0, ants.tostring())
+        images[(feng.packetizer, 'chans')] = (0, chans_hdr.tostring())
+        images[(feng.reorder, 'reorder3_map1')] = (0, reorder.tostring())
+        images[(feng.eth, 'sw')] = (0x3000, arp.tostring())
+
+        eq_coeffs = fconfig.get('eq_coeffs', self.config.get('eq_coeffs', None))
+        if eq_coeffs is not None:
+            coeffs = np.ones(feng.eq.ncoeffs) * eq_coeffs
+            images[(feng.eq, 'coeffs')] = (0, feng.eq.pack_coeffs(coeffs) * feng.eq.nstreams)
+
+        phase_switch = fconfig.get('phase_switch', self.config.get('phase_switch', None))
+        if phase_switch is not None:
+            ps = feng.phaseswitch
+            blank = '\x00' * ps.depth
+            mod, demod = ps.walsh_images(self._walsh_params(feng, enable=phase_switch), blank, blank)
+            images[(ps, 'gpio_switch_states')] = (0, mod)
+            images[(ps, 'sw_switch_states')] = (0, demod)
+        return images
+
+    def apply_config(self, dry_run=False):
+        """
+        Bring every board into line with the configuration, writing only
+        the parts of its channel reorder map, packetizer tables, ARP table,
+        and (if configured) EQ coefficients and phase switch patterns,
+        which differ from what it already holds. Memories are read back the
+        first time they are checked, and cached afterwards. Also sets the
+        Ethernet ports, as `configure_freq_slots` does.
+        dry_run: Only find the differences, don't write anything.
+        returns: dictionary of {hostname: {register name: number of bytes which differ}},
+                 or None if the configuration is invalid.
+        """
+        slots = self._get_slot_plan()
+        if slots is None:
+            return None
+        dest_port = self.config['dest_port'] 
+        source_ports = self._get_source_ports()
+        if not dry_run:
+            for xn, chans, ip_even, ip_odd, xparams in slots:
+                self.r.hset("corr:xeng_chans", xn, json.dumps(chans))
+
+        def _apply(feng):
+            diff = {}
+            for (block, reg), (offset, data) in self.get_target_images(feng, slots).items():
+                regions = block.write_image(reg, data, offset=offset, dry_run=dry_run)
+                if len(regions) > 0:
+                    diff[block.prefix + reg] = sum([nbytes for start, nbytes in regions])
+            if not dry_run:
+                self.r.hset("corr:snap_ants", feng.host, json.dumps(feng.ant_indices))
+                feng.eth.set_source_port(source_ports[feng.host])
+                feng.eth.set_port(dest_port)
+            return diff
+        diffs, errors = self.do_for_all_fengs(_apply)
+
+        for host, diff in sorted(diffs.items()):
+            if len(diff) == 0:
+                self.logger.info('%s: Configuration already up to date' % host)
+            else:
+                self.logger.info('%s: %s %s' % (host, 'Would change' if dry_run else 'Changed',
+                    ', '.join(['%s (%d bytes)' % (reg, n) for reg, n in sorted(diff.items())])))
+        return diffs
+
+    def _staged_arm(self, offset):
+        """
+        Pulse bit `offset` of every board's sync arm register as soon
+        as possible after the next PPS.
+        All register values are computed, and every board's arm bit is
+        set low, before waiting for the PPS. Each board then gets its own
+        thread, which waits for the PPS and then performs two writes.
+        returns: pps_time, arm_times
+                 The time the PPS was detected, and a dictionary of
+                 {hostname: time the arm bit was set}
+        """
+        def _stage(feng):
+            low, high = feng.sync.get_arm_words(offset)
+            feng.sync.write_int('arm', low)
+            return low, high
+        words, errors = self.do_for_all_fengs(_stage)
+
+        go = threading.Event()
+        abort = threading.Event()
+        def _arm(feng):
+            low, high = words[feng.host]
+            go.wait()
+            if abort.is_set():
+                return None
+            # Verifying the writes would put a read back in the window after the PPS
+            feng.sync.write_int('arm', high, blindwrite=True)
+            arm_time = time.time()
+            feng.sync.write_int('arm', low, blindwrite=True)
+            return arm_time
+        fengs = [feng for feng in self.fengs if feng.host in words]
+        out = {}
+        def _run():
+            out['arm_times'], out['errors'] = self.do_for_all_fengs(_arm, fengs=fengs,
+                                                  nthreads=max(len(fengs), 1))
+        runner = threading.Thread(target=_run)
+        runner.daemon = True
+        runner.start()
+
+        try:
+            self.logger.info('Waiting for PPS at time %.2f' % time.time())
+            self.fengs[0].sync.wait_for_sync()
+            pps_time = time.time()
+            self.logger.info('Sync passed at time %.2f' % pps_time)
+        except:
+            # Release the boards' threads without arming them
+            abort.set()
+            raise
+        finally:
+            go.set()
+            runner.join()
+        return pps_time, out['arm_times']
+
+    def _check_arm_times(self, pps_time, arm_times):
+        """
+        Log how long after the PPS each board was armed.
+        returns: list of hostnames which were armed too late to catch
+                 the same PPS edge as the rest of the array.
+        """
+        late = []
+        for host, arm_time in sorted(arm_times.items()):
+            self.logger.debug('%s: armed %.3f seconds after PPS' % (host, arm_time - pps_time))
+            if arm_time - pps_time >= 1.0:
+                self.logger.error('%s: armed %.3f seconds after PPS and missed the sync edge' % (host, arm_time - pps_time))
+                late += [host]
+        if len(arm_times) > 0:
+            self.logger.info('Arming took %.3f seconds' % (max(arm_times.values()) - pps_time))
+        return late
+
+    def check_sync(self):
+        """
+        Check that every board was synchronized by the same PPS edge.
+        Reads the sync count and uptime of all boards just after a PPS,
+        and compares them with the value most boards agree on.
+        returns: list of hostnames which disagree with the majority
+        """
+        self.fengs[0].sync.wait_for_sync()
+        stats, errors = self.do_for_all_fengs(lambda feng: feng.sync.read_uints(['count', 'uptime']))
+        bad = []
+        for reg in ['count', 'uptime']:
+            vals = [stat[reg] for stat in stats.values()]
+            if len(vals) == 0:
+                continue
+            expected = max(set(vals), key=vals.count)
+            for host, stat in sorted(stats.items()):
+                if stat[reg] != expected:
+                    self.logger.error('%s: sync %s is %d, but most boards have %d' % (host, reg, stat[reg], expected))
+                    if host not in bad:
+                        bad += [host]
+        if len(bad) == 0:
+            self.logger.info('All %d boards agree on sync count and uptime' % len(stats))
+        return bad
+
+    def resync(self, manual=False, staged=False):
+        """
+        Sync all F-engines from the next PPS (or a software trigger if `manual`).
+        If `staged`, arm all boards concurrently, using precomputed register values,
+        then check every board caught the same PPS edge.
+        returns: list of hostnames of boards which missed the sync edge
+                 (only checked if `staged`)
+        """
         self.logger.info('Sync-ing Fengines')
+        if staged and not manual:
+            pps_time, arm_times = self._staged_arm(self.fengs[0].sync.OFFSET_ARM_SYNC)
+            late = self._check_arm_times(pps_time, arm_times)
+            sync_time = int(pps_time) + 1 + 3 # Takes 3 PPS pulses to arm
+            self.r['corr:feng_sync_time'] = sync_time
+            self.r['corr:feng_sync_time_str'] = time.ctime(sync_time)
+            # Wait for the sync to have happened before checking the counters
+            time.sleep(max(0, sync_time + 1 - time.time()))
+            return sorted(set(late + self.check_sync()))
         if not manual:
             self.logger.info('Waiting for PPS at time %.2f' % time.time())
             self.fengs[0].sync.wait_for_sync()
@@ -290,9 +666,19 @@ class HeraCorrelator(object):
         self.logger.info('Syncing took %.2f seconds' % (after_sync - before_sync))
         if after_sync - before_sync > 0.5:
             self.logger.warning("It took longer than expected to arm sync!")
+        return []
 
-    def sync_noise(self, manual=False):
+    def sync_noise(self, manual=False, staged=False):
+        """
+        Sync all noise generators from the next PPS (or a software trigger if `manual`).
+        If `staged`, arm all boards concurrently, using precomputed register values.
+        returns: list of hostnames of boards which were armed too late
+                 (only checked if `staged`)
+        """
         self.logger.info('Sync-ing noise generators')
+        if staged and not manual:
+            pps_time, arm_times = self._staged_arm(self.fengs[0].sync.OFFSET_ARM_NOISE)
+            return self._check_arm_times(pps_time, arm_times)
         if not manual:
             self.logger.info('Waiting for PPS at time %.2f' % time.time())
             self.fengs[0].sync.wait_for_sync()
@@ -310,13 +696,12 @@ class HeraCorrelator(object):
         self.logger.info('Syncing took %.2f seconds' % (after_sync - before_sync))
         if after_sync - before_sync > 0.5:
             self.logger.warning("It took longer than expected to arm sync!")
+        return []
 
     def enable_output(self):
         self.logger.info('Enabling ethernet output')
-        for feng in self.fengs:
-            feng.eth.enable_tx()
+        self.do_for_all_fengs(lambda feng: feng.eth.enable_tx())
 
     def disable_output(self):
         self.logger.info('Disabling ethernet output')
-        for feng in self.fengs:
-            feng.eth.disable_tx()
+        self.do_for_all_fengs(lambda feng: feng.eth.disable_tx())
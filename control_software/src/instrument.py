@@ -0,0 +1,329 @@
+"""
+Optional instrumentation of the register accesses made by Blocks.
+
+When enabled, every read and write a Block makes is counted, and its
+latency and size added to histograms, per board, block, register and
+kind ('read' or 'write'). Open traces (see `trace`) also attribute the
+accesses to the high-level operation they were made for, and can keep a
+log of each one. Everything can be exported as JSON, to a file or to
+redis, for the monitor to publish.
+
+Disabled, which is the default, an access costs one extra function call
+and a check of `ENABLED`.
+
+    instrument.enable()
+    with instrument.trace('configure_freq_slots') as t:
+        corr.configure_freq_slots()
+    print t.summary()
+    instrument.export_redis(corr.r, 'hera_snap_feng_init.py')
+"""
+import os
+import json
+import math
+import time
+import socket
+import threading
+
+# Whether Block accesses are recorded. Use `enable` and `disable`
+# to change it, which keep it on while any trace is open.
+ENABLED = False
+NBINS = 32
+
+_lock = threading.Lock()
+_forced = False
+_traces = []
+
+class Histogram(object):
+    """
+    Counts of values in power-of-two bins. Bin 0 holds values below 1,
+    and bin i values from 2**(i-1) up to 2**i, with the last bin also
+    holding anything larger.
+    """
+    def __init__(self, nbins=NBINS):
+        self.counts = [0] * nbins
+        self.n = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+        i = 0 if value < 1 else min(math.frexp(value)[1], len(self.counts) - 1)
+        self.counts[i] += 1
+        self.n += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.n += other.n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """
+        returns: upper edge of the bin holding the `q`th percentile, or 0 if empty
+        """
+        if self.n == 0:
+            return 0
+        target = self.n * q / 100.
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(2**i, self.max)
+        return self.max
+
+    def to_dict(self):
+        nbins = len(self.counts)
+        while nbins > 0 and self.counts[nbins - 1] == 0:
+            nbins -= 1
+        return {'n' : self.n, 'total' : self.total, 'max' : self.max,
+                'p50' : self.percentile(50), 'p99' : self.percentile(99),
+                'counts' : self.counts[:nbins]}
+
+class AccessStats(object):
+    """
+    Statistics of the accesses to one register: their number, the
+    number which raised an exception, and histograms of their latency
+    (in microseconds) and size (in bytes).
+    """
+    def __init__(self):
+        self.errors = 0
+        self.latency = Histogram()
+        self.bytes = Histogram()
+
+    def add(self, nbytes, latency, error=False):
+        self.latency.add(latency * 1e6)
+        self.bytes.add(nbytes)
+        if error:
+            self.errors += 1
+
+    def merge(self, other):
+        self.errors += other.errors
+        self.latency.merge(other.latency)
+        self.bytes.merge(other.bytes)
+
+    def to_dict(self):
+        return {'count' : self.latency.n, 'errors' : self.errors,
+                'latency_us' : self.latency.to_dict(), 'bytes' : self.bytes.to_dict()}
+
+class Recorder(object):
+    """
+    AccessStats of every register accessed, keyed by
+    (board hostname, block name, register name, kind).
+    """
+    def __init__(self):
+        self.registers = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, nbytes, latency, error=False):
+        with self.lock:
+            stats = self.registers.get(key)
+            if stats is None:
+                stats = self.registers[key] = AccessStats()
+            stats.add(nbytes, latency, error)
+
+    def reset(self):
+        with self.lock:
+            self.registers = {}
+
+    def by_block(self):
+        """
+        returns: dictionary of {(hostname, block name, kind): AccessStats}
+                 of all the registers of each block
+        """
+        blocks = {}
+        with self.lock:
+            for (host, block, reg, kind), stats in self.registers.items():
+                blocks.setdefault((host, block, kind), AccessStats()).merge(stats)
+        return blocks
+
+    def totals(self):
+        """
+        returns: AccessStats of every access
+        """
+        total = AccessStats()
+        with self.lock:
+            for stats in self.registers.values():
+                total.merge(stats)
+        return total
+
+    def to_dict(self):
+        with self.lock:
+            registers = sorted(self.registers.items())
+        records = []
+        for (host, block, reg, kind), stats in registers:
+            record = stats.to_dict()
+            record.update({'host' : host, 'block' : block, 'reg' : reg, 'kind' : kind})
+            records += [record]
+        return {'registers' : records}
+
+class Trace(Recorder):
+    """
+    The accesses made while a `trace` is open, by any thread, as the
+    board-wide operations of HeraCorrelator use one thread per board.
+    Traces can be nested, in which case accesses count towards all of
+    the traces open.
+
+    log: If True, also keep a list of every access in `events`, as
+         (unix time, thread name, hostname, block, register, kind,
+         bytes, latency in seconds) tuples, up to `maxlog` of them.
+    """
+    def __init__(self, name, log=False, maxlog=100000):
+        super(Trace, self).__init__()
+        self.name = name
+        self.log = log
+        self.maxlog = maxlog
+        self.events = []
+        self.start = None
+        self.elapsed = None
+
+    def add(self, key, nbytes, latency, error=False):
+        super(Trace, self).add(key, nbytes, latency, error)
+        if self.log and len(self.events) < self.maxlog:
+            self.events.append((time.time(), threading.current_thread().name) + key + (nbytes, latency))
+
+    def __enter__(self):
+        self.start = time.time()
+        _open_trace(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _close_trace(self)
+        self.elapsed = time.time() - self.start
+
+    def summary(self):
+        """
+        returns: dictionary of the trace's name, seconds elapsed, and the
+                 number, bytes and total latency of the accesses made
+        """
+        total = self.totals()
+        return {'name' : self.name, 'elapsed' : self.elapsed, 'count' : total.latency.n,
+                'errors' : total.errors, 'bytes' : total.bytes.total,
+                'latency' : total.latency.total / 1e6}
+
+    def to_dict(self):
+        rv = super(Trace, self).to_dict()
+        rv.update(self.summary())
+        if self.log:
+            rv['events'] = self.events
+        return rv
+
+# Every access made while enabled
+RECORDER = Recorder()
+
+def _update():
+    global ENABLED
+    ENABLED = _forced or len(_traces) > 0
+
+def enable():
+    """
+    Start recording Block accesses.
+    """
+    global _forced
+    with _lock:
+        _forced = True
+        _update()
+
+def disable():
+    """
+    Stop recording Block accesses, other than in open traces.
+    """
+    global _forced
+    with _lock:
+        _forced = False
+        _update()
+
+def _open_trace(t):
+    global _traces
+    with _lock:
+        _traces = _traces + [t]
+        _update()
+
+def _close_trace(t):
+    global _traces
+    with _lock:
+        _traces = [tr for tr in _traces if tr is not t]
+        _update()
+
+def trace(name, log=False, maxlog=100000):
+    """
+    A context manager which records the Block accesses made inside it,
+    even if instrumentation isn't otherwise enabled. See `Trace`.
+    returns: Trace
+    """
+    return Trace(name, log=log, maxlog=maxlog)
+
+def record(block, reg, kind, nbytes, latency, error=False):
+    """
+    Record an access of `nbytes` to register `reg` of Block `block`,
+    which took `latency` seconds. Accesses to several registers at once
+    are recorded with `reg` '*'.
+    """
+    if not isinstance(reg, basestring):
+        reg = '*'
+    key = (getattr(block.host, 'host', None), block.name, reg, kind)
+    if _forced:
+        RECORDER.add(key, nbytes, latency, error)
+    for t in _traces:
+        t.add(key, nbytes, latency, error)
+
+def instrumented(kind, size=None):
+    """
+    Decorate a Block method of the form `method(self, reg, *args, **kwargs)`,
+    which accesses register `reg` of the block, so that calls are recorded
+    while instrumentation is enabled.
+    kind: 'read' or 'write'
+    size: Function of (args, return value) returning the number of bytes
+          accessed. Default: 4
+    """
+    def decorate(method):
+        def wrapper(self, reg, *args, **kwargs):
+            if not ENABLED:
+                return method(self, reg, *args, **kwargs)
+            t0 = time.time()
+            try:
+                rv = method(self, reg, *args, **kwargs)
+            except:
+                record(self, reg, kind, 0, time.time() - t0, error=True)
+                raise
+            record(self, reg, kind, 4 if size is None else size(args, rv), time.time() - t0)
+            return rv
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+    return decorate
+
+def reset():
+    """
+    Forget everything recorded outside of traces.
+    """
+    RECORDER.reset()
+
+def to_dict(recorder=None):
+    """
+    returns: JSON-serializable dictionary of everything recorded by
+             `recorder` (default: everything recorded while enabled),
+             with the machine, process and time it was taken at
+    """
+    rv = (recorder or RECORDER).to_dict()
+    rv.update({'hostname' : socket.gethostname(), 'pid' : os.getpid(), 'time' : time.time()})
+    return rv
+
+def export_file(path, recorder=None):
+    """
+    Write the output of `to_dict` to file `path`, as JSON.
+    """
+    # Write atomically, so readers never see half of it
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump(to_dict(recorder), fh)
+    os.rename(tmp, path)
+
+def export_redis(r, name, recorder=None, key='status:instrumentation'):
+    """
+    Store the output of `to_dict`, as JSON, in field `name` (eg. the
+    name of the script) of redis hash `key`, using redis connection `r`.
+    """
+    r.hset(key, name, json.dumps(to_dict(recorder)))
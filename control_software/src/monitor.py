@@ -0,0 +1,164 @@
+"""
+Gathering of the monitoring data of SNAP boards, as polled by
+hera_snap_redis_monitor.py.
+"""
+import time
+import datetime
+import numpy as np
+import helpers
+import redis_codec
+from blocks import ADC_HIST_BINS
+from poco import BASELINES
+
+def get_fpga_stats(feng):
+    """
+    Get FPGA stats.
+    returns: Dictionary of stats
+    """
+    stat = {}
+    stat['temp'] = feng.fpga.transport.get_temp()
+    stat['timestamp'] = datetime.datetime.now().isoformat()
+    regs = feng.read_uints(['sync_uptime', 'sync_count', 'pmbus_alert'])
+    stat['uptime'] = regs['sync_uptime']
+    stat['pps_count'] = regs['sync_count']
+    stat['serial'] = feng.serial
+    stat['pmb_alert'] = regs['pmbus_alert']
+    return stat
+
+def get_poco_output(feng, baseline, int_time, timeout=None):
+    """
+    Get pocket correlator output of one baseline of a board.
+    Params:  feng: SnapFengine object that maps to a SNAP board
+             baseline: Pair of the board's antennas (0-2) to correlate
+             int_time: Integration time, in seconds
+             timeout: Seconds all the waits for accumulations may take.
+                      Default: forever.
+    Returns: Dict: {'data':shape(pols, fqs), 
+                    'times':list of unix times}
+    """
+    corr = feng.corr
+    acc_len = int(int_time * 250e6 / (8192 * corr.spec_per_acc))
+    if acc_len != corr.get_acc_len() // 8192:
+        corr.set_acc_len(acc_len)
+    else:
+        corr.acc_len = acc_len
+    deadline = None if timeout is None else time.time() + timeout
+    remaining = lambda: None if deadline is None else deadline - time.time()
+
+    ant1, ant2 = baseline[0] * 2, baseline[1] * 2
+    xcorr = np.empty((4, corr.nchans), dtype=np.complex128); times = np.empty(4)
+    for i in range(4):
+        pol1, pol2 = ant1+i%2, (ant2+(i//2+i%2)%2)
+        corr.set_input(pol1, pol2)
+        # The accumulation in progress has some of the last inputs in it
+        cnt = corr.wait_for_new_acc(corr.read_uint('acc_cnt'), timeout=remaining())
+        corr.wait_for_new_acc(cnt, timeout=remaining())
+        corr.normalize(corr.read_dout(out=xcorr[i]), auto=(pol1 == pol2))
+        times[i] = time.time()
+    return {'data':xcorr, 'times':times}
+
+def poll_poco(corr, r, hosts=None):
+    """
+    Take the pocket correlator output of the next baseline, in the cycle
+    kept in redis hash 'poco', from all boards at once, and upload it to
+    hash 'poco:<hostname>'. The integration time is also read from 'poco'.
+    Each board has `corr.timeout` seconds for its accumulations.
+    corr: HeraCorrelator
+    r: redis connection
+    hosts: boards to correlate. Default: all
+    returns: dictionary of {hostname: exception} of boards which failed
+    """
+    int_time = float(r.hget('poco', 'integration_time'))
+    # Every board correlates the same baseline, which moves on once per call
+    pair = (int(r.hget('poco', 'ant1')), int(r.hget('poco', 'ant2')))
+    ant1, ant2 = BASELINES[(BASELINES.index(pair) + 1) % len(BASELINES)]
+    r.hmset('poco', {'ant1' : ant1, 'ant2' : ant2})
+
+    fengs = [feng for feng in corr.fengs if hosts is None or feng.host in hosts]
+    outputs, errors = helpers.run_threaded(
+            lambda feng: get_poco_output(feng, (ant1, ant2), int_time, timeout=corr.timeout),
+            fengs, key=lambda feng: feng.host, nthreads=corr.nthreads, timeout=corr.timeout)
+    pipe = r.pipeline(transaction=False)
+    for host, output in outputs.iteritems():
+        # to unpack: xcorr, t = redis_codec.hget_array(r, 'poco:%s' % host, 'corr')
+        pipe.hmset('poco:%s' % host, {
+            'ant1' : ant1,
+            'ant2' : ant2,
+            'corr' : redis_codec.encode(output['data'], timestamp=output['times'][0]),
+            'times' : redis_codec.encode(output['times'], timestamp=output['times'][0]),
+        })
+    pipe.execute()
+    return errors
+
+def get_board_inputs(corr):
+    """
+    Group the antenna-pols in the hookup by the board which digitizes them.
+    returns: dictionary of {hostname: [(ant, pol, input number), ...]}
+    """
+    inputs = {}
+    for ant, antval in corr.ant_to_snap.iteritems():
+        for pol, polval in antval.iteritems():
+            # Boards we aren't connected to are left as hostnames by compute_hookup
+            if isinstance(polval['host'], basestring):
+                continue
+            inputs.setdefault(polval['host'].host, []).append((ant, pol, polval['channel']))
+    return inputs
+
+def get_board_status(feng, inputs, snapshot=None):
+    """
+    Gather all the monitoring data from one board.
+    inputs: list of (ant, pol, input number) hooked up to this board.
+    snapshot: The board's ADC snapshot (see Input.get_snapshot), which
+              is split up by antenna. If None, only the FPGA stats are gathered.
+    returns: dictionary of {redis key: {field: value}}
+    """
+    status = {}
+    status["status:snap:%s" % feng.host] = get_fpga_stats(feng)
+    if snapshot is not None:
+        # Stats and histograms of all the board's inputs, in one binary encoded record array
+        status["status:snap:%s" % feng.host]['adc_snapshot'] = redis_codec.encode(snapshot, compress=True)
+        for ant, pol, chan in inputs:
+            stats = snapshot[chan]
+            status['status:ant:%s:%s' % (ant, pol)] = {
+                'f_host' : feng.host,
+                'host_ant_id' : chan,
+                'adc_mean' : float(stats['mean']),
+                'adc_power' : float(stats['power']),
+                'adc_rms' : float(stats['rms']),
+                # [bins, counts], as a binary encoded (2, 256) array. See redis_codec
+                'histogram' : redis_codec.encode(np.array([ADC_HIST_BINS, stats['histogram']], dtype=np.int32),
+                                                 timestamp=stats['time'], compress=True),
+                'timestamp' : datetime.datetime.fromtimestamp(stats['time']).isoformat(),
+            }
+    return status
+
+def poll_boards(corr, inputs):
+    """
+    Poll all the boards of HeraCorrelator `corr` which have inputs hooked
+    up at once. The ADC snapshots of all boards are taken together, to
+    share the waits for the histograms.
+    inputs: dictionary of {hostname: [(ant, pol, input number), ...]},
+            as returned by `get_board_inputs`.
+    returns: status, errors
+             Two dictionaries, keyed by hostname. `status` holds the output of
+             `get_board_status`, and `errors` the exceptions raised by boards
+             which failed.
+    """
+    snapshots, errors = corr.get_adc_snapshots([feng for feng in corr.fengs if feng.host in inputs])
+    status, board_errors = helpers.run_threaded(
+            lambda feng: get_board_status(feng, inputs.get(feng.host, []), snapshots.get(feng.host)),
+            [feng for feng in corr.fengs if feng.host not in errors],
+            key=lambda feng: feng.host, nthreads=corr.nthreads, timeout=corr.timeout)
+    errors.update(board_errors)
+    return status, errors
+
+def upload_status(r, status):
+    """
+    Upload the board status `status`, as returned by `poll_boards`,
+    to redis connection `r`, with a single round trip.
+    """
+    pipe = r.pipeline(transaction=False)
+    for host, board_status in status.iteritems():
+        for key, val in board_status.iteritems():
+            pipe.hmset(key, val)
+    pipe.execute()
@@ -0,0 +1,457 @@
+"""
+Receive and check F-engine packets at line rate.
+
+Packets are received in batches (with recvmmsg where the C library
+has it, otherwise one recv_into per packet) directly into a preallocated
+ring buffer, and are decoded and checked a whole batch at a time with
+numpy, rather than one packet at a time in Python.
+"""
+import socket
+import select
+import errno
+import ctypes
+import ctypes.util
+import logging
+import multiprocessing
+import signal
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+NANTS_PER_PKT = 3
+CHANS_PER_PKT = 384
+NSAMP_PER_PKT = 2
+NPOL = 2
+PAYLOAD_BYTES = NANTS_PER_PKT * CHANS_PER_PKT * NSAMP_PER_PKT * NPOL
+HEADER_BYTES = 8
+PACKET_BYTES = HEADER_BYTES + PAYLOAD_BYTES
+
+# One F-engine packet. The 64-bit header is time<<29 | chan<<16 | ant
+PACKET_DTYPE = np.dtype([('header', '>u8'), ('payload', 'u1', (PAYLOAD_BYTES,))])
+
+TVG_MODES = ['const_ants', 'const_pols', 'ramp_ants', 'ramp_pols']
+
+def decode_headers(pkts):
+    """
+    Decode the headers of an array of packets (with dtype PACKET_DTYPE).
+    returns: time, chan, ant arrays (of int64)
+    """
+    header = pkts['header'].astype(np.int64)
+    time = header >> 29
+    chan = (header >> 16) & (2**13 - 1)
+    ant = header & 0xffff
+    return time, chan, ant
+
+def payload_view(pkts):
+    """
+    View the payloads of an array of packets as an
+    (npackets, ants, chans, samples, pols) array.
+    """
+    return pkts['payload'].reshape(-1, NANTS_PER_PKT, CHANS_PER_PKT, NSAMP_PER_PKT, NPOL)
+
+def tvg_pattern(mode, nstreams=6, nchans=2**13):
+    """
+    The test vector an F-engine's EqTvg block holds in the mode `mode`.
+    'const_pols' and 'ramp_pols' are what EqTvg.write_const_ants and
+    EqTvg.write_freq_ramp write, and 'const_ants' and 'ramp_ants' are
+    what they write with equal_pols=True.
+    returns: (nstreams, nchans) array of uint8
+    """
+    if mode not in TVG_MODES:
+        raise ValueError('Unknown test vector mode %s. Choose from %s' % (mode, TVG_MODES))
+    stream_vals = np.arange(nstreams)
+    if mode.endswith('_ants'):
+        stream_vals = stream_vals // 2
+    tv = np.zeros([nstreams, nchans], dtype=np.int) + stream_vals[:, None]
+    if mode.startswith('ramp'):
+        tv += np.arange(nchans)
+    # tvg values are only 8 bits
+    return (tv % 256).astype(np.uint8)
+
+class TvgChecker(object):
+    """
+    Check packet payloads against the test vector of the EqTvg mode `mode`.
+    """
+    def __init__(self, mode, nchans=2**13):
+        self.mode = mode
+        self.nchans = nchans
+        tv = tvg_pattern(mode, nstreams=NANTS_PER_PKT*NPOL, nchans=nchans)
+        # Rearrange as (ant, chan, pol) to match the payload, and extend by
+        # a packet's worth of channels so every packet is a simple slice.
+        tv = tv.reshape(NANTS_PER_PKT, NPOL, nchans).transpose(0, 2, 1)
+        self.tv = np.concatenate([tv, tv[:, :CHANS_PER_PKT]], axis=1)
+        self.chan_offsets = np.arange(CHANS_PER_PKT)
+
+    def expected(self, chans):
+        """
+        The payloads expected for packets starting at channels `chans`.
+        returns: (npackets, ants, chans, 1, pols) array, which broadcasts
+                 against the output of payload_view.
+        """
+        idx = (np.asarray(chans) % self.nchans)[:, None] + self.chan_offsets
+        return self.tv[:, idx, :].transpose(1, 0, 2, 3)[:, :, :, None, :]
+
+    def check(self, pkts):
+        """
+        Compare each packet's payload to the test vector at
+        the channel in its header.
+        returns: boolean array, True for packets which match
+        """
+        if len(pkts) == 0:
+            return np.zeros(0, dtype=np.bool)
+        time, chan, ant = decode_headers(pkts)
+        match = payload_view(pkts) == self.expected(chan)
+        return match.reshape(len(pkts), -1).all(axis=1)
+
+# recvmmsg(2) via ctypes, since the socket module doesn't provide it
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _msghdr), ('msg_len', ctypes.c_uint)]
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _recvmmsg = _libc.recvmmsg
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+except (OSError, AttributeError, TypeError):
+    _recvmmsg = None
+
+# Report the real length of over-sized packets, rather than the truncated one
+_MSG_TRUNC = getattr(socket, 'MSG_TRUNC', 0)
+
+class PacketCapture(object):
+    """
+    Receive F-engine packets sent to `ip`:`port` into a ring buffer
+    of `nslots` packets, up to `batch` packets at a time.
+    rcvbuf: Size of the socket receive buffer to ask for, in bytes.
+    use_recvmmsg: Use the recvmmsg system call, if it is available.
+    sock: An already bound UDP socket to receive from, instead
+          of binding a new one to `ip`:`port`.
+    """
+    def __init__(self, ip, port, nslots=2**14, batch=256, rcvbuf=1024*PACKET_BYTES*128,
+                 use_recvmmsg=True, sock=None):
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+            sock.bind((ip, port))
+        self.sock = sock
+        # Waiting is done with select, so that batches can be
+        # drained without blocking once the first packet is in
+        self.sock.setblocking(False)
+        self.ring = np.zeros(nslots, dtype=PACKET_DTYPE)
+        self._raw = self.ring.view(np.uint8).reshape(nslots, PACKET_BYTES)
+        # Number of bytes received into each slot
+        self.nbytes = np.zeros(nslots, dtype=np.int64)
+        self.batch = min(batch, nslots)
+        self.head = 0
+        self.npkts = 0 # packets received, of any size
+        self.nbad = 0  # packets which weren't PACKET_BYTES long
+        self._msgs = None
+        if use_recvmmsg and _recvmmsg is not None:
+            self._setup_recvmmsg()
+
+    def _setup_recvmmsg(self):
+        nslots = len(self.ring)
+        self._iovs = (_iovec * nslots)()
+        self._msgs = (_mmsghdr * nslots)()
+        base = self._raw.ctypes.data
+        for i in range(nslots):
+            self._iovs[i].iov_base = base + i*PACKET_BYTES
+            self._iovs[i].iov_len = PACKET_BYTES
+            self._msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            self._msgs[i].msg_hdr.msg_iovlen = 1
+        # View the returned lengths as an array, so they can be copied in one go
+        self._msg_lens = np.ndarray(shape=(nslots,), dtype=np.uint32, buffer=self._msgs,
+                                    offset=_mmsghdr.msg_len.offset, strides=(ctypes.sizeof(_mmsghdr),))
+        self._msgs_addr = ctypes.addressof(self._msgs)
+
+    def _recv_mmsg(self, start, n):
+        rv = _recvmmsg(self.sock.fileno(), self._msgs_addr + start*ctypes.sizeof(_mmsghdr), n, _MSG_TRUNC, None)
+        if rv < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise socket.error(err, 'recvmmsg failed')
+        self.nbytes[start:start+rv] = self._msg_lens[start:start+rv]
+        return rv
+
+    def _recv_into(self, start, n):
+        for i in range(n):
+            try:
+                self.nbytes[start+i] = self.sock.recv_into(self._raw[start+i], PACKET_BYTES, _MSG_TRUNC)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return i
+                raise
+        return n
+
+    def recv_batch(self, timeout=None):
+        """
+        Wait up to `timeout` seconds (None: forever) for packets, and
+        receive up to `batch` of those waiting into the ring buffer.
+        returns: array (with dtype PACKET_DTYPE) of the packets received
+                 which had the right size, in arrival order. This is a view
+                 of the ring buffer, so is only valid until the buffer
+                 wraps round to it again, nslots / batch calls later.
+        """
+        if self.head + self.batch > len(self.ring):
+            self.head = 0
+        start = self.head
+        if len(select.select([self.sock], [], [], timeout)[0]) == 0:
+            return self.ring[start:start]
+        if self._msgs is not None:
+            n = self._recv_mmsg(start, self.batch)
+        else:
+            n = self._recv_into(start, self.batch)
+        self.head += n
+        self.npkts += n
+        good = self.nbytes[start:start+n] == PACKET_BYTES
+        ngood = np.count_nonzero(good)
+        if ngood == n:
+            return self.ring[start:start+n]
+        self.nbad += n - ngood
+        return self.ring[start:start+n][good]
+
+    def close(self):
+        self.sock.close()
+
+def reuseport_socket(ip, port, rcvbuf=1024*PACKET_BYTES*128):
+    """
+    A UDP socket bound to `ip`:`port` with SO_REUSEPORT set, so that
+    several processes can bind the same port, and the kernel shares
+    the packets out between them (always giving the packets from one
+    sender to the same socket).
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # SO_REUSEPORT isn't in the Python 2 socket module, even on Linux
+    sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind((ip, port))
+    return sock
+
+class CaptureStats(object):
+    """
+    Packet counters for `nworkers` capture processes, in shared memory.
+    Each worker only ever adds to its own shard of the counters (so no
+    locking is needed), and any process can read the merged totals.
+    Create this before starting the workers, so they inherit it.
+    max_ants: One more than the largest antenna number expected in a header.
+    """
+    # Scalar counters, per worker
+    COUNTERS = ['packets', 'size_errors', 'tvg_errors', 'time_errors', 'lost', 'even', 'odd']
+
+    def __init__(self, nworkers, max_ants=512, nchans=2**13):
+        self.nworkers = nworkers
+        self.max_ants = max_ants
+        self.nchans = nchans
+        self._counters = multiprocessing.RawArray('b', 8 * nworkers * len(self.COUNTERS))
+        self._ants = multiprocessing.RawArray('b', 8 * nworkers * max_ants)
+        self._chans = multiprocessing.RawArray('b', 8 * nworkers * nchans)
+        self._last_time = None
+
+    def _views(self):
+        counters = np.frombuffer(self._counters, dtype=np.int64).reshape(self.nworkers, len(self.COUNTERS))
+        ants = np.frombuffer(self._ants, dtype=np.int64).reshape(self.nworkers, self.max_ants)
+        chans = np.frombuffer(self._chans, dtype=np.int64).reshape(self.nworkers, self.nchans)
+        return counters, ants, chans
+
+    def update(self, worker, pkts, nbad=0, tvg=None):
+        """
+        Add a batch of packets, received by worker number `worker`, to its counters.
+        nbad: Number of packets of the wrong size received with this batch.
+        tvg: TvgChecker to check payloads with, or None not to check them.
+        """
+        counters, ants, chans = [x[worker] for x in self._views()]
+        c = dict([(name, i) for i, name in enumerate(self.COUNTERS)])
+        counters[c['size_errors']] += nbad
+        if len(pkts) == 0:
+            return
+        pkt_time, chan, ant = decode_headers(pkts)
+        counters[c['packets']] += len(pkts)
+        ant = np.clip(ant, 0, self.max_ants - 1)
+        chan = chan % self.nchans
+        ants += np.bincount(ant, minlength=self.max_ants)
+        chans += np.bincount(chan, minlength=self.nchans)
+        # Even and odd banks of X-engines get alternate blocks of samples
+        bank = (pkt_time // NSAMP_PER_PKT) % 2
+        nodd = np.count_nonzero(bank)
+        counters[c['odd']] += nodd
+        counters[c['even']] += len(pkts) - nodd
+        if tvg is not None:
+            counters[c['tvg_errors']] += len(pkts) - np.count_nonzero(tvg.check(pkts))
+        gaps, lost = self._check_times(pkt_time, bank, ant, chan)
+        counters[c['time_errors']] += gaps
+        counters[c['lost']] += lost
+
+    def _check_times(self, pkt_time, bank, ant, chan):
+        """
+        Check each (bank, antenna, channel) stream's timestamps increase by
+        one packet's worth of samples (per bank) from packet to packet.
+        Only the low 32 bits of the timestamps are kept, which is plenty to
+        measure a gap with, and keeps the table small.
+        returns: number of discontinuities, estimated number of packets lost
+        """
+        if self._last_time is None:
+            # Worker-local, so it is allocated after the workers start.
+            # Timestamps are always even, so all ones means never seen.
+            self._last_time = np.ones(2 * self.max_ants * self.nchans, dtype=np.uint32) * 0xffffffff
+        step = 2 * NSAMP_PER_PKT
+        key = (bank * self.max_ants + ant) * self.nchans + chan
+        order = np.argsort(key, kind='mergesort') # stable, so arrival order is kept
+        key = key[order]
+        t = (pkt_time[order] & 0xffffffff).astype(np.uint32)
+        first = np.ones(len(key), dtype=np.bool)
+        first[1:] = key[1:] != key[:-1]
+        last = np.ones(len(key), dtype=np.bool)
+        last[:-1] = first[1:]
+        prev = np.empty_like(t)
+        prev[1:] = t[:-1]
+        prev[first] = self._last_time[key[first]]
+        self._last_time[key[last]] = t[last]
+        seen = prev != 0xffffffff
+        dt = (t - prev)[seen] # uint32, so this wraps like the timestamps
+        bad = dt != step
+        # Only forward jumps of whole packets are counted as lost packets,
+        # not repeated or out of order timestamps
+        skipped = dt[bad & (dt % step == 0) & (dt < 2**31)].astype(np.int64)
+        lost = (skipped // step - 1).clip(0).sum()
+        return np.count_nonzero(bad), int(lost)
+
+    def totals(self):
+        """
+        Merge the counters of all workers.
+        returns: dictionary of the scalar counters, plus 'ants' and 'chans'
+                 (packets per antenna and per channel) and 'per_worker'
+                 (packets received by each worker)
+        """
+        counters, ants, chans = [x.copy() for x in self._views()]
+        rv = dict(zip(self.COUNTERS, [int(x) for x in counters.sum(axis=0)]))
+        rv['ants'] = ants.sum(axis=0)
+        rv['chans'] = chans.sum(axis=0)
+        rv['per_worker'] = counters[:, self.COUNTERS.index('packets')]
+        return rv
+
+    def reset(self):
+        for x in self._views():
+            x[:] = 0
+
+def _capture_worker(worker, stats, sock, stop, tvg_mode, kwargs):
+    # Ctrl-C goes to the whole process group. Leave it to the parent
+    # to stop the workers, so they finish their batches cleanly.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    cap = PacketCapture(None, None, sock=sock, **kwargs)
+    tvg = None if tvg_mode is None else TvgChecker(tvg_mode, nchans=stats.nchans)
+    nbad = 0
+    while not stop.is_set():
+        pkts = cap.recv_batch(timeout=0.1)
+        stats.update(worker, pkts, nbad=cap.nbad - nbad, tvg=tvg)
+        nbad = cap.nbad
+    cap.close()
+
+class CaptureService(object):
+    """
+    Capture packets on several ports at once, with a pool of processes.
+    ip: Address to bind to.
+    ports: List of ports to capture from, eg. the even and odd X-engine ports.
+    nworkers: Number of processes per port. If more than one, they share
+              the port with SO_REUSEPORT.
+    tvg_mode: EqTvg mode to check payloads against, or None not to check them.
+    Other keyword arguments are passed to each worker's PacketCapture.
+    """
+    def __init__(self, ip, ports, nworkers=1, tvg_mode=None, max_ants=512, nchans=2**13, **kwargs):
+        self.logger = kwargs.pop('logger', logger)
+        self.ip = ip
+        self.ports = list(ports)
+        self.nworkers = nworkers
+        self.tvg_mode = tvg_mode
+        self.kwargs = kwargs
+        self.stats = CaptureStats(len(self.ports) * nworkers, max_ants=max_ants, nchans=nchans)
+        self.stop_event = multiprocessing.Event()
+        self.procs = []
+        self.addresses = []
+
+    def start(self):
+        """
+        Bind the sockets and start the capture processes.
+        Sockets are bound here, rather than by the workers, so packets sent
+        as soon as this returns are captured, and so port 0 can be used
+        to have the OS pick a free port (see `addresses`).
+        """
+        self.stop_event.clear()
+        for port in self.ports:
+            socks = []
+            for i in range(self.nworkers):
+                if self.nworkers == 1:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.kwargs.get('rcvbuf', 1024*PACKET_BYTES*128))
+                    sock.bind((self.ip, port))
+                else:
+                    sock = reuseport_socket(self.ip, port, rcvbuf=self.kwargs.get('rcvbuf', 1024*PACKET_BYTES*128))
+                # Later workers share the port the OS gave the first
+                port = sock.getsockname()[1]
+                socks += [sock]
+            self.addresses += [(self.ip, port)]
+            for sock in socks:
+                p = multiprocessing.Process(target=_capture_worker,
+                        args=(len(self.procs), self.stats, sock, self.stop_event, self.tvg_mode, self.kwargs))
+                p.daemon = True
+                p.start()
+                # The worker has its own copy now
+                sock.close()
+                self.procs += [p]
+        self.logger.info('Started %d capture processes on %s' % (len(self.procs),
+                         ', '.join(['%s:%d' % a for a in self.addresses])))
+
+    def stop(self, timeout=5.0):
+        self.stop_event.set()
+        for p in self.procs:
+            p.join(timeout)
+            if p.is_alive():
+                p.terminate()
+        self.procs = []
+        self.addresses = []
+
+    def report(self):
+        """
+        Log a summary of the merged counters.
+        returns: the merged counters, as from CaptureStats.totals
+        """
+        t = self.stats.totals()
+        ants = np.where(t['ants'] != 0)[0]
+        self.logger.info('%d packets (even: %d, odd: %d), %d antennas, %d channels, '
+                         'errors: %d size, %d TVG, %d timestamp (~%d packets lost). Per worker: %s'
+                         % (t['packets'], t['even'], t['odd'], len(ants), np.count_nonzero(t['chans']),
+                            t['size_errors'], t['tvg_errors'], t['time_errors'], t['lost'],
+                            ' '.join([str(x) for x in t['per_worker']])))
+        return t
+
+    def run(self, report_interval=10.0, duration=None):
+        """
+        Start capturing, and report the counters every `report_interval`
+        seconds, until `duration` seconds have passed (None: until
+        interrupted).
+        returns: the final merged counters
+        """
+        self.start()
+        t0 = time.time()
+        try:
+            while duration is None or time.time() - t0 < duration:
+                wait = report_interval
+                if duration is not None:
+                    wait = min(wait, duration - (time.time() - t0))
+                time.sleep(max(wait, 0))
+                self.report()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+        return self.report()
@@ -0,0 +1,112 @@
+"""
+Generate the packets SNAP F-engines send, without any hardware,
+to exercise the receive path and the slot layout.
+"""
+import socket
+import struct
+import time
+import logging
+import numpy as np
+import yaml
+from hera_corr import get_slot_plan
+from packet_capture import PACKET_DTYPE, PACKET_BYTES, NSAMP_PER_PKT, TvgChecker, payload_view
+
+logger = logging.getLogger(__name__)
+
+def ip_to_str(ip):
+    return socket.inet_ntoa(struct.pack('>I', ip))
+
+class PacketGenerator(object):
+    """
+    Generate the packets the F-engines in the configuration `config`
+    (a dictionary, or the name of a YAML file) send with their EqTvg test
+    vectors enabled in mode `tvg_mode` (see packet_capture.TVG_MODES).
+    Every time step, each board sends one packet per X-engine slot, to the
+    X-engine's even or odd IP, exactly as the packetizer tables written by
+    `HeraCorrelator.apply_config` direct.
+    dest: None to send to the configured X-engine IPs and dest_port, or an
+          (ip, even port, odd port) tuple to send everything to instead,
+          eg. ('127.0.0.1', 8511, 8512) for loopback tests.
+    rate: Packets per second to send at, or None to send as fast as possible.
+    hosts: Boards to generate packets for. Default: all in the config.
+    """
+    def __init__(self, config, tvg_mode='ramp_pols', dest=None, rate=None, hosts=None):
+        if isinstance(config, str):
+            with open(config, 'r') as fh:
+                config = yaml.load(fh)
+        self.rate = rate
+        self.hosts = hosts or config['fengines'].keys()
+        slots = get_slot_plan(config)
+        dest_port = config['dest_port']
+        # Antenna numbers are assigned as HeraCorrelator.establish_connections does
+        ants = {}
+        for n, host in enumerate(config['fengines'].keys()):
+            ants[host] = (config['fengines'][host] or {}).get('ants', range(3*n, 3*n + 3))
+
+        # Template packets, with everything but the timestamp set,
+        # in the order each board sends them
+        self.template = np.zeros(len(self.hosts) * len(slots), dtype=PACKET_DTYPE)
+        self.dests = [[], []] # even bank, odd bank
+        chans = []
+        for host in self.hosts:
+            for xn, xchans, ip_even, ip_odd, xparams in slots:
+                chans += [xchans[0]]
+                if dest is None:
+                    self.dests[0] += [(ip_to_str(ip_even), dest_port)]
+                    self.dests[1] += [(ip_to_str(ip_odd), dest_port)]
+                else:
+                    self.dests[0] += [(dest[0], dest[1])]
+                    self.dests[1] += [(dest[0], dest[2])]
+        chans = np.array(chans, dtype=np.uint64)
+        ant_hdr = np.array([ants[host][0] for host in self.hosts], dtype=np.uint64).repeat(len(slots))
+        self.base_header = (chans << 16) | ant_hdr
+        payload_view(self.template)[:] = TvgChecker(tvg_mode).expected(chans.astype(np.int64))
+        self._raw = self.template.view(np.uint8).reshape(len(self.template), PACKET_BYTES)
+        self.time = 0   # timestamp of the packets being sent
+        self._index = 0 # next packet of this timestamp to send
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def packets(self, t):
+        """
+        The packets sent at timestamp `t`.
+        returns: array of packets (with dtype PACKET_DTYPE), list of (ip, port) destinations
+        """
+        pkts = self.template.copy()
+        pkts['header'] = self.base_header | (np.uint64(t) << np.uint64(29))
+        bank = (t // NSAMP_PER_PKT) % 2
+        return pkts, self.dests[bank]
+
+    def send(self, npkts=None, duration=None):
+        """
+        Send packets, carrying on from the last one sent, until `npkts`
+        packets have been sent or `duration` seconds have passed (whichever
+        comes first; if neither is given, until interrupted).
+        returns: number of packets sent, seconds taken
+        """
+        sent = 0
+        t0 = time.time()
+        try:
+            while True:
+                if self._index == 0:
+                    self.template['header'] = self.base_header | (np.uint64(self.time) << np.uint64(29))
+                dests = self.dests[(self.time // NSAMP_PER_PKT) % 2]
+                while self._index < len(dests):
+                    if npkts is not None and sent >= npkts:
+                        return sent, time.time() - t0
+                    self.sock.sendto(self._raw[self._index], dests[self._index])
+                    self._index += 1
+                    sent += 1
+                    # Sleep when ahead of schedule, checking every so often
+                    if self.rate is not None and sent % 16 == 0:
+                        ahead = t0 + float(sent) / self.rate - time.time()
+                        if ahead > 0:
+                            time.sleep(ahead)
+                self._index = 0
+                self.time += NSAMP_PER_PKT
+                if duration is not None and time.time() - t0 > duration:
+                    return sent, time.time() - t0
+        except KeyboardInterrupt:
+            return sent, time.time() - t0
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,257 @@
+"""
+Scheduling of the SNAP pocket correlators, which can only
+correlate one pair of inputs at a time, over every input pair
+of every board.
+"""
+import os
+import time
+import json
+import logging
+import threading
+import numpy as np
+import helpers
+
+logger = logging.getLogger(__name__)
+
+NINPUTS = 6
+# Every pair of inputs, autos included. Inputs are 1x,1y,2x,2y,3x,3y = 0,1,2,3,4,5
+POCO_PAIRS = [(i, j) for i in range(NINPUTS) for j in range(i, NINPUTS)]
+# Antenna pairs, and polarization products, of a board's 3 dual-pol antennas
+BASELINES = [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)]
+POLS = ['xx', 'yy', 'xy', 'yx']
+
+def pair_to_baseline_pol(pair):
+    """
+    Convert an input pair, eg. (1, 2) (1y, 2x), into
+    indices into BASELINES and POLS, eg. 1, 3 ((0, 1), 'yx')
+    """
+    (ant1, pol1), (ant2, pol2) = divmod(pair[0], 2), divmod(pair[1], 2)
+    return BASELINES.index((ant1, ant2)), POLS.index('xy'[pol1] + 'xy'[pol2])
+
+class PocoScheduler(object):
+    """
+    Cycle the pocket correlators of boards `fengs` through the input
+    pairs `pairs`, keeping `ndumps` accumulations of each pair per cycle.
+
+    Inputs are switched as soon as the accumulation counter increments,
+    and the one accumulation which was in progress during the switch is
+    thrown away, so only a fraction 1 / (ndumps + 1) of the time is lost
+    to switching. Every board runs in its own thread.
+
+    callback: Called as `callback(host, pair, acc_cnt, timestamp, spectrum)`
+              for every accumulation kept, from the board's thread.
+              `spectrum` is normalized by Corr.normalize.
+    acc_len: If given, set every board's accumulation length to this.
+    """
+    def __init__(self, fengs, callback, pairs=POCO_PAIRS, ndumps=1, acc_len=None, poll=0.005):
+        self.fengs = fengs
+        self.callback = callback
+        self.pairs = list(pairs)
+        self.ndumps = ndumps
+        self.acc_len = acc_len
+        self.poll = poll
+        self.stop_event = threading.Event()
+        # {host: {pair: [number of accumulations kept, seconds integrated]}}
+        self.kept = {}
+        self.elapsed = {} # {host: seconds spent cycling}
+        self.lost = {}    # {host: number of accumulations missed by reading too late}
+
+    def _run_board(self, feng, ncycles):
+        corr = feng.corr
+        if self.acc_len is not None:
+            corr.set_acc_len(self.acc_len)
+        else:
+            corr.acc_len = corr.get_acc_len() // 8192
+        acc_time = corr.get_acc_time()
+        # Give up on a board which stops accumulating
+        timeout = 4 * acc_time + 10
+        kept = dict([(pair, [0, 0.]) for pair in self.pairs])
+        self.kept[feng.host] = kept
+        self.lost[feng.host] = 0
+        cnt = corr.wait_for_new_acc(corr.read_uint('acc_cnt'), poll=self.poll, timeout=timeout)
+        t0 = time.time()
+        cycle = 0
+        while (ncycles is None or cycle < ncycles) and not self.stop_event.is_set():
+            for pair in self.pairs:
+                corr.set_input(*pair)
+                # The accumulation in progress has some of the last pair in it
+                first_good = cnt + 2
+                ngot = 0
+                while ngot < self.ndumps:
+                    cnt = corr.wait_for_new_acc(cnt, poll=self.poll, timeout=timeout)
+                    if cnt < first_good:
+                        continue
+                    spec = corr.read_dout()
+                    timestamp = time.time()
+                    # Only the latest accumulation can be read, so any which
+                    # were completed while we weren't looking are lost
+                    if corr.read_uint('acc_cnt') != cnt:
+                        self.lost[feng.host] += 1
+                        cnt = corr.read_uint('acc_cnt')
+                        continue
+                    corr.normalize(spec, auto=(pair[0] == pair[1]))
+                    self.callback(feng.host, pair, cnt, timestamp, spec)
+                    kept[pair][0] += 1
+                    kept[pair][1] += acc_time
+                    ngot += 1
+                    if self.stop_event.is_set():
+                        break
+                if self.stop_event.is_set():
+                    break
+            cycle += 1
+            self.elapsed[feng.host] = time.time() - t0
+
+    def run(self, ncycles=None):
+        """
+        Cycle through all the pairs `ncycles` times (None: until `stop`
+        is called, eg. from another thread).
+        returns: errors, a dictionary of {hostname: exception} for boards
+                 which failed
+        """
+        self.stop_event.clear()
+        nthreads = max(len(self.fengs), 1)
+        try:
+            results, errors = helpers.run_threaded(lambda feng: self._run_board(feng, ncycles),
+                                    self.fengs, key=lambda feng: feng.host, nthreads=nthreads)
+        except KeyboardInterrupt:
+            # Don't leave the boards' threads running
+            self.stop()
+            raise
+        for host, err in errors.items():
+            logger.error('%s: Pocket correlator capture failed: %s' % (host, err))
+        return errors
+
+    def stop(self):
+        self.stop_event.set()
+
+    def duty_cycles(self):
+        """
+        The fraction of the time spent cycling which was integrated, and
+        kept, for each pair of each board.
+        returns: dictionary of {hostname: {pair: duty cycle}}
+        """
+        rv = {}
+        for host, kept in self.kept.items():
+            elapsed = self.elapsed.get(host, 0)
+            rv[host] = dict([(pair, integrated / elapsed if elapsed > 0 else 0.)
+                             for pair, (nkept, integrated) in kept.items()])
+        return rv
+
+    def report(self):
+        """
+        Log the duty cycle achieved for each pair of each board.
+        returns: the output of `duty_cycles`
+        """
+        duty = self.duty_cycles()
+        ideal = self.ndumps / float((self.ndumps + 1) * len(self.pairs))
+        for host in sorted(duty.keys()):
+            logger.info('%s: %.1f seconds, %d accumulations lost. Duty cycle per pair (ideal %.4f): %s'
+                        % (host, self.elapsed.get(host, 0), self.lost.get(host, 0), ideal,
+                           ' '.join(['%d-%d:%.4f' % (pair + (duty[host][pair],)) for pair in self.pairs])))
+        return duty
+
+class PocoWriter(object):
+    """
+    Write the pocket correlator spectra of board `host` to disk as they
+    arrive, in directory `path`, which holds preallocated, memory-mapped
+    arrays with time, baseline (see BASELINES), polarization (see POLS)
+    and, for the spectra, frequency axes:
+
+        data.npy     complex64 (ntimes, baselines, pols, nchans)
+        times.npy    float64 (ntimes, baselines, pols): unix time of each
+                     spectrum, or NaN where there isn't one (yet)
+        header.json  host, baselines, pols, frequencies, and ntimes_written
+
+    Memory use is constant, however long the run. The arrays are flushed
+    every `flush_interval` seconds, at which point header.json is updated,
+    so `read_poco` can be used to look at the data while it is written.
+    A new time starts whenever a baseline and polarization already written
+    at the current time arrives again. The yx spectra of autocorrelations
+    aren't measured, and are filled in as the conjugates of the xy ones.
+    """
+    def __init__(self, path, host, ntimes, nchans=1024, flush_interval=10.0):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.ntimes = ntimes
+        self.flush_interval = flush_interval
+        shape = (ntimes, len(BASELINES), len(POLS))
+        self.data = np.lib.format.open_memmap(os.path.join(path, 'data.npy'), mode='w+',
+                                              dtype=np.complex64, shape=shape + (nchans,))
+        self.times = np.lib.format.open_memmap(os.path.join(path, 'times.npy'), mode='w+',
+                                               dtype=np.float64, shape=shape)
+        self.times[:] = np.nan
+        self.header = {
+            'host' : host,
+            'baselines' : BASELINES,
+            'pols' : POLS,
+            'frequencies' : (np.arange(nchans) * 250e6 / nchans).tolist(),
+            'ntimes' : ntimes,
+            'ntimes_written' : 0,
+        }
+        self.t = 0
+        self.last_flush = time.time()
+        self.flush()
+
+    @property
+    def full(self):
+        return self.t >= self.ntimes
+
+    def add(self, pair, timestamp, spectrum):
+        """
+        Write the spectrum `spectrum` of input pair `pair` (see POCO_PAIRS).
+        """
+        bl, pol = pair_to_baseline_pol(pair)
+        if not np.isnan(self.times[self.t, bl, pol]):
+            self.header['ntimes_written'] = self.t + 1
+            self.t += 1
+        if self.full:
+            raise IndexError('%s is full' % self.path)
+        self.data[self.t, bl, pol] = spectrum
+        self.times[self.t, bl, pol] = timestamp
+        if BASELINES[bl][0] == BASELINES[bl][1] and POLS[pol] == 'xy':
+            yx = POLS.index('yx')
+            self.data[self.t, bl, yx] = np.conj(spectrum)
+            self.times[self.t, bl, yx] = timestamp
+        if time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def __call__(self, host, pair, acc_cnt, timestamp, spectrum):
+        """
+        Add a spectrum. Matches the callback of PocoScheduler.
+        """
+        self.add(pair, timestamp, spectrum)
+
+    def flush(self):
+        self.data.flush()
+        self.times.flush()
+        # Write the header atomically, so readers never see half of one
+        tmp = os.path.join(self.path, 'header.json.tmp')
+        with open(tmp, 'w') as fh:
+            json.dump(self.header, fh)
+        os.rename(tmp, os.path.join(self.path, 'header.json'))
+        self.last_flush = time.time()
+
+    def close(self):
+        """
+        Flush everything, and mark the time being written as complete.
+        """
+        if not self.full and np.any(~np.isnan(self.times[self.t])):
+            self.header['ntimes_written'] = self.t + 1
+        self.flush()
+        del self.data
+        del self.times
+
+def read_poco(path):
+    """
+    Read the output of a PocoWriter, including one which is still being written.
+    returns: header dictionary, data, times
+             data and times are read-only memory maps of the times
+             written as of the last flush.
+    """
+    with open(os.path.join(path, 'header.json'), 'r') as fh:
+        header = json.load(fh)
+    n = header['ntimes_written']
+    data = np.load(os.path.join(path, 'data.npy'), mmap_mode='r')[:n]
+    times = np.load(os.path.join(path, 'times.npy'), mmap_mode='r')[:n]
+    return header, data, times
@@ -0,0 +1,112 @@
+"""
+A compact, self-describing binary encoding for numpy arrays
+stored in redis, such as ADC histograms and stats and pocket
+correlator spectra.
+
+An encoded array is a fixed header:
+
+    magic      4 bytes, 'HCFA'
+    version    uint8
+    flags      uint8, bit 0 set if the payload is zlib compressed
+    reserved   uint16
+    timestamp  float64, unix time the data were taken
+    meta_len   uint32, length of the metadata which follows
+
+followed by `meta_len` bytes of JSON metadata, {"dtype": <numpy
+dtype description>, "shape": [...]}, and then the array's data in
+C order, with every field little-endian. All header fields are
+little-endian too.
+"""
+import struct
+import json
+import time
+import zlib
+import numpy as np
+
+MAGIC = 'HCFA'
+VERSION = 1
+FLAG_ZLIB = 0x1
+
+_HEADER = struct.Struct('<4sBBHdI')
+
+def _to_little_endian(dtype):
+    return dtype.newbyteorder('<')
+
+def _descr_to_dtype(descr):
+    """
+    Inverse of np.lib.format.dtype_to_descr, after a round trip through JSON.
+    """
+    if isinstance(descr, basestring):
+        return np.dtype(str(descr))
+    fields = []
+    for field in descr:
+        name, sub = str(field[0]), _descr_to_dtype(field[1])
+        if len(field) > 2:
+            fields += [(name, sub, tuple(field[2]))]
+        else:
+            fields += [(name, sub)]
+    return np.dtype(fields)
+
+def encode(data, timestamp=None, compress=False):
+    """
+    Encode the array `data`.
+    timestamp: Unix time the data were taken. Default: now.
+    compress: zlib compress the payload.
+    returns: encoded string
+    """
+    data = np.asarray(data)
+    data = np.ascontiguousarray(data, dtype=_to_little_endian(data.dtype))
+    meta = json.dumps({'dtype' : np.lib.format.dtype_to_descr(data.dtype), 'shape' : data.shape})
+    payload = data.tostring()
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload, 1)
+        flags |= FLAG_ZLIB
+    if timestamp is None:
+        timestamp = time.time()
+    return _HEADER.pack(MAGIC, VERSION, flags, 0, timestamp, len(meta)) + meta + payload
+
+def decode(blob):
+    """
+    Decode a string made by `encode`.
+    returns: array, timestamp
+    """
+    if blob is None or len(blob) < _HEADER.size:
+        raise ValueError('Too short to be an encoded array')
+    magic, version, flags, reserved, timestamp, meta_len = _HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError('Not an encoded array')
+    if version > VERSION:
+        raise ValueError('Encoded array has version %d, but this reader only knows up to %d' % (version, VERSION))
+    start = _HEADER.size + meta_len
+    meta = json.loads(blob[_HEADER.size:start])
+    payload = blob[start:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    dtype = _descr_to_dtype(meta['dtype'])
+    # frombuffer views the (read-only) string, so copy to get a normal array
+    data = np.frombuffer(payload, dtype=dtype).reshape(meta['shape']).copy()
+    return data, timestamp
+
+def is_encoded(blob):
+    """
+    returns: True if `blob` looks like the output of `encode`.
+    """
+    return blob is not None and blob[0:len(MAGIC)] == MAGIC
+
+def hset_array(r, key, field, data, timestamp=None, compress=False):
+    """
+    Store the array `data` in field `field` of redis hash `key`.
+    r: redis connection, or pipeline.
+    """
+    return r.hset(key, field, encode(data, timestamp=timestamp, compress=compress))
+
+def hget_array(r, key, field):
+    """
+    Read an array stored with `hset_array`.
+    returns: array, timestamp; or None, None if the field doesn't exist.
+    """
+    blob = r.hget(key, field)
+    if blob is None:
+        return None, None
+    return decode(blob)
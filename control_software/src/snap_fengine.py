@@ -3,71 +3,155 @@ import helpers
 import numpy as np
 import struct
 import time
+import threading
 import casperfpga
 from blocks import *
 
+class lazy_block(object):
+    """
+    A SnapFengine attribute holding the value of `make(feng)`, which is
+    only made the first time the attribute is used, and then stored
+    in the instance, so later uses cost nothing extra.
+    """
+    def __init__(self, make):
+        self.make = make
+        self.name = None
+        self.__doc__ = make.__doc__
+
+    def _find_name(self, cls):
+        for klass in cls.__mro__:
+            for name, value in vars(klass).items():
+                if value is self:
+                    return name
+
+    def __get__(self, feng, cls):
+        if feng is None:
+            return self
+        if self.name is None:
+            self.name = self._find_name(cls)
+        # Each board has its own lock, so boards don't wait on each other
+        with feng._lazy_lock:
+            # Another thread may have made it while we waited
+            if self.name not in feng.__dict__:
+                value = self.make(feng)
+                if feng.shadow and isinstance(value, Block):
+                    value.enable_shadow()
+                feng.__dict__[self.name] = value
+            return feng.__dict__[self.name]
+
 class SnapFengine(object):
-    def __init__(self, host, ant_indices=None, logger=None):
+    # blocks, made when they are first used
+    synth       = lazy_block(lambda self: Synth(self.fpga, 'lmx_ctrl'))
+    adc         = lazy_block(lambda self: Adc(self.fpga)) # not a subclass of Block
+    sync        = lazy_block(lambda self: Sync(self.fpga, 'sync'))
+    noise       = lazy_block(lambda self: NoiseGen(self.fpga, 'noise', nstreams=6))
+    input       = lazy_block(lambda self: Input(self.fpga, 'input', nstreams=12))
+    delay       = lazy_block(lambda self: Delay(self.fpga, 'delay', nstreams=6))
+    pfb         = lazy_block(lambda self: Pfb(self.fpga, 'pfb'))
+    eq          = lazy_block(lambda self: Eq(self.fpga, 'eq_core', nstreams=6, ncoeffs=2**10))
+    eq_tvg      = lazy_block(lambda self: EqTvg(self.fpga, 'eqtvg', nstreams=6, nchans=2**13))
+    reorder     = lazy_block(lambda self: ChanReorder(self.fpga, 'chan_reorder', nchans=2**10))
+    rotator     = lazy_block(lambda self: Rotator(self.fpga, 'rotator'))
+    packetizer  = lazy_block(lambda self: Packetizer(self.fpga, 'packetizer', n_time_demux=2)) # Round robin time packets to two destinations
+    eth         = lazy_block(lambda self: Eth(self.fpga, 'eth'))
+    corr        = lazy_block(lambda self: Corr(self.fpga,'corr_0'))
+    phaseswitch = lazy_block(lambda self: PhaseSwitch(self.fpga, 'phase_switch'))
+    pams        = lazy_block(lambda self: [Pam(self.fpga, 'i2c_ant%d' % i) for i in range(3)])
+    fems        = lazy_block(lambda self: [])#[Fem(self.fpga, 'i2c_ant%d' % i) for i in range(3)]
+
+    # The order here can be important, blocks are initialized in the
+    # order they appear here
+    BLOCKS = ['synth', 'adc', 'sync', 'noise', 'input', 'delay', 'pfb', 'eq',
+              'eq_tvg', 'reorder', 'packetizer', 'eth', 'corr', 'phaseswitch']
+
+    def __init__(self, host, ant_indices=None, logger=None, fpga=None, shadow=False):
+        """
+        fpga: Object to talk to the board through, in place of a
+              casperfpga.CasperFpga using TAPCP, eg. a snap_sim.SimulatedSnap.
+        shadow: Keep software copies of the blocks' control registers (see
+                Block.enable_shadow), which saves reads, but is only safe
+                in scripts short-lived enough that no other process
+                writes the registers meanwhile.
+
+        Blocks are made the first time they are used, so that scripts
+        which only use a few of them don't pay to make the rest.
+        """
         self.host = host
+        self._lazy_lock = threading.RLock()
+        self.shadow = shadow
         self.logger = logger or helpers.add_default_log_handlers(logging.getLogger(__name__ + "(%s)" % host))
-        self.fpga = casperfpga.CasperFpga(host=host, transport=casperfpga.TapcpTransport)
-        # Try and get the canonical name of the host
-        # to use as a serial number
-        try:
-            self.serial = socket.gethostbyaddr(self.host)[0]
-        except:
-            self.serial = None
-
-        # blocks
-        self.synth       = Synth(self.fpga, 'lmx_ctrl')
-        self.adc         = Adc(self.fpga) # not a subclass of Block
-        self.sync        = Sync(self.fpga, 'sync')
-        self.noise       = NoiseGen(self.fpga, 'noise', nstreams=6)
-        self.input       = Input(self.fpga, 'input', nstreams=12)
-        self.delay       = Delay(self.fpga, 'delay', nstreams=6)
-        self.pfb         = Pfb(self.fpga, 'pfb')
-        self.eq          = Eq(self.fpga, 'eq_core', nstreams=6, ncoeffs=2**10)
-        self.eq_tvg      = EqTvg(self.fpga, 'eqtvg', nstreams=6, nchans=2**13)
-        self.reorder     = ChanReorder(self.fpga, 'chan_reorder', nchans=2**10)
-        self.rotator     = Rotator(self.fpga, 'rotator')
-        self.packetizer  = Packetizer(self.fpga, 'packetizer', n_time_demux=2) # Round robin time packets to two destinations
-        self.eth         = Eth(self.fpga, 'eth')
-        self.corr        = Corr(self.fpga,'corr_0')
-        self.phaseswitch = PhaseSwitch(self.fpga, 'phase_switch')
-        self.i2c_initialized = False
+        self.fpga = fpga or casperfpga.CasperFpga(host=host, transport=casperfpga.TapcpTransport)
+        self.ants = [None] * 6 # An attribute to store the antenna names of this board's inputs
+        self.ant_indices = ant_indices or range(3) # An attribute to store the antenna numbers used in packet headers
+
+    @lazy_block
+    def serial(self):
+        """
+        The canonical name of the host, used as a serial number,
+        or None if it has none. Looked up when first used.
+        """
         try:
-            self._add_i2c()
+            return helpers.gethostbyaddr(self.host)[0]
         except:
-            pass
+            return None
 
-        self.ants = [None] * 6 # An attribute to store the antenna names of this board's inputs
-        self.ant_indices = ant_indices or range(3) # An attribute to store the antenna numbers used in packet headers
-        
-        # The order here can be important, blocks are initialized in the
-        # order they appear here
-        self.blocks = [
-            self.synth,
-            self.adc,
-            self.sync,
-            self.noise,
-            self.input,
-            self.delay,
-            self.pfb,
-            self.eq,
-            self.eq_tvg,
-            self.reorder,
-            self.packetizer,
-            self.eth,
-            self.corr,
-            self.phaseswitch,
-        ]
+    @property
+    def i2c_initialized(self):
+        """
+        Whether the PAM and FEM blocks have been made.
+        """
+        return 'pams' in self.__dict__ and 'fems' in self.__dict__
 
     def _add_i2c(self):
-        self.pams        = [Pam(self.fpga, 'i2c_ant%d' % i) for i in range(3)]
-        self.fems        = []#[Fem(self.fpga, 'i2c_ant%d' % i) for i in range(3)]
-        self.blocks += self.pams
-        self.blocks += self.fems
-        self.i2c_initialized = True
+        self.pams
+        self.fems
+
+    @property
+    def blocks(self):
+        """
+        All the blocks, in the order they are initialized, including the
+        PAMs and FEMs if they have been made. Makes any not made yet.
+        """
+        blocks = [getattr(self, name) for name in self.BLOCKS]
+        if self.i2c_initialized:
+            blocks += self.pams + self.fems
+        return blocks
+
+    def read_uints(self, regs, **kwargs):
+        """
+        Read many registers, from any blocks, using as few
+        transactions as possible.
+        regs: list of full register names, or (register name, word offset) tuples
+        returns: dictionary of {entry in regs: unsigned value}
+        """
+        full_regs = [reg if isinstance(reg, tuple) else (reg, 0) for reg in regs]
+        return dict(zip(regs, read_uints(self.fpga, full_regs, **kwargs)))
+
+    def _made_blocks(self):
+        """
+        returns: the blocks which have been made so far
+        """
+        blocks = [self.__dict__[name] for name in self.BLOCKS if name in self.__dict__]
+        if self.i2c_initialized:
+            blocks += self.pams + self.fems
+        return blocks
+
+    def invalidate_shadows(self):
+        """
+        Forget all software copies of control registers. Call this
+        whenever the FPGA is reprogrammed.
+        """
+        for block in self._made_blocks():
+            if isinstance(block, Block):
+                block.invalidate_shadow()
+
+    def resync_shadows(self):
+        """
+        Refresh all software copies of control registers from the hardware.
+        """
+        for block in self._made_blocks():
+            if isinstance(block, Block):
+                block.resync_shadow()
 
     def initialize(self):
         if not self.i2c_initialized:
@@ -75,4 +159,7 @@ class SnapFengine(object):
         for block in self.blocks:
             self.logger.info("Initializing block: %s" % block.name)
             block.initialize()
+        # Not every block writes through the Block methods which keep
+        # the copies of registers and memories up to date
+        self.invalidate_shadows()
 
@@ -0,0 +1,278 @@
+"""
+An in-process stand-in for a SNAP board running the F-engine design,
+reached over TAPCP, so that the control software can be exercised,
+profiled and regression tested, at any number of boards, without
+hardware.
+
+`SimulatedSnap` looks like a casperfpga.CasperFpga. It holds a memory
+model of the registers and BRAMs the Blocks in this package use, keyed
+by the same names, and charges every transaction a modeled TAPCP time
+(see `TapcpModel`), which it can either just add up or actually wait
+for. Use it with `SnapFengine(host, fpga=SimulatedSnap(host))`, or
+`HeraCorrelator(..., fpga_factory=SimulatedSnap)`.
+
+Only the F-engine firmware is modeled. The ADC, synthesizer and I2C
+chips behind casperfpga's drivers just see plain memory.
+"""
+import struct
+import threading
+import time
+import numpy as np
+
+# The registers and BRAMs of the F-engine design, and their sizes in bytes,
+# as the Blocks of a SnapFengine name them.
+SNAP_REGISTERS = {
+    'lmx_ctrl' : 4,
+    'timebase_sync_period' : 4,
+    'sync_arm' : 4,
+    'sync_uptime' : 4,
+    'sync_period' : 4,
+    'sync_count' : 4,
+    'noise_seed_0' : 4,
+    'noise_seed_1' : 4,
+    'input_source_sel' : 4,
+    'input_rms_enable' : 4,
+    'input_rms_levels' : 12 * 8,
+    'input_bit_stats_input_sel' : 4,
+    'input_bit_stats_histogram_output' : 512 * 2,
+    'delay_delays' : 4,
+    'pfb_ctrl' : 4,
+    'pfb_status' : 4,
+    'eq_core_coeffs' : 6 * 2**10 * 2,
+    'eq_core_clip_cnt' : 4,
+    'eqtvg_tvg_en' : 4,
+    'eqtvg_tv' : 6 * 2**13,
+    'chan_reorder_reorder3_map1' : 2**10 * 4,
+    'rotator_en' : 4,
+    'packetizer_ips' : 2 * 16 * 4,
+    'packetizer_ants' : 2 * 16 * 4,
+    'packetizer_chans' : 2 * 16 * 4,
+    'eth_ctrl' : 4,
+    'eth_sw' : 0x4000,
+    'eth_sw_txofctr' : 4,
+    'eth_sw_txfullctr' : 4,
+    'eth_sw_txerrctr' : 4,
+    'eth_sw_txvldctr' : 4,
+    'eth_sw_txctr' : 4,
+    'corr_0_acc_len' : 4,
+    'corr_0_acc_cnt' : 4,
+    'corr_0_input_sel' : 4,
+    'corr_0_dout' : 2**10 * 8,
+    'phase_switch_gpio_switch_states' : 2**12,
+    'phase_switch_sw_switch_states' : 2**12,
+    'phase_switch_gpio_switch_offset' : 4,
+    'pmbus_alert' : 4,
+    'i2c_ant0' : 0x100,
+    'i2c_ant1' : 0x100,
+    'i2c_ant2' : 0x100,
+}
+
+FPGA_CLOCK = 250e6
+
+class TapcpModel(object):
+    """
+    The time TAPCP transactions take. TAPCP moves every read or write
+    as a TFTP transfer over UDP, so each transaction costs a round trip
+    for the request, plus one for every `block_size` byte block of data,
+    each of which has to be acknowledged before the next is sent, plus
+    the time to move the bytes at `bandwidth` bytes per second.
+    The defaults are typical of a SNAP's microblaze on a quiet network.
+    """
+    def __init__(self, latency=2e-3, block_latency=0.5e-3, block_size=1024, bandwidth=2e6):
+        self.latency = latency
+        self.block_latency = block_latency
+        self.block_size = block_size
+        self.bandwidth = bandwidth
+
+    def transaction_time(self, nbytes):
+        """
+        returns: seconds taken to read or write `nbytes` in one transaction
+        """
+        nblocks = max(1, (nbytes + self.block_size - 1) // self.block_size)
+        return self.latency + nblocks * self.block_latency + nbytes / float(self.bandwidth)
+
+class SimulatedMemory(object):
+    """
+    An entry of the memory map, as casperfpga describes them.
+    """
+    def __init__(self, name, address, length_bytes):
+        self.name = name
+        self.address = address
+        self.length_bytes = length_bytes
+
+class SimulatedTransport(object):
+    def __init__(self, snap):
+        self.snap = snap
+
+    def get_temp(self):
+        return self.snap.temperature
+
+    def is_connected(self):
+        return True
+
+class SimulatedSnap(object):
+    """
+    A stand-in for a casperfpga.CasperFpga connected to SNAP `host`.
+
+    model: TapcpModel charged for every transaction. Default: TapcpModel()
+    sleep: If True, wait the modeled time of every transaction, as a real
+           board would make you. Otherwise only add it up, in `stats`.
+    strict: If True, accessing a register not in `registers` is an error.
+            Otherwise such registers are made as they're first used.
+    registers: dictionary of {register name: size in bytes}.
+               Default: SNAP_REGISTERS
+
+    Registers are laid out in the memory map in order of name, as the
+    toolflow does, so reads which `read_uints` merges behave as they do
+    on hardware. Like casperfpga, `write` and `write_int` read back what
+    they wrote to check it, and `blindwrite` doesn't. The sync uptime and
+    count, and the correlator's accumulation counter, advance with time;
+    everything else is plain memory, starting with plausible ADC
+    statistics and correlator output. One transaction is served at a time.
+    """
+    def __init__(self, host, model=None, sleep=False, strict=False, registers=SNAP_REGISTERS):
+        self.host = host
+        self.model = model or TapcpModel()
+        self.sleep = sleep
+        self.strict = strict
+        self.transport = SimulatedTransport(self)
+        self.temperature = 45.0
+        self.lock = threading.Lock()
+        self.memory_devices = {}
+        self.ram = bytearray()
+        self.unknown = set() # registers used which weren't in `registers`
+        for name in sorted(registers.keys()):
+            self._add_register(name, registers[name])
+        self.reset_stats()
+        self._fill()
+        self.t0 = time.time()
+
+    def _add_register(self, name, nbytes):
+        self.memory_devices[name] = SimulatedMemory(name, len(self.ram), nbytes)
+        self.ram += bytearray((nbytes + 3) // 4 * 4)
+
+    def _set(self, name, data):
+        address = self.memory_devices[name].address
+        self.ram[address:address + len(data)] = data
+
+    def _get(self, name, nbytes, offset=0):
+        address = self.memory_devices[name].address + offset
+        return bytes(self.ram[address:address + nbytes])
+
+    def _fill(self):
+        """
+        Start with some signal in the ADC statistics and correlator.
+        """
+        devs = self.memory_devices
+        if 'input_rms_levels' in devs:
+            # (mean, power) pairs, 16 fractional bits, for an rms of 10
+            levels = np.zeros(devs['input_rms_levels'].length_bytes // 4, dtype='>i4')
+            levels[1::2] = 100 * 2**16
+            self._set('input_rms_levels', levels.tostring())
+        if 'input_bit_stats_histogram_output' in devs:
+            # Two cores, each with bins for 0..127 then -128..-1
+            bins = np.roll(np.arange(-128, 128), -128)
+            hist = (2**18 / (10 * np.sqrt(2*np.pi)) * np.exp(-bins**2 / 200.)).astype('>u2')
+            self._set('input_bit_stats_histogram_output', np.tile(hist, 2).tostring())
+        if 'corr_0_dout' in devs:
+            dout = np.zeros(devs['corr_0_dout'].length_bytes // 4, dtype='>i4')
+            dout[0::2] = 10000 + np.arange(len(dout) // 2)
+            self._set('corr_0_dout', dout.tostring())
+        if 'corr_0_acc_len' in devs:
+            self._set('corr_0_acc_len', struct.pack('>L', 8192 * 3815))
+
+    def reset_stats(self):
+        """
+        Zero the transaction counters in `stats`.
+        """
+        self.stats = {
+            'reads' : 0,          # read transactions
+            'writes' : 0,         # write transactions
+            'bytes_read' : 0,
+            'bytes_written' : 0,
+            'modeled_time' : 0.0, # seconds the transactions would take over TAPCP
+        }
+
+    def _charge(self, kind, nbytes):
+        t = self.model.transaction_time(nbytes)
+        if kind == 'read':
+            self.stats['reads'] += 1
+            self.stats['bytes_read'] += nbytes
+        else:
+            self.stats['writes'] += 1
+            self.stats['bytes_written'] += nbytes
+        self.stats['modeled_time'] += t
+        if self.sleep:
+            time.sleep(t)
+
+    def _address(self, name, offset, nbytes):
+        """
+        returns: address in `ram` of byte `offset` of register `name`, checking
+                 that `nbytes` from there are in the memory map.
+        """
+        if name not in self.memory_devices:
+            if self.strict:
+                raise KeyError('%s: No register named %s' % (self.host, name))
+            self.unknown.add(name)
+            self._add_register(name, max(4, offset + nbytes))
+        address = self.memory_devices[name].address + offset
+        if address + nbytes > len(self.ram):
+            raise IndexError('%s: Access to %d bytes at offset %d of %s runs off the memory map'
+                             % (self.host, nbytes, offset, name))
+        return address
+
+    def _update_dynamic(self, start, end):
+        """
+        Bring the registers which the firmware changes, and which
+        are between addresses `start` and `end`, up to date.
+        """
+        now = time.time() - self.t0
+        for name in ['sync_uptime', 'sync_count', 'corr_0_acc_cnt']:
+            dev = self.memory_devices.get(name)
+            if dev is None or dev.address >= end or dev.address + 4 <= start:
+                continue
+            if name == 'corr_0_acc_cnt':
+                acc_len = struct.unpack('>L', self._get('corr_0_acc_len', 4))[0]
+                # as Corr.get_acc_time
+                acc_time = acc_len * 8 / FPGA_CLOCK
+                value = int(now / acc_time) if acc_time > 0 else 0
+            else:
+                value = int(now) # a 1 PPS sync
+            self._set(name, struct.pack('>L', value & 0xffffffff))
+
+    def is_connected(self):
+        return True
+
+    def listdev(self):
+        return sorted(self.memory_devices.keys())
+
+    def read(self, name, size, offset=0, **kwargs):
+        with self.lock:
+            address = self._address(name, offset, size)
+            self._update_dynamic(address, address + size)
+            self._charge('read', size)
+            return bytes(self.ram[address:address + size])
+
+    def blindwrite(self, name, data, offset=0, **kwargs):
+        with self.lock:
+            address = self._address(name, offset, len(data))
+            self._charge('write', len(data))
+            self.ram[address:address + len(data)] = data
+
+    def write(self, name, data, offset=0, **kwargs):
+        self.blindwrite(name, data, offset=offset)
+        if self.read(name, len(data), offset=offset) != data:
+            raise ValueError('%s: Verification of write to %s at offset %d failed' % (self.host, name, offset))
+
+    def read_int(self, name, word_offset=0, **kwargs):
+        return struct.unpack('>l', self.read(name, 4, offset=4*word_offset))[0]
+
+    def read_uint(self, name, word_offset=0, **kwargs):
+        return struct.unpack('>L', self.read(name, 4, offset=4*word_offset))[0]
+
+    def write_int(self, name, value, blindwrite=False, word_offset=0, **kwargs):
+        data = struct.pack('>l' if value < 0 else '>L', value)
+        if blindwrite:
+            self.blindwrite(name, data, offset=4*word_offset)
+        else:
+            self.write(name, data, offset=4*word_offset)
@@ -0,0 +1,88 @@
+import unittest
+import copy
+from hera_corr_f import benchmark
+
+class TestControlBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.bench = benchmark.ControlBenchmark(nboards=3)
+
+    def test_report(self):
+        report = self.bench.run()
+        self.assertEqual(sorted(report['operations'].keys()), sorted([name for name, func in benchmark.OPERATIONS]))
+        for name, metrics in report['operations'].items():
+            self.assertEqual(metrics['errors'], 0)
+            self.assertEqual(metrics['transactions'], metrics['reads'] + metrics['writes'])
+        # The monitor uploads every board's status with one pipeline
+        self.assertTrue(report['operations']['monitor_loop']['redis_commands'] > 3 * 7)
+        self.assertEqual(self.bench.snaps.values()[0].unknown, set())
+
+    def test_thresholds(self):
+        report = self.bench.run(['phase_switch_enable'])
+        writes = report['operations']['phase_switch_enable']['writes']
+        self.assertEqual(benchmark.check_thresholds(report, {'phase_switch_enable' : {'writes' : writes}}), [])
+        self.assertEqual(len(benchmark.check_thresholds(report, {'phase_switch_enable' : {'writes' : writes - 1}})), 1)
+        self.assertRaises(ValueError, self.bench.run, ['no_such_operation'])
+
+    def test_baseline(self):
+        report = self.bench.run(['initialize', 'resync'])
+        baseline = copy.deepcopy(report)
+        baseline['operations']['initialize']['wall_time'] = 0.
+        self.assertEqual(benchmark.compare_to_baseline(report, baseline), [])
+        baseline['operations']['resync']['transactions'] *= 0.5
+        regressions = benchmark.compare_to_baseline(report, baseline)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('resync transactions'))
+
+    def test_poco(self):
+        from hera_corr_f import monitor, redis_codec
+        r = self.bench.redis
+        r.hmset('poco', {'integration_time' : 0.01, 'ant1' : 0, 'ant2' : 0})
+        self.assertEqual(monitor.poll_poco(self.bench.corr, r), {})
+        self.assertEqual((r.hget('poco', 'ant1'), r.hget('poco', 'ant2')), ('0', '1'))
+        for host in self.bench.snaps.keys():
+            xcorr, t = redis_codec.hget_array(r, 'poco:%s' % host, 'corr')
+            self.assertEqual(xcorr.shape, (4, 1024))
+        # A board which doesn't accumulate in time fails, without holding up the others
+        self.bench.corr.timeout = 0.1
+        r.hset('poco', 'integration_time', 1)
+        self.assertEqual(sorted(monitor.poll_poco(self.bench.corr, r).keys()), sorted(self.bench.snaps.keys()))
+
+    def test_staged_arm(self):
+        corr = self.bench.corr
+        pps_time, arm_times = corr._staged_arm(corr.fengs[0].sync.OFFSET_ARM_SYNC)
+        self.assertEqual(sorted(arm_times.keys()), sorted(self.bench.snaps.keys()))
+        # A failure waiting for the PPS arms no boards, and declares none dead
+        def _fail():
+            raise RuntimeError('board dropped out')
+        corr.fengs[0].sync.wait_for_sync = _fail
+        self.assertRaises(RuntimeError, corr._staged_arm, corr.fengs[0].sync.OFFSET_ARM_SYNC)
+        self.assertEqual(corr.dead_fengs, {})
+
+    def test_apply_config(self):
+        feng = self.bench.corr.fengs[0]
+        feng.eth.add_arp_entry(200, 0x0123456789ab)
+        self.bench.measure(benchmark._apply_config)
+        # ARP entries no X-engine uses are left alone
+        self.assertEqual(feng.eth.read_uint('sw', word_offset=(0x3000 + 200*8) // 4 + 1), 0x456789ab)
+        # Once the memories are cached, only the ports are written
+        metrics = self.bench.measure(benchmark._apply_config)
+        self.assertEqual((metrics['bytes_read'], metrics['errors']), (4, 0))
+        # Word writes, as by initialize, are seen, and the tables written again
+        ips = feng.packetizer.read('ips', 16)
+        feng.packetizer.initialize()
+        self.assertNotEqual(feng.packetizer.read('ips', 16), ips)
+        diffs = self.bench.corr.apply_config()
+        self.assertTrue('packetizer_ips' in diffs[feng.host])
+        self.assertEqual(feng.packetizer.read('ips', 16), ips)
+
+    def test_adc_snapshots(self):
+        snapshots, errors = self.bench.corr.get_adc_snapshots(self.bench.corr.fengs[:1])
+        self.assertEqual((snapshots.keys(), errors), ([self.bench.corr.fengs[0].host], {}))
+        # No boards means none, not all of them
+        self.assertEqual(self.bench.corr.get_adc_snapshots([]), ({}, {}))
+
+    def test_board_status(self):
+        from hera_corr_f import monitor
+        feng = self.bench.corr.fengs[0]
+        status = monitor.get_board_status(feng, [(0, 'e', 0)])
+        self.assertEqual(status.keys(), ['status:snap:%s' % feng.host])
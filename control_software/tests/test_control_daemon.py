@@ -0,0 +1,124 @@
+import unittest
+import time
+import threading
+from hera_corr_f import benchmark
+from hera_corr_f import control_daemon
+
+class ListRedis(benchmark.CountingRedis):
+    """
+    Adds the list commands the control daemon uses.
+    """
+    def __init__(self):
+        super(ListRedis, self).__init__()
+        self.cond = threading.Condition()
+
+    def rpush(self, key, *values):
+        with self.cond:
+            self.data.setdefault(key, []).extend(values)
+            self.cond.notify_all()
+
+    def blpop(self, keys, timeout=0):
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                for key in keys:
+                    if len(self.data.get(key, [])) > 0:
+                        return key, self.data[key].pop(0)
+                if time.time() > deadline:
+                    return None
+                self.cond.wait(0.05)
+
+class TestPriorityLock(unittest.TestCase):
+    def test_order(self):
+        lock = control_daemon.PriorityLock()
+        lock.acquire()
+        order = []
+        def _wait(priority):
+            lock.acquire(priority)
+            order.append(priority)
+            lock.release()
+        threads = []
+        for priority in [10, 0, 5, 0]:
+            threads += [threading.Thread(target=_wait, args=(priority,))]
+            threads[-1].start()
+            while lock.waiting() < len(threads):
+                time.sleep(0.001)
+        lock.release()
+        for t in threads:
+            t.join()
+        self.assertEqual(order, [0, 0, 5, 10])
+
+class TestControlDaemon(unittest.TestCase):
+    def setUp(self):
+        # As the daemon script, which doesn't keep copies of control registers
+        self.bench = benchmark.ControlBenchmark(nboards=2, shadow=False)
+        self.daemon = control_daemon.ControlDaemon(self.bench.corr)
+        self.hosts = sorted(self.bench.snaps.keys())
+
+    def test_call(self):
+        self.daemon.call('phase_switch_enable')
+        self.assertEqual(self.bench.redis.get('corr:status_phase_switch'), 'on')
+        rv = self.daemon.call('feng_call', ('sync', 'change_period', 0), hosts=self.hosts[:1])
+        self.assertEqual((rv['results'].keys(), rv['errors']), (self.hosts[:1], {}))
+        self.assertRaises(ValueError, self.daemon.call, 'declare_feng_dead', (self.hosts[0],))
+        self.assertRaises(ValueError, self.daemon.call, 'feng_call', ('eth', '_write_region'))
+        # Board-wide methods can't be limited to some boards
+        self.assertRaises(ValueError, self.daemon.call, 'resync', kwargs={'manual' : True}, hosts=self.hosts[:1])
+        self.assertEqual(self.daemon.call('monitor_poll', priority=control_daemon.MONITOR), {})
+        self.assertEqual(self.daemon.call('status')['hosts'], self.bench.corr.config['fengines'].keys())
+
+    def test_boards_held(self):
+        # A request waits for the boards it uses to be free, and no others
+        done = []
+        with self.daemon.hold(self.hosts[:1]):
+            t = threading.Thread(target=lambda: done.append(self.daemon.call('enable_output')))
+            t.start()
+            self.daemon.call('feng_call', ('eth', 'disable_tx'), hosts=self.hosts[1:])
+            time.sleep(0.05)
+            self.assertEqual(done, [])
+        t.join()
+        self.assertEqual(done, [None])
+
+    def test_invalidate(self):
+        # Boards reprogrammed, or locked out, by another script are forgotten
+        feng = self.bench.corr.fengs[0]
+        monitor = threading.Thread(target=self.daemon.run_monitor, args=(0.01,))
+        monitor.start()
+        try:
+            for key in ['corr:snap:last_programmed', 'disable_monitoring']:
+                self.daemon.call('apply_config')
+                self.assertFalse(feng.eth.cached_image('sw', offset=0x3000) is None)
+                self.bench.redis.set(key, 'now')
+                deadline = time.time() + 10
+                while feng.eth.cached_image('sw', offset=0x3000) is not None and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertTrue(feng.eth.cached_image('sw', offset=0x3000) is None, key)
+        finally:
+            self.daemon.stop()
+            monitor.join()
+
+    def test_initialize(self):
+        # Configuration undone by initializing the boards is applied again
+        self.daemon.call('apply_config')
+        self.daemon.call('feng_call', ('packetizer', 'initialize'))
+        diffs = self.daemon.call('apply_config')
+        self.assertTrue(all(['packetizer_ips' in diff for diff in diffs.values()]))
+        self.daemon.call('initialize')
+        diffs = self.daemon.call('apply_config')
+        self.assertTrue(all(['packetizer_ips' in diff for diff in diffs.values()]))
+        self.assertEqual(self.daemon.call('apply_config'), dict([(host, {}) for host in self.hosts]))
+
+    def test_rpc(self):
+        r = ListRedis()
+        server = threading.Thread(target=self.daemon.serve, args=(r,))
+        server.start()
+        try:
+            client = control_daemon.DaemonClient(r=r, timeout=10)
+            self.assertEqual(client.resync(manual=True), [])
+            rv = client.feng_call('eth', 'disable_tx', hosts=self.hosts)
+            self.assertEqual(sorted(rv['results'].keys()), self.hosts)
+            self.assertRaises(control_daemon.RemoteError, client.call, 'no_such_method')
+            self.assertRaises(AttributeError, getattr, client, 'declare_feng_dead')
+        finally:
+            self.daemon.stop()
+            server.join()
@@ -0,0 +1,54 @@
+import unittest
+import numpy as np
+from hera_corr_f import SnapFengine
+from hera_corr_f.snap_sim import SimulatedSnap
+from hera_corr_f.eq_manager import EqManager
+
+class TestEqManager(unittest.TestCase):
+    def setUp(self):
+        self.fengs = [SnapFengine('snap%d' % i, fpga=SimulatedSnap('snap%d' % i)) for i in range(3)]
+        self.eqm = EqManager(self.fengs)
+
+    def test_only_changed_boards_are_written(self):
+        written, errors = self.eqm.upload()
+        self.assertEqual((written, errors), (['snap0', 'snap1', 'snap2'], {}))
+        self.assertEqual([feng.fpga.stats['writes'] for feng in self.fengs], [1, 1, 1])
+        self.eqm.set(np.arange(1024), hosts=['snap1'], streams=[2, 4])
+        self.assertEqual(self.eqm.pending(), ['snap1'])
+        written, errors = self.eqm.upload()
+        self.assertEqual(written, ['snap1'])
+        self.assertEqual([feng.fpga.stats['writes'] for feng in self.fengs], [1, 2, 1])
+        coeffs = self.fengs[1].eq.get_all_coeffs()
+        self.assertTrue(np.all(coeffs[[2, 4]] == np.arange(1024)))
+        self.assertTrue(np.all(coeffs[[0, 1, 3, 5]] == 100))
+
+    def test_saturation(self):
+        self.eqm.set(-1, hosts='snap0', streams=0)
+        self.eqm.set(2000, hosts='snap2')
+        quantized, saturated = self.eqm.quantize()
+        self.assertEqual(list(saturated), [1024, 0, 6*1024])
+        self.assertEqual(quantized[2].max(), 2**16 - 1)
+        self.assertEqual(quantized[0, 0].max(), 0)
+
+    def test_fetch(self):
+        self.fengs[0].eq.set_all_coeffs(np.arange(6)[:, None])
+        self.eqm.fetch()
+        self.assertEqual(self.eqm.pending(), [])
+        self.assertTrue(np.all(self.eqm.get('snap0', 5) == 5))
+        self.assertTrue(np.all(self.eqm.get('snap1') == 0))
+
+    def test_shares_block_images(self):
+        self.eqm.upload()
+        # Coefficients written another way, as by HeraCorrelator.apply_config, are seen
+        self.fengs[0].eq.write_image('coeffs', self.fengs[0].eq.pack_coeffs(np.ones((6, 1024)) * 50))
+        self.assertEqual(self.eqm.pending(), ['snap0'])
+        self.eqm.set(50, hosts='snap0')
+        self.assertEqual(self.eqm.pending(), [])
+        # A reprogrammed board is written again
+        self.eqm.invalidate(['snap2'])
+        self.assertEqual(self.eqm.upload(), (['snap2'], {}))
+        # A single hostname isn't taken as the set of its substrings
+        self.eqm.invalidate('snap12')
+        self.assertEqual(self.eqm.pending(), [])
+        self.eqm.invalidate('snap1')
+        self.assertEqual(self.eqm.pending(), ['snap1'])
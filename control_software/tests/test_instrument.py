@@ -0,0 +1,70 @@
+import unittest
+import os
+import json
+import tempfile
+from hera_corr_f import blocks
+from hera_corr_f import instrument
+from hera_corr_f.snap_sim import SimulatedSnap
+
+class TestInstrument(unittest.TestCase):
+    def setUp(self):
+        self.snap = SimulatedSnap('10.0.0.1')
+        self.sync = blocks.Sync(self.snap, 'sync')
+        self.eq = blocks.Eq(self.snap, 'eq_core', nstreams=6)
+        instrument.reset()
+
+    def tearDown(self):
+        instrument.disable()
+        instrument.reset()
+
+    def test_disabled(self):
+        self.sync.write_int('arm', 1)
+        self.assertEqual(self.sync.read_uint('arm'), 1)
+        self.assertEqual(instrument.RECORDER.registers, {})
+
+    def test_enabled(self):
+        instrument.enable()
+        self.sync.write_int('arm', 1)
+        self.sync.write_int('arm', 2)
+        self.sync.read_uints(['uptime', 'count'])
+        self.eq.set_all_coeffs(200)
+        instrument.disable()
+        self.sync.write_int('arm', 3)
+        regs = instrument.RECORDER.registers
+        self.assertEqual(regs[('10.0.0.1', 'sync', 'arm', 'write')].latency.n, 2)
+        self.assertEqual(regs[('10.0.0.1', 'sync', '*', 'read')].bytes.total, 8)
+        self.assertEqual(regs[('10.0.0.1', 'eq_core', 'coeffs', 'write')].bytes.total, 6 * 2**11)
+        blocks_stats = instrument.RECORDER.by_block()
+        self.assertEqual(blocks_stats[('10.0.0.1', 'sync', 'write')].latency.n, 2)
+
+    def test_trace(self):
+        self.snap.strict = True
+        with instrument.trace('outer', log=True) as outer:
+            self.sync.write_int('arm', 1)
+            with instrument.trace('inner') as inner:
+                self.eq.set_all_coeffs(100)
+                self.assertRaises(KeyError, self.sync.read_uint, 'no_such_register_either')
+        self.assertFalse(instrument.ENABLED)
+        self.assertEqual(instrument.RECORDER.registers, {})
+        self.assertEqual(outer.summary()['count'], 3)
+        self.assertEqual(inner.summary()['count'], 2)
+        self.assertEqual(inner.summary()['errors'], 1)
+        self.assertEqual([event[4] for event in outer.events], ['arm', 'coeffs', 'no_such_register_either'])
+
+    def test_export(self):
+        instrument.enable()
+        self.sync.read_uint('count')
+        path = os.path.join(tempfile.mkdtemp(), 'instrumentation.json')
+        instrument.export_file(path)
+        with open(path) as fh:
+            record, = json.load(fh)['registers']
+        self.assertEqual((record['block'], record['reg'], record['count']), ('sync', 'count', 1))
+        self.assertEqual(record['bytes']['counts'], [0, 0, 0, 1]) # 4 bytes are in bin 3
+
+    def test_histogram(self):
+        h = instrument.Histogram()
+        for value in [0.5, 1, 3, 3, 1000]:
+            h.add(value)
+        self.assertEqual(h.counts[:4], [1, 1, 2, 0])
+        self.assertEqual(h.percentile(50), 4)
+        self.assertEqual(h.percentile(100), 1000)
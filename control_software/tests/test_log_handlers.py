@@ -0,0 +1,78 @@
+import unittest
+import logging
+import threading
+import json
+from hera_corr_f import helpers
+
+class Pipeline(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.messages = []
+
+    def publish(self, channel, message):
+        self.messages += [(channel, message)]
+
+    def execute(self):
+        self.conn.go.wait()
+        self.conn.batches += [len(self.messages)]
+        self.conn.published += self.messages
+
+class Connection(object):
+    """
+    Records what a RedisHandler publishes, once `go` is set.
+    """
+    def __init__(self):
+        self.go = threading.Event()
+        self.batches = []
+        self.published = []
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self)
+
+class TestRedisHandler(unittest.TestCase):
+    def setUp(self):
+        self.conn = Connection()
+        self.handler = helpers.RedisHandler('test-channel', self.conn, maxsize=100, batch=32)
+        self.handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        self.logger = logging.getLogger('test_log_handlers')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.conn.go.set()
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+    def test_batches_and_drops(self):
+        # Nothing is published while redis is stuck, so the queue fills up
+        for i in range(200):
+            self.logger.info('record %d', i)
+        self.conn.go.set()
+        self.handler.flush()
+        self.assertTrue(self.handler.dropped > 0)
+        self.assertEqual(len(self.conn.published) + self.handler.dropped, 200)
+        self.assertTrue(max(self.conn.batches) <= 32)
+        self.assertTrue(len(self.conn.batches) < len(self.conn.published))
+        # The newest records are the ones dropped
+        channel, message = self.conn.published[-1]
+        self.assertEqual(channel, 'test-channel')
+        self.assertEqual(json.loads(message)['formatted'], 'INFO record %d' % (len(self.conn.published) - 1))
+
+class TestDefaultHandlers(unittest.TestCase):
+    def test_handlers_are_shared(self):
+        a = helpers.add_default_log_handlers(logging.getLogger('test_log_handlers(a)'), redishostname='127.0.0.1')
+        b = helpers.add_default_log_handlers(logging.getLogger('test_log_handlers(b)'), redishostname='127.0.0.1')
+        helpers.add_default_log_handlers(a, redishostname='127.0.0.1')
+        self.assertEqual(len(a.handlers), 3)
+        self.assertEqual(a.handlers, b.handlers)
+        self.assertTrue(helpers.get_redis_handler('127.0.0.1') in a.handlers)
+
+    def test_closed_handler_is_replaced(self):
+        a = helpers.add_default_log_handlers(logging.getLogger('test_log_handlers(c)'), redishostname='127.0.0.2')
+        closed = helpers.get_redis_handler('127.0.0.2')
+        closed.close()
+        b = helpers.add_default_log_handlers(logging.getLogger('test_log_handlers(d)'), redishostname='127.0.0.2')
+        self.assertFalse(closed in b.handlers)
+        self.assertTrue(helpers.get_redis_handler('127.0.0.2') in b.handlers)
+        a.removeHandler(closed)
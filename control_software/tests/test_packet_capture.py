@@ -0,0 +1,138 @@
+import unittest
+import socket
+import time
+import numpy as np
+from hera_corr_f import packet_capture as pc
+
+def make_packets(times, chans, ant=0, mode='ramp_pols'):
+    pkts = np.zeros(len(times), dtype=pc.PACKET_DTYPE)
+    pkts['header'] = (np.array(times, dtype=np.uint64) << 29) | (np.array(chans, dtype=np.uint64) << 16) | ant
+    pc.payload_view(pkts)[:] = pc.TvgChecker(mode).expected(chans)
+    return pkts
+
+def send(pkts, addr):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for i, pkt in enumerate(pkts):
+        sock.sendto(pkt.tostring(), addr)
+        if i % 16 == 15:
+            time.sleep(0.001) # don't overrun the receive buffer
+    sock.close()
+
+class TestTvgChecker(unittest.TestCase):
+    def test_payload_errors_are_found(self):
+        for mode in pc.TVG_MODES:
+            pkts = make_packets([0, 4, 8], [0, 384, 8000], mode=mode)
+            pkts['payload'][1, 100] += 1
+            ok = pc.TvgChecker(mode).check(pkts)
+            self.assertEqual(list(ok), [True, False, True])
+
+    def test_pattern_matches_eqtvg(self):
+        tv = pc.tvg_pattern('ramp_ants')
+        self.assertEqual(list(tv[:, 300]), [(300 + s//2) % 256 for s in range(6)])
+        tv = pc.tvg_pattern('const_pols')
+        self.assertEqual(list(tv[:, 0]), range(6))
+
+class TestPacketCapture(unittest.TestCase):
+    def _capture(self, use_recvmmsg):
+        cap = pc.PacketCapture('127.0.0.1', 0, nslots=256, batch=32, use_recvmmsg=use_recvmmsg)
+        pkts = make_packets(4*np.arange(100), [384]*100, ant=3)
+        send(pkts, cap.sock.getsockname())
+        send([np.zeros(10, dtype=np.uint8)], cap.sock.getsockname())
+        got = []
+        while True:
+            batch = cap.recv_batch(timeout=0.2)
+            if len(batch) == 0:
+                break
+            got += [batch.copy()]
+        cap.close()
+        got = np.concatenate(got)
+        self.assertEqual(len(got), 100)
+        self.assertEqual(cap.nbad, 1)
+        t, chan, ant = pc.decode_headers(got)
+        self.assertEqual(list(t), list(4*np.arange(100)))
+        self.assertTrue(np.all(chan == 384) and np.all(ant == 3))
+
+    def test_recv_into(self):
+        self._capture(False)
+
+    def test_recvmmsg(self):
+        if pc._recvmmsg is None:
+            self.skipTest('recvmmsg not available')
+        self._capture(True)
+
+class TestCaptureStats(unittest.TestCase):
+    def test_timestamp_gaps(self):
+        stats = pc.CaptureStats(1)
+        times = [0, 4, 8, 20, 24]
+        stats.update(0, make_packets(times[:2], [0, 0]))
+        stats.update(0, make_packets(times[2:], [0, 0, 0]))
+        # a second stream, in the other bank, interleaved
+        stats.update(0, make_packets([2, 6, 10], [0, 0, 0]))
+        t = stats.totals()
+        self.assertEqual(t['packets'], 8)
+        self.assertEqual((t['even'], t['odd']), (5, 3))
+        self.assertEqual(t['time_errors'], 1)
+        self.assertEqual(t['lost'], 2)
+
+class TestCaptureService(unittest.TestCase):
+    def test_loopback(self):
+        service = pc.CaptureService('127.0.0.1', [0, 0], nworkers=2, tvg_mode='ramp_pols', batch=16)
+        service.start()
+        try:
+            for n, addr in enumerate(service.addresses):
+                pkts = make_packets(4*np.arange(50) + 2*n, [n*384]*50, ant=3)
+                pkts['payload'][0, 0] += 1
+                send(pkts, addr)
+            time.sleep(0.5)
+        finally:
+            service.stop()
+        t = service.stats.totals()
+        self.assertEqual(t['packets'], 100)
+        self.assertEqual((t['even'], t['odd']), (50, 50))
+        self.assertEqual(t['tvg_errors'], 2)
+        self.assertEqual(t['time_errors'], 0)
+        self.assertEqual(t['ants'][3], 100)
+        self.assertEqual(t['chans'][384], 50)
+
+class TestPacketGenerator(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            'dest_port' : 8511,
+            'fengines' : {'snap1' : {'ants' : [6, 7, 8]}},
+            'xengines' : {
+                0 : {'even' : {'ip' : '10.0.0.1'}, 'odd' : {'ip' : '10.0.0.2'}},
+                1 : {'even' : {'ip' : '10.0.0.3'}, 'odd' : {'ip' : '10.0.0.4'}},
+            },
+        }
+
+    def test_packets_follow_slot_plan(self):
+        from hera_corr_f.packet_generator import PacketGenerator
+        gen = PacketGenerator(self.config, tvg_mode='const_ants')
+        pkts, dests = gen.packets(2)
+        t, chan, ant = pc.decode_headers(pkts)
+        self.assertEqual(sorted(chan), [0, 384])
+        self.assertTrue(np.all(t == 2) and np.all(ant == 6))
+        # Time 2 is in the odd bank
+        self.assertEqual(sorted(dests), [('10.0.0.2', 8511), ('10.0.0.4', 8511)])
+        self.assertTrue(np.all(pc.TvgChecker('const_ants').check(pkts)))
+        gen.close()
+
+    def test_loopback(self):
+        from hera_corr_f.packet_generator import PacketGenerator
+        service = pc.CaptureService('127.0.0.1', [0, 0], tvg_mode='ramp_pols')
+        service.start()
+        try:
+            ip, even_port = service.addresses[0]
+            ip, odd_port = service.addresses[1]
+            gen = PacketGenerator(self.config, dest=(ip, even_port, odd_port), rate=20000)
+            sent, elapsed = gen.send(npkts=200)
+            gen.close()
+            time.sleep(0.5)
+        finally:
+            service.stop()
+        t = service.stats.totals()
+        self.assertEqual(sent, 200)
+        self.assertEqual(t['packets'], 200)
+        self.assertEqual((t['even'], t['odd']), (100, 100))
+        self.assertEqual(t['tvg_errors'] + t['time_errors'], 0)
+        self.assertEqual(list(t['per_worker']), [100, 100])
@@ -0,0 +1,42 @@
+import unittest
+import numpy as np
+from scipy.linalg import hadamard
+from hera_corr_f.blocks import PhaseSwitch
+from hera_corr_f.snap_sim import SimulatedSnap
+
+class TestPhaseSwitch(unittest.TestCase):
+    def setUp(self):
+        self.host = SimulatedSnap('10.0.0.1')
+        self.host.blindwrite('phase_switch_gpio_switch_states', '\x80' * 2**12)
+        self.host.blindwrite('phase_switch_sw_switch_states', '\xc0' * 2**12)
+        self.host.reset_stats()
+        self.ps = PhaseSwitch(self.host, 'phase_switch')
+
+    def test_walsh_matches_hadamard(self):
+        for N, n, stepperiod in [(1, 0, 1), (3, 2, 0), (8, 5, 1), (512, 300, 3)]:
+            N_round = int(2**np.ceil(np.log2(N)))
+            row = (hadamard(N_round)[n] == -1).astype(int).repeat(2**stepperiod)
+            expected = np.tile(row, self.ps.depth // len(row))
+            self.assertTrue(np.array_equal(self.ps.walsh_vec(N, n, stepperiod), expected))
+        self.assertRaises(ValueError, self.ps.walsh_vec, 1024, 1, 3)
+
+    def test_all_streams_one_write_per_bram(self):
+        params = [(8, stream + 1, 1) for stream in range(6)]
+        self.ps.set_walsh_streams(params)
+        # Each BRAM is read once, and written once (and read back, to check the write)
+        self.assertEqual((self.host.stats['reads'], self.host.stats['writes']), (4, 2))
+        for stream, (N, n, stepperiod) in enumerate(params):
+            vec = self.ps.walsh_vec(N, n, stepperiod)
+            self.assertTrue(np.array_equal(self.ps.get_mod_pattern(stream), vec))
+            self.assertTrue(np.array_equal(self.ps.get_demod_pattern(stream), vec))
+        # Bits not belonging to a stream are kept
+        mod = np.fromstring(self.host.read('phase_switch_gpio_switch_states', 2**12), dtype=np.uint8)
+        demod = np.fromstring(self.host.read('phase_switch_sw_switch_states', 2**12), dtype=np.uint8)
+        self.assertTrue(np.all(mod & 0xc0 == 0x80) and np.all(demod & 0xc0 == 0xc0))
+        # Later updates start from the cached images
+        self.host.reset_stats()
+        self.ps.set_walsh(2, 1, 0, 1, demodulate=False)
+        # The only reads are the checks of the writes
+        self.assertEqual(self.host.stats['reads'], self.host.stats['writes'])
+        self.assertEqual(self.ps.get_mod_pattern(2).max(), 0)
+        self.assertTrue(np.array_equal(self.ps.get_mod_pattern(3), self.ps.walsh_vec(8, 4, 1)))
@@ -0,0 +1,44 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from hera_corr_f import poco
+
+class TestPocoWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'poco')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_pairs_cover_baselines_and_pols(self):
+        slots = set([poco.pair_to_baseline_pol(pair) for pair in poco.POCO_PAIRS])
+        # Every slot but the yx of the autos is measured
+        self.assertEqual(len(slots), len(poco.BASELINES) * len(poco.POLS) - 3)
+
+    def test_write_and_read(self):
+        writer = poco.PocoWriter(self.path, 'snap', 3, nchans=8, flush_interval=0)
+        for t in range(2):
+            for pair in poco.POCO_PAIRS:
+                writer('snap', pair, 0, 100. + t, (np.arange(8) + 1j) * (pair[0] + 10*pair[1]))
+        # Only the first time is known to be complete before closing
+        header, data, times = poco.read_poco(self.path)
+        self.assertEqual(header['ntimes_written'], 1)
+        writer.close()
+        header, data, times = poco.read_poco(self.path)
+        self.assertEqual(data.shape, (2, 6, 4, 8))
+        self.assertFalse(np.any(np.isnan(times)))
+        self.assertEqual(list(times[:, 0, 0]), [100., 101.])
+        bl, pol = poco.pair_to_baseline_pol((1, 2))
+        self.assertEqual((poco.BASELINES[bl], poco.POLS[pol]), ((0, 1), 'yx'))
+        self.assertTrue(np.all(data[1, bl, pol] == np.arange(8) * 21 + 21j))
+        xy, yx = poco.POLS.index('xy'), poco.POLS.index('yx')
+        self.assertTrue(np.all(data[:, 0, yx] == np.conj(data[:, 0, xy])))
+
+    def test_full(self):
+        writer = poco.PocoWriter(self.path, 'snap', 1, nchans=8)
+        writer.add((0, 0), 0., np.ones(8))
+        self.assertRaises(IndexError, writer.add, (0, 0), 1., np.ones(8))
+        writer.close()
@@ -0,0 +1,35 @@
+import unittest
+from hera_corr_f.blocks import plan_reads
+
+class TestReadPlan(unittest.TestCase):
+    def setUp(self):
+        self.devices = {
+            'sync_uptime' : (0x0, 4),
+            'sync_period' : (0x4, 4),
+            'sync_count'  : (0x8, 4),
+            'pmbus_alert' : (0x100, 4),
+            'eq_coeffs'   : (0x4000, 0x4000),
+        }
+
+    def test_adjacent_registers_share_a_read(self):
+        plan = plan_reads(self.devices, [('sync_count', 0), ('sync_uptime', 0)])
+        self.assertEqual(len(plan), 1)
+        name, offset, nbytes, contents = plan[0]
+        self.assertEqual((name, offset, nbytes), ('sync_uptime', 0, 12))
+        self.assertEqual(sorted(contents), [(0, 8), (1, 0)])
+
+    def test_unmapped_gap_splits_reads(self):
+        plan = plan_reads(self.devices, [('sync_uptime', 0), ('pmbus_alert', 0)])
+        self.assertEqual(len(plan), 2)
+
+    def test_large_gap_splits_reads(self):
+        plan = plan_reads(self.devices, [('eq_coeffs', 0), ('eq_coeffs', 1000)], max_gap=256)
+        self.assertEqual(len(plan), 2)
+        self.assertEqual(plan[1][:3], ('eq_coeffs', 4000, 4))
+
+    def test_unknown_registers_read_alone(self):
+        plan = plan_reads(self.devices, [('sync_uptime', 0), ('not_a_reg', 2)])
+        self.assertTrue(('not_a_reg', 8, 4, [(1, 0)]) in plan)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+import numpy as np
+from hera_corr_f import redis_codec
+from hera_corr_f.blocks import ADC_SNAPSHOT_DTYPE
+
+class TestRedisCodec(unittest.TestCase):
+    def roundtrip(self, data, **kwargs):
+        blob = redis_codec.encode(data, timestamp=1234.5, **kwargs)
+        self.assertTrue(redis_codec.is_encoded(blob))
+        out, t = redis_codec.decode(blob)
+        self.assertEqual(t, 1234.5)
+        self.assertEqual(out.shape, data.shape)
+        return blob, out
+
+    def test_simple_types(self):
+        for dtype in ['>u4', '<i2', '>f8', 'c16', 'u1']:
+            data = (np.arange(24) * 3).astype(dtype).reshape(2, 3, 4)
+            blob, out = self.roundtrip(data)
+            self.assertTrue(np.array_equal(out, data))
+            self.assertNotEqual(out.dtype.byteorder, '>')
+
+    def test_payload_is_little_endian(self):
+        blob = redis_codec.encode(np.array([1], dtype='>u4'))
+        self.assertEqual(blob[-4:], '\x01\x00\x00\x00')
+
+    def test_records(self):
+        data = np.zeros(6, dtype=ADC_SNAPSHOT_DTYPE)
+        data['mean'] = np.arange(6)
+        data['histogram'][3] = np.arange(256)
+        for compress in [False, True]:
+            blob, out = self.roundtrip(data, compress=compress)
+            self.assertEqual(out.dtype, data.dtype)
+            self.assertTrue(np.array_equal(out, data))
+        self.assertTrue(len(redis_codec.encode(data, compress=True)) < data.nbytes)
+
+    def test_rejects_other_data(self):
+        self.assertRaises(ValueError, redis_codec.decode, 'not an array at all, just a string')
+        self.assertFalse(redis_codec.is_encoded('[1, 2, 3]'))
@@ -0,0 +1,88 @@
+import unittest
+import time
+import numpy as np
+from hera_corr_f import blocks
+from hera_corr_f import SnapFengine
+from hera_corr_f.snap_sim import SimulatedSnap, TapcpModel
+
+class TestSimulatedSnap(unittest.TestCase):
+    def setUp(self):
+        self.snap = SimulatedSnap('10.0.0.1', model=TapcpModel(latency=1e-3, block_latency=0, bandwidth=1e6))
+
+    def test_accounting(self):
+        sync = blocks.Sync(self.snap, 'sync')
+        sync.write_int('arm', 5)
+        sync.blindwrite('arm', '\x00\x00\x00\x06')
+        # write_int reads back what it wrote, blindwrite doesn't
+        self.assertEqual((self.snap.stats['writes'], self.snap.stats['reads']), (2, 1))
+        self.snap.reset_stats()
+        eq = blocks.Eq(self.snap, 'eq_core', nstreams=6)
+        eq.get_all_coeffs()
+        self.assertEqual(self.snap.stats['bytes_read'], 6 * 2048)
+        self.assertAlmostEqual(self.snap.stats['modeled_time'], 1e-3 + 6 * 2048 / 1e6)
+
+    def test_merged_register_reads(self):
+        sync = blocks.Sync(self.snap, 'sync')
+        sync.write_int('period', 1234)
+        self.snap.reset_stats()
+        stat = sync.read_uints(['uptime', 'period', 'count', 'arm'])
+        self.assertEqual(self.snap.stats['reads'], 1)
+        self.assertEqual(stat['period'], 1234)
+
+    def test_blocks_initialize(self):
+        fengine_blocks = [
+            blocks.Sync(self.snap, 'sync'),
+            blocks.NoiseGen(self.snap, 'noise', nstreams=6),
+            blocks.Input(self.snap, 'input', nstreams=12),
+            blocks.Pfb(self.snap, 'pfb'),
+            blocks.Eq(self.snap, 'eq_core', nstreams=6, ncoeffs=2**10),
+            blocks.EqTvg(self.snap, 'eqtvg', nstreams=6, nchans=2**13),
+            blocks.ChanReorder(self.snap, 'chan_reorder', nchans=2**10),
+            blocks.Packetizer(self.snap, 'packetizer', n_time_demux=2),
+            blocks.Eth(self.snap, 'eth'),
+            blocks.Corr(self.snap, 'corr_0'),
+            blocks.PhaseSwitch(self.snap, 'phase_switch'),
+        ]
+        for block in fengine_blocks:
+            block.initialize()
+        self.assertEqual(self.snap.unknown, set())
+        self.assertTrue(np.all(fengine_blocks[4].get_all_coeffs() == 100))
+        self.assertEqual(list(fengine_blocks[6].read_reorder()), range(1024))
+
+    def test_strict(self):
+        snap = SimulatedSnap('10.0.0.1', strict=True)
+        self.assertRaises(KeyError, snap.read_uint, 'no_such_register')
+        self.assertRaises(IndexError, snap.read, 'sync_uptime', 4, offset=2**20)
+
+    def test_accumulations(self):
+        corr = blocks.Corr(self.snap, 'corr_0')
+        corr.write_int('acc_len', 8192) # 262 us accumulations
+        cnt = corr.read_uint('acc_cnt')
+        self.assertTrue(corr.wait_for_new_acc(cnt, poll=0.001, timeout=1) > cnt)
+        spec = corr.get_new_corr(0, 0)
+        self.assertTrue(np.all(spec.real > 0) and np.all(spec.imag == 0))
+
+    def test_lazy_blocks(self):
+        feng = SnapFengine(self.snap.host, fpga=self.snap)
+        self.assertFalse(feng.i2c_initialized)
+        feng.eth.disable_tx()
+        self.assertTrue('eth' in feng.__dict__ and 'sync' not in feng.__dict__)
+        self.assertTrue(feng.eth is feng.eth)
+        feng.invalidate_shadows() # doesn't make the other blocks
+        self.assertFalse('sync' in feng.__dict__)
+        self.assertEqual([block.name for block in feng.blocks[2:]],
+                         ['sync', 'noise', 'input', 'delay', 'pfb', 'eq_core', 'eqtvg',
+                          'chan_reorder', 'packetizer', 'eth', 'corr_0', 'phase_switch'])
+
+    def test_shadows(self):
+        # Without shadows, bit-field updates read the register first
+        feng = SnapFengine(self.snap.host, fpga=self.snap)
+        feng.eth.write_int('ctrl', 0)
+        self.snap.reset_stats()
+        feng.eth.enable_tx()
+        self.assertEqual(self.snap.stats['reads'], 2) # the read, and write_int's read back
+        feng = SnapFengine(self.snap.host, fpga=self.snap, shadow=True)
+        feng.eth.write_int('ctrl', 0)
+        self.snap.reset_stats()
+        feng.eth.enable_tx()
+        self.assertEqual(self.snap.stats['reads'], 1)